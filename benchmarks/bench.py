@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+# Notepath requires Python 3.8 or higher.
+
+'''Time Notepath's main operations on a synthetic corpus of notes.
+
+Each benchmark runs --repeat times, and the fastest run is the one that
+counts (the slower runs are mostly other programs getting in the way).
+The results are written as JSON, and can be compared with the results
+of an earlier run (a baseline):
+
+    python benchmarks/bench.py --notes 20000 -o baseline.json
+    (change something)
+    python benchmarks/bench.py --notes 20000 --baseline baseline.json
+
+A benchmark that got slower than the baseline by more than the tolerance
+is reported as a regression, and the script then exits with status 1.
+Only runs on the same corpus (the same settings and seed) are compared.
+'''
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from typing import Callable, Dict, List
+
+from corpus import Corpus, add_corpus_arguments, get_corpus_from_args
+
+# (corpus.py has put the notepath directory in the import path.)
+from basics import FilePath, Object
+from database import Database
+from exporter import Exporter
+from note import get_notes_from_file, read_notes
+from querybuilder import QueryBuilder
+
+DEFAULT_REPEAT = 3
+DEFAULT_TOLERANCE = 0.20
+
+# The archive-growth benchmark edits and saves this many notes each round.
+ARCHIVE_NOTES = 1000
+ARCHIVE_ROUNDS = 5
+
+
+class Benchmarks(Object):
+    '''Runs the benchmarks on one corpus, in a scratch directory.
+
+    Each benchmark is a method named bench_<name>, which returns a dict of
+    measurements: at least "seconds" (of the fastest run), plus whatever
+    else is worth comparing, such as the number of notes a query found (if
+    that changes, the corpus or the query has, and the times can't be
+    compared).
+    '''
+    def __init__(self,
+                 corpus: Corpus,
+                 workdir: FilePath,
+                 repeat: int = DEFAULT_REPEAT
+                 ) -> None:
+        self.corpus = corpus
+        self.workdir = workdir
+        self.repeat = repeat
+        self.corpus_path = os.path.join(workdir, 'corpus.nptext')
+        self.db_path = os.path.join(workdir, 'bench.sqlite3')
+        self._db = None # the database the query benchmarks share
+
+    def get_names(self) -> List[str]:
+        '''Return the benchmarks' names, in the order they're defined.'''
+        return [name[len('bench_'):] for name in type(self).__dict__
+                if name.startswith('bench_')]
+
+    def _time(self,
+              function: Callable[[], object],
+              setup: Callable[[], None] = None
+              ) -> Dict:
+        '''Run the function repeatedly; return its times and its result.'''
+        runs = []
+        result = None
+        for _ in range(self.repeat):
+            if setup:
+                setup()
+            start_time = time.perf_counter()
+            result = function()
+            runs.append(time.perf_counter() - start_time)
+        return {'seconds': round(min(runs), 6),
+                'runs': [round(seconds, 6) for seconds in runs],
+                'result': result}
+
+    def _remove_database(self, db_path: FilePath) -> None:
+        for filepath in [db_path, db_path + '-journal']:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+
+    def _get_db(self) -> Database:
+        # The query benchmarks share one database, loaded (once) with the
+        # whole corpus.
+        if self._db is None:
+            self._remove_database(self.db_path)
+            self._db = Database(self.db_path)
+            with open(self.corpus_path, mode='r', encoding='utf-8') as file:
+                self._db.save_note_stream(read_notes(file))
+        return self._db
+
+    def run(self, names: List[str] = None) -> Dict:
+        '''Run the benchmarks named (or all); return the results.'''
+        start_time = time.perf_counter()
+        self.corpus.write(self.corpus_path)
+        corpus_seconds = time.perf_counter() - start_time
+
+        results = {}
+        for name in names or self.get_names():
+            self._error('Running', name, '...')
+            result = getattr(self, 'bench_' + name)()
+            result.pop('result', None)
+            results[name] = result
+        if self._db:
+            self._db.close()
+            self._db = None
+        return {
+            'environment': {
+                'python': platform.python_version(),
+                'sqlite': sqlite3.sqlite_version,
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+            },
+            'corpus': self.corpus.get_settings(),
+            'corpus_bytes': os.path.getsize(self.corpus_path),
+            'corpus_seconds': round(corpus_seconds, 6),
+            'repeat': self.repeat,
+            'benchmarks': results,
+        }
+
+    def bench_parse(self) -> Dict:
+        '''Read the corpus file into notes (get_notes_from_file).'''
+        result = self._time(lambda: get_notes_from_file(self.corpus_path))
+        result['notes'] = len(result['result'])
+        return result
+
+    def bench_save(self) -> Dict:
+        '''Save the whole corpus into a new database (as with -s).'''
+        db_path = os.path.join(self.workdir, 'save.sqlite3')
+
+        def save():
+            db = Database(db_path)
+            with open(self.corpus_path, mode='r', encoding='utf-8') as file:
+                count, _ = db.save_note_stream(read_notes(file))
+            db.close()
+            return count
+
+        result = self._time(save, lambda: self._remove_database(db_path))
+        result['notes'] = result['result']
+        result['database_bytes'] = os.path.getsize(db_path)
+        self._remove_database(db_path)
+        return result
+
+    def _bench_query(self,
+                     paths: List[str] = (),
+                     texts: List[str] = (),
+                     tags: List[str] = (),
+                     fields: List[str] = ()
+                     ) -> Dict:
+        db = self._get_db()
+        sql = QueryBuilder().build_sql_from_lists(list(paths), list(texts),
+                                                  list(tags), list(fields))
+        result = self._time(lambda: db._get_notes(sql))
+        result['matches'] = len(result['result'])
+        return result
+
+    def bench_query_path(self) -> Dict:
+        return self._bench_query(paths=[self.corpus.segment(1, 3)])
+
+    def bench_query_root(self) -> Dict:
+        return self._bench_query(paths=['^' + self.corpus.segment(0, 2)])
+
+    def bench_query_text(self) -> Dict:
+        # A word of middling frequency: found in some notes, not most.
+        return self._bench_query(texts=[self.corpus.word(200)])
+
+    def bench_query_ranked(self) -> Dict:
+        '''The ten best matches for the word of query_text (as with --rank).'''
+        db = self._get_db()
+        # (The first ranked query builds the full-text index; that is
+        # timed once, apart from the queries.)
+        start_time = time.perf_counter()
+        db.run_ranked_query([], [self.corpus.word(200)], [], [], 1)
+        index_seconds = time.perf_counter() - start_time
+        result = self._time(lambda: db.run_ranked_query(
+            [], [self.corpus.word(200)], [], [], 10))
+        result['matches'] = len(result['result'])
+        result['index_seconds'] = round(index_seconds, 6)
+        return result
+
+    def bench_query_tag(self) -> Dict:
+        return self._bench_query(tags=[self.corpus.tag_name(5)])
+
+    def bench_query_field_op(self) -> Dict:
+        field = self.corpus.field_name(1)
+        value = self.corpus.field_values // 10
+        return self._bench_query(fields=[field + ' < ' + str(value)])
+
+    def bench_query_field_has(self) -> Dict:
+        return self._bench_query(fields=['title has ' + self.corpus.word(30)])
+
+    def bench_query_field_re(self) -> Dict:
+        pattern = '^' + self.corpus.word(10)
+        return self._bench_query(fields=['title re ' + pattern])
+
+    def bench_hydrate(self) -> Dict:
+        '''Turn every row of the database back into a note.'''
+        db = self._get_db()
+        result = self._time(lambda: db._get_notes('SELECT id FROM notes'))
+        result['notes'] = len(result['result'])
+        return result
+
+    def bench_export(self) -> Dict:
+        '''Write every note to one file (as with -w).'''
+        notes = self._get_db()._get_notes('SELECT id FROM notes')
+        filepath = os.path.join(self.workdir, 'export.nptext')
+        exporter = Exporter(filepath, workers=1)
+        result = self._time(lambda: exporter.export(notes))
+        result['bytes'] = os.path.getsize(filepath)
+        return result
+
+    def bench_export_split(self) -> Dict:
+        '''Write every note to a file per top-level path segment.'''
+        notes = self._get_db()._get_notes('SELECT id FROM notes')
+        dirpath = os.path.join(self.workdir, 'export')
+        exporter = Exporter(dirpath, split_level=1)
+        result = self._time(lambda: exporter.export(notes))
+        result['files'] = len(result['result'])
+        shutil.rmtree(dirpath)
+        return result
+
+    def bench_archive_growth(self) -> Dict:
+        '''Edit and save the same notes over and over, with an archive file.
+
+        Besides the time, this reports how much the database and the
+        archive file grew for each old version of a note kept.
+        '''
+        db_path = os.path.join(self.workdir, 'archive.sqlite3')
+        archive_path = os.path.join(self.workdir, 'archive.nparch')
+        notes = {}
+        for note in self.corpus.notes():
+            notes[note.path] = note
+            if len(notes) >= ARCHIVE_NOTES:
+                break
+
+        def setup():
+            self._remove_database(db_path)
+            if os.path.exists(archive_path):
+                os.remove(archive_path)
+            db = Database(db_path, archive_path=archive_path)
+            db.save_notes({path: note.clone() for path, note in notes.items()})
+            db.close()
+
+        def grow():
+            db = Database(db_path, archive_path=archive_path)
+            sizes = (os.path.getsize(db_path), os.path.getsize(archive_path)
+                     if os.path.exists(archive_path) else 0)
+            for round_number in range(ARCHIVE_ROUNDS):
+                edited = {}
+                for path, note in notes.items():
+                    note = note.clone()
+                    note.textlines.append('Edit ' + str(round_number) + '.\n')
+                    note.directive = 'replace'
+                    edited[path] = note
+                db.save_notes(edited)
+            db.close()
+            return sizes
+
+        result = self._time(grow, setup)
+        db_bytes, archive_bytes = result['result']
+        versions = len(notes) * ARCHIVE_ROUNDS
+        result['versions'] = versions
+        result['database_bytes_per_version'] = round(
+            (os.path.getsize(db_path) - db_bytes) / versions, 1)
+        result['archive_bytes_per_version'] = round(
+            (os.path.getsize(archive_path) - archive_bytes) / versions, 1)
+        return result
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    '''Print a comparison with the baseline; return the regressions' names.
+    '''
+    if results['corpus'] != baseline.get('corpus'):
+        print('The baseline was run on a different corpus;'
+              ' the results cannot be compared.', file=sys.stderr)
+        return []
+
+    regressions = []
+    print('%-20s %10s %10s %8s' % ('benchmark', 'baseline', 'now', 'change'),
+          file=sys.stderr)
+    for name, result in results['benchmarks'].items():
+        old = baseline['benchmarks'].get(name)
+        if not old:
+            continue
+        change = result['seconds'] / old['seconds'] - 1 if old['seconds'] else 0
+        mark = ''
+        if change > tolerance:
+            mark = '  SLOWER'
+            regressions.append(name)
+        elif change < -tolerance:
+            mark = '  faster'
+        # A different count of notes found means something else changed.
+        for key in ['notes', 'matches', 'files']:
+            if key in old and old[key] != result.get(key):
+                mark += '  (' + key + ': ' + str(old[key]) + ' -> ' \
+                        + str(result.get(key)) + ')'
+        print('%-20s %10.4f %10.4f %+7.1f%%%s' % (name, old['seconds'],
+              result['seconds'], change * 100, mark), file=sys.stderr)
+    return regressions
+
+def main() -> None:
+    t = 'Time Notepath on a synthetic corpus; write the results as JSON.'
+    parser = argparse.ArgumentParser(description=t)
+    add_corpus_arguments(parser)
+
+    t = 'times to run each benchmark (default: ' + str(DEFAULT_REPEAT) + ')'
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help=t)
+
+    t = 'run only the benchmarks named'
+    parser.add_argument('--only', nargs='+', metavar='NAME', help=t)
+
+    t = 'list the benchmarks, then exit'
+    parser.add_argument('--list', action='store_true', help=t)
+
+    t = 'write the results to this file (default: standard output)'
+    parser.add_argument('-o', '--output', help=t)
+
+    t = 'compare the results with those in this file'
+    parser.add_argument('--baseline', help=t)
+
+    t = ('how much slower than the baseline (as a fraction) a benchmark can'
+         ' run before it counts as a regression (default: '
+         + str(DEFAULT_TOLERANCE) + ')')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help=t)
+    args = parser.parse_args()
+
+    corpus = get_corpus_from_args(args)
+    with tempfile.TemporaryDirectory(prefix='notepath-bench-') as workdir:
+        benchmarks = Benchmarks(corpus, workdir, max(1, args.repeat))
+        if args.list:
+            print('\n'.join(benchmarks.get_names()))
+            return
+        unknown = set(args.only or []) - set(benchmarks.get_names())
+        if unknown:
+            parser.error('unknown benchmark: ' + ', '.join(sorted(unknown)))
+        results = benchmarks.run(args.only)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, mode='w', encoding='utf-8') as file:
+            file.write(text + '\n')
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline, mode='r', encoding='utf-8') as file:
+            baseline = json.load(file)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# Notepath requires Python 3.8 or higher.
+
+'''Generate a synthetic corpus of notes, for benchmarking.
+
+The same settings (and the same seed) always produce the same notes, so
+that two benchmark runs --- on two versions of Notepath, say --- can be
+compared. Run this file to write a corpus to a text file:
+
+    python benchmarks/corpus.py --notes 10000 corpus.nptext
+'''
+
+import argparse
+import math
+import os
+import random
+import sys
+
+from typing import Dict, Iterator, List
+
+p = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+p = os.path.join(p, 'notepath')
+if p not in sys.path:
+    sys.path.append(p)
+
+from basics import FilePath, Object
+from note import Note
+
+SYLLABLES = ['ka', 'lo', 'mi', 'nu', 're', 'sa', 'ti', 'vo', 'ze', 'bra',
+             'cle', 'dro', 'fen', 'gal', 'hom', 'jun', 'mar', 'pel', 'qui',
+             'sto', 'tur', 'wen', 'xan', 'yor']
+LINE_WIDTH = 72
+
+
+class Corpus(Object):
+    '''A reproducible set of notes, with settings for their shape.
+
+    - count: the number of notes.
+    - seed: the seed for the random numbers; change it for other notes.
+    - text_median, text_sigma, text_max: a note's text runs about
+      text_median characters, with lengths spread log-normally (the
+      larger text_sigma, the more very short and very long notes), up to
+      text_max characters. Words are drawn from a vocabulary of
+      vocabulary_size made-up words, the commonest far more often than
+      the rarest (as in real text).
+    - tags, tags_per_note: how many different tags there are, and the
+      most any one note has (a note has from 0 to that many).
+    - fields, fields_per_note, field_values: how many different numeric
+      fields there are, the most any one note has, and how many values
+      (0 to field_values - 1) each can take. Every note also has a
+      "title" field of a few words, for queries that match text.
+    - depth, branching: a note's path has up to depth segments above its
+      own name, each one of branching names at its level.
+    '''
+    def __init__(self,
+                 count: int = 10000,
+                 seed: int = 1,
+                 text_median: int = 400,
+                 text_sigma: float = 1.0,
+                 text_max: int = 50000,
+                 vocabulary_size: int = 5000,
+                 tags: int = 50,
+                 tags_per_note: int = 3,
+                 fields: int = 10,
+                 fields_per_note: int = 2,
+                 field_values: int = 1000,
+                 depth: int = 3,
+                 branching: int = 10
+                 ) -> None:
+        self.count = count
+        self.seed = seed
+        self.text_median = text_median
+        self.text_sigma = text_sigma
+        self.text_max = text_max
+        self.vocabulary_size = vocabulary_size
+        self.tags = tags
+        self.tags_per_note = tags_per_note
+        self.fields = fields
+        self.fields_per_note = fields_per_note
+        self.field_values = field_values
+        self.depth = depth
+        self.branching = branching
+        self.words = self._make_vocabulary()
+
+    def get_settings(self) -> Dict:
+        '''Return the settings (for a benchmark report), as a dict.'''
+        return {name: value for name, value in vars(self).items()
+                if name != 'words'}
+
+    def _make_vocabulary(self) -> List[str]:
+        # The vocabulary depends only on the seed, so that the words used
+        # in queries (see word()) are the same from run to run.
+        rng = random.Random('vocabulary %d' % self.seed)
+        words = []
+        seen = set()
+        while len(words) < self.vocabulary_size:
+            word = ''.join(rng.choice(SYLLABLES)
+                           for _ in range(rng.randint(1, 4)))
+            if word not in seen:
+                seen.add(word)
+                words.append(word)
+        return words
+
+    def word(self, rank: int) -> str:
+        '''Return the word that is the rank-th commonest (counting from 0).'''
+        return self.words[rank % len(self.words)]
+
+    def tag_name(self, rank: int) -> str:
+        '''Return the tag that is the rank-th commonest (counting from 0).'''
+        return 'tag' + str(rank % self.tags)
+
+    def field_name(self, index: int) -> str:
+        return 'field' + str(index % self.fields)
+
+    def segment(self, level: int, index: int) -> str:
+        '''Return one of the names for a path segment at the level given.'''
+        return self.word(level * self.branching + index % self.branching)
+
+    def _zipf_weights(self, count: int) -> List[float]:
+        cumulative = []
+        total = 0.0
+        for rank in range(count):
+            total += 1.0 / (rank + 1)
+            cumulative.append(total)
+        return cumulative
+
+    def _make_text(self, rng: random.Random, weights: List[float]) -> str:
+        length = int(self.text_median * math.exp(rng.gauss(0,
+                                                           self.text_sigma)))
+        length = max(1, min(length, self.text_max))
+        lines = []
+        line = []
+        line_length = 0
+        total = 0
+        while total < length:
+            # Draw words in runs (which is much faster than one at a time).
+            for word in rng.choices(self.words, cum_weights=weights, k=16):
+                if line_length + len(word) >= LINE_WIDTH:
+                    lines.append(' '.join(line) + '\n')
+                    if rng.random() < 0.15:
+                        lines.append('\n')
+                    line, line_length = [], 0
+                line.append(word)
+                line_length += len(word) + 1
+                total += len(word) + 1
+        lines.append(' '.join(line) + '\n')
+        return ''.join(lines)
+
+    def notes(self) -> Iterator[Note]:
+        '''Yield the notes, one at a time, always in the same order.'''
+        rng = random.Random('notes %d' % self.seed)
+        word_weights = self._zipf_weights(len(self.words))
+        tag_weights = self._zipf_weights(self.tags)
+        tag_names = [self.tag_name(i) for i in range(self.tags)]
+        for i in range(self.count):
+            note = Note()
+            note.in_note = True
+            levels = rng.randint(0, self.depth)
+            segments = [self.segment(level, rng.randrange(self.branching))
+                        for level in range(levels)]
+            note.path = '/'.join(segments + ['note' + str(i)])
+
+            if self.tags:
+                for tag in rng.choices(tag_names, cum_weights=tag_weights,
+                                       k=rng.randint(0, self.tags_per_note)):
+                    if tag not in note.tags:
+                        note.tags.append(tag)
+            if self.fields:
+                for _ in range(rng.randint(0, self.fields_per_note)):
+                    name = self.field_name(rng.randrange(self.fields))
+                    value = float(rng.randrange(self.field_values))
+                    if (name, value) not in note.fields:
+                        note.fields.append((name, value))
+            title = rng.choices(self.words, cum_weights=word_weights,
+                                k=rng.randint(2, 5))
+            note.fields.append(('title', ' '.join(title)))
+
+            note.set_text(self._make_text(rng, word_weights))
+            yield note
+
+    def write(self, filepath: FilePath) -> int:
+        '''Write the notes to a text file; return the number written.'''
+        count = 0
+        with open(filepath, mode='w', encoding='utf-8') as file:
+            for note in self.notes():
+                file.write(str(note) + '\n')
+                count += 1
+        return count
+
+
+def add_corpus_arguments(parser: argparse.ArgumentParser) -> None:
+    '''Add an option for each of the settings of a Corpus.'''
+    for name, default in Corpus().get_settings().items():
+        option = '--' + ('notes' if name == 'count' else name)
+        option = option.replace('_', '-')
+        t = 'default: ' + str(default)
+        parser.add_argument(option, dest=name, type=type(default),
+                            default=default, help=t)
+
+def get_corpus_from_args(args: object) -> Corpus:
+    settings = Corpus().get_settings()
+    return Corpus(**{name: getattr(args, name) for name in settings})
+
+def main() -> None:
+    t = 'Write a synthetic corpus of notes to a text file.'
+    parser = argparse.ArgumentParser(description=t)
+    add_corpus_arguments(parser)
+    parser.add_argument('filepath', help='the file to write')
+    args = parser.parse_args()
+    count = get_corpus_from_args(args).write(args.filepath)
+    print('Wrote', count, 'notes to', args.filepath)
+
+
+if __name__ == '__main__':
+    main()
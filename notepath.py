@@ -1,6 +1,12 @@
 #!/usr/bin/env python3
 
+import sys
+
+# (Checked before anything else is imported, since the modules themselves
+# would fail on an older Python with a less helpful message.)
+if sys.version_info < (3, 8):
+    sys.exit('Notepath requires Python 3.8 or higher.')
+
 from notepath.script import Script
 
 Script().run()
-
@@ -1,16 +1,27 @@
 #!/usr/bin/env python3
-# The function annotations in this module require Python 3.5 or higher.
+# Notepath requires Python 3.8 or higher.
 
+import gzip
+import hashlib
+import io
 import os
+import time
 
-from typing import Dict
+from typing import Dict, Iterable, List, Tuple
 from basics import FilePath, NotePath, Object, get_data_path, sort_notepaths
-from note import Note
-from utils import timestamp_for_logging
+from note import Note, read_notes
+from utils import timestamp_for_filename, timestamp_for_logging
 
 ARCHIVE_FILENAME = 'archive.nparch'
 ARCHIVE_FIELD = '{archive_date}'
 
+# Rotated segments of the archive are compressed once they are this old.
+COMPRESS_AFTER_DAYS = 30
+
+# Each line of the segment index reads: segment, notepath, offset, length.
+IndexEntry = Tuple[str, NotePath, int, int]
+
+
 class Archiver(Object):
     '''Appends old records from the database to the archive file.
     
@@ -18,28 +29,187 @@ class Archiver(Object):
     but with an additional "{archive_date}" field assigned to each
     note in the file.
     
-    Whenever a note in the database is to be changed or deleted, it is
-    first exported to the archive file as a backup.
+    Old versions of notes are kept in the database's history table. The
+    archive file is written only if the database is given a path for it,
+    or when the history is exported.
     '''
     def __init__(self, path: FilePath = None) -> None:
         if not path:
             path = ARCHIVE_FILENAME
         self.path = get_data_path(path)
+        self.stem = os.path.splitext(self.path)[0]
+        self.index_path = self.stem + '.npidx'
 
         # Make sure the directory exists.
         dirpath = os.path.dirname(self.path)
         if not os.path.exists(dirpath):
             os.makedirs(dirpath)
+
+    def _open_for_append(self):
+        '''Open the archive file for appending.
+        
+        A note's text need not end with a newline, but the header of the
+        next note must begin on a line of its own, so self._at_line_start
+        tracks whether a newline must be written before the next note.
+        '''
+        self._at_line_start = True
+        if os.path.exists(self.path) and os.path.getsize(self.path):
+            with open(self.path, mode='rb') as file:
+                file.seek(-1, os.SEEK_END)
+                self._at_line_start = file.read(1) == b'\n'
+        return open(self.path, mode='a', encoding='utf-8')
+
+    def _write_note(self, note: Note, when: float, file) -> None:
+        # Do not modify the original note; clone it and add the
+        # {archive_date} field to the clone.
+        clone = note.clone()
+        name, value = ARCHIVE_FIELD, timestamp_for_logging(when)
+        clone.fields.append((name, value))
+        if not self._at_line_start:
+            file.write('\n')
+        text = str(clone)
+        file.write(text)
+        self._at_line_start = text.endswith('\n')
     
     def append_notes(self, notes: Dict[NotePath, Note]) -> None:
         notepaths = sort_notepaths(list(notes.keys()))
-        with open(self.path, mode='a', encoding='utf-8') as file:
-            # Do not modify the original notes; clone each note and add the
-            # {archive_date} field to the clone.
+        with self._open_for_append() as file:
             for notepath in notepaths:
-                clone = notes[notepath].clone()
-                name, value = ARCHIVE_FIELD, timestamp_for_logging()
-                clone.fields.append((name, value))
-                clone.write(file)
+                self._write_note(notes[notepath], None, file)
+
+    def append_versions(self, versions: Iterable[Tuple[float, Note]]) -> None:
+        '''Append each note with the time (in epoch seconds) it was archived.
+        '''
+        with self._open_for_append() as file:
+            for when, note in versions:
+                self._write_note(note, when, file)
+
+    def _read_index(self) -> List[IndexEntry]:
+        entries = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path, mode='r', encoding='utf-8') as file:
+                for line in file:
+                    segment, notepath, offset, length = line.rstrip(
+                        '\n').split('\t')
+                    entries.append((segment, notepath,
+                                    int(offset), int(length)))
+        return entries
+
+    def _write_index(self, entries: List[IndexEntry]) -> None:
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, mode='w', encoding='utf-8') as file:
+            for segment, notepath, offset, length in entries:
+                file.write('\t'.join([segment, notepath,
+                                      str(offset), str(length)]) + '\n')
+        os.replace(temp_path, self.index_path)
 
+    def rotate(self) -> List[IndexEntry]:
+        '''Move the archive file into a new segment; return its index entries.
+        
+        The notes in the segment are grouped by notepath (in the order of
+        sort_notepaths(), oldest version first), so that each note's versions
+        can be read with a single seek. A version that is byte-for-byte the
+        same as the version before it (other than the archive date) is
+        dropped.
+        '''
+        if not os.path.exists(self.path) or not os.path.getsize(self.path):
+            return []
+
+        versions = {} # type: Dict[NotePath, List[str]]
+        last_hashes = {} # type: Dict[NotePath, str]
+        with open(self.path, mode='r', encoding='utf-8') as file:
+            for note in read_notes(file):
+                # (Only the last version in the file may lack a final
+                # newline; ignore it when comparing versions.)
+                clone = note.clone()
+                clone.fields = [f for f in clone.fields if f[0] != ARCHIVE_FIELD]
+                text = str(clone)
+                if text.endswith('\n'):
+                    text = text[:-1]
+                digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+                if last_hashes.get(note.path) == digest:
+                    continue
+                last_hashes[note.path] = digest
+                text = str(note)
+                if not text.endswith('\n'):
+                    text += '\n'
+                versions.setdefault(note.path, []).append(text)
+
+        segment = self.stem + '-' + timestamp_for_filename() + '.nparch'
+        entries = []
+        with open(segment, mode='wb') as file:
+            for notepath in sort_notepaths(list(versions.keys())):
+                data = ''.join(versions[notepath]).encode('utf-8')
+                entries.append((os.path.basename(segment), notepath,
+                                file.tell(), len(data)))
+                file.write(data)
+        os.remove(self.path)
+        return entries
+
+    def compress_segments(self,
+                          entries: List[IndexEntry],
+                          days: float = COMPRESS_AFTER_DAYS
+                          ) -> List[IndexEntry]:
+        '''Gzip segments older than the number of days given.
+        
+        Each notepath's versions are compressed as a separate gzip member
+        (a file of concatenated members is still a valid gzip file), so that
+        one note's versions can be read by decompressing only its member.
+        Return the index entries, updated for the compressed segments.
+        '''
+        dirpath = os.path.dirname(self.path)
+        cutoff = time.time() - days * 24 * 60 * 60
+        by_segment = {} # type: Dict[str, List[IndexEntry]]
+        for entry in entries:
+            by_segment.setdefault(entry[0], []).append(entry)
+
+        updated = []
+        for segment in sorted(by_segment.keys()):
+            segment_entries = by_segment[segment]
+            path = os.path.join(dirpath, segment)
+            if segment.endswith('.gz') or os.path.getmtime(path) > cutoff:
+                updated.extend(segment_entries)
+                continue
+            compressed = segment + '.gz'
+            with open(path, mode='rb') as source, \
+                 open(os.path.join(dirpath, compressed), mode='wb') as target:
+                for _, notepath, offset, length in segment_entries:
+                    source.seek(offset)
+                    member = gzip.compress(source.read(length))
+                    updated.append((compressed, notepath,
+                                    target.tell(), len(member)))
+                    target.write(member)
+            os.remove(path)
+        return updated
+
+    def maintain(self, days: float = COMPRESS_AFTER_DAYS) -> None:
+        '''Rotate the archive file, compress old segments, update the index.
+        '''
+        entries = self._read_index() + self.rotate()
+        entries = self.compress_segments(entries, days)
+        self._write_index(entries)
+
+    def read_versions(self, notepath: NotePath) -> List[Note]:
+        '''Return the archived versions of the note, oldest first.
+        
+        Only the note's own part of each segment is read (and decompressed);
+        the archive file not yet rotated is read in full.
+        '''
+        dirpath = os.path.dirname(self.path)
+        notes = []
+        for segment, path, offset, length in sorted(self._read_index()):
+            if path != notepath:
+                continue
+            with open(os.path.join(dirpath, segment), mode='rb') as file:
+                file.seek(offset)
+                data = file.read(length)
+            if segment.endswith('.gz'):
+                data = gzip.decompress(data)
+            notes.extend(read_notes(io.StringIO(data.decode('utf-8'))))
 
+        if os.path.exists(self.path):
+            with open(self.path, mode='r', encoding='utf-8') as file:
+                for note in read_notes(file):
+                    if note.path == notepath:
+                        notes.append(note)
+        return notes
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# Notepath requires Python 3.8 or higher.
+
+import asyncio
+import os
+import threading
+
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Union
+
+from basics import FilePath, NotePath, Object, SQLSelectStatement
+from database import Database
+from note import Note
+from querybuilder import QueryBuilder
+
+
+class _Job(Object):
+    '''A call to make on a database connection in a worker thread.
+
+    A job can be interrupted from any thread: if it hasn't started, it
+    never will, and if it is running, SQLite is told to stop the statement
+    it is running (which then raises sqlite3.OperationalError in the worker
+    thread; a save is rolled back).
+    '''
+    def __init__(self, function: Callable[[Database], Any]) -> None:
+        self.function = function
+        self.db = None # the database the job is running on, while it runs
+        self.interrupted = False
+        self._lock = threading.Lock()
+
+    def run(self, db: Database) -> Any:
+        with self._lock:
+            if self.interrupted:
+                return None
+            self.db = db
+        try:
+            return self.function(db)
+        finally:
+            with self._lock:
+                self.db = None
+
+    def interrupt(self) -> None:
+        with self._lock:
+            self.interrupted = True
+            if self.db:
+                self.db.connection.interrupt()
+
+
+class AsyncDatabase(Object):
+    '''Lets an asyncio program query and save notes without blocking.
+
+    Queries run in a pool of threads, each with its own read-only
+    connection, so that several can run at once (sqlite3 lets go of
+    Python's global lock while SQLite works). Saves run one at a time in a
+    thread of their own, on the one connection that writes. The database
+    is put in WAL mode, so that readers see the last save committed and
+    don't have to wait for a save in progress.
+
+    At most max_pending calls are queued or running at once; beyond that,
+    callers wait their turn (so a burst of requests can't pile up work
+    without limit). A call that is cancelled --- for instance, by
+    asyncio.wait_for() running out of time --- is interrupted.
+
+    Use it as an async context manager:
+
+        async with AsyncDatabase(path) as db:
+            notes = await db.query(tags=['project'])
+    '''
+    def __init__(self,
+                 db_path: FilePath,
+                 readers: int = None,
+                 max_pending: int = None
+                 ) -> None:
+        self.db_path = db_path
+        self.readers = readers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.readers * 4
+        self._read_executor = ThreadPoolExecutor(
+            max_workers=self.readers, thread_name_prefix='notepath-reader')
+        self._write_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='notepath-writer')
+        self._local = threading.local()
+        self._reader_dbs = [] # type: List[Database]
+        self._reader_lock = threading.Lock()
+        self._writer = None # type: Database
+        self._semaphore = None # type: asyncio.Semaphore
+
+    async def __aenter__(self) -> 'AsyncDatabase':
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    def _get_reader(self) -> Database:
+        # Each reader thread opens its connection the first time it's used.
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = Database(self.db_path, read_only=True)
+            self._local.db = db
+            with self._reader_lock:
+                self._reader_dbs.append(db)
+        return db
+
+    def _get_writer(self) -> Database:
+        if self._writer is None:
+            self._writer = Database(self.db_path)
+            self._writer.connection.execute('PRAGMA journal_mode=WAL;')
+        return self._writer
+
+    async def _run(self,
+                   executor: Executor,
+                   get_db: Callable[[], Database],
+                   function: Callable[[Database], Any]
+                   ) -> Any:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_pending)
+        job = _Job(function)
+        loop = asyncio.get_running_loop()
+        await self._semaphore.acquire()
+
+        # The slot is given back when the job is done in its thread, not
+        # when the caller stops waiting: a job cancelled while it runs (or
+        # while it is queued in the executor) still holds a thread until
+        # it stops, and max_pending is meant to count it until then.
+        def release(_) -> None:
+            try:
+                loop.call_soon_threadsafe(self._semaphore.release)
+            except RuntimeError:
+                pass # (The event loop has been closed.)
+
+        try:
+            future = executor.submit(lambda: job.run(get_db()))
+        except BaseException:
+            self._semaphore.release()
+            raise
+        future.add_done_callback(release)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            job.interrupt()
+            raise
+
+    async def _read(self, function: Callable[[Database], Any]) -> Any:
+        return await self._run(self._read_executor, self._get_reader,
+                               function)
+
+    async def _write(self, function: Callable[[Database], Any]) -> Any:
+        return await self._run(self._write_executor, self._get_writer,
+                               function)
+
+    async def open(self) -> None:
+        '''Open (or create) the database, so that readers can connect.'''
+        await self._write(lambda db: None)
+
+    async def close(self) -> None:
+        '''Wait for the calls in progress, then close every connection.'''
+        # The writer closes last: only a connection that can write can
+        # clean up the WAL files, and only the last one to close does.
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._close_readers)
+        if self._writer is not None:
+            await loop.run_in_executor(self._write_executor,
+                                       self._writer.close)
+            self._writer = None
+        self._write_executor.shutdown()
+
+    def _close_readers(self) -> None:
+        self._read_executor.shutdown()
+        with self._reader_lock:
+            for db in self._reader_dbs:
+                db.close()
+            self._reader_dbs = []
+
+    async def run_query(self, sql: SQLSelectStatement) -> Dict[NotePath, Note]:
+        '''Return the notes whose IDs the SQL selects.'''
+        return await self._read(lambda db: db._get_notes(sql))
+
+    async def query(self,
+                    paths: Iterable[str] = (),
+                    texts: Iterable[str] = (),
+                    tags: Iterable[str] = (),
+                    fields: Iterable[str] = ()
+                    ) -> Dict[NotePath, Note]:
+        '''Return the notes matching the terms, as with -p, -t, -g, -f.'''
+        sql = QueryBuilder().build_sql_from_lists(list(paths), list(texts),
+                                                  list(tags), list(fields))
+        return await self.run_query(sql)
+
+    async def run_saved_query(self, query_name: str) -> Dict[NotePath, Note]:
+        return await self._read(lambda db: db.run_saved_query(query_name))
+
+    async def get_notes_by_path(self,
+                                notepaths: Union[NotePath, List[NotePath]]
+                                ) -> Dict[NotePath, Note]:
+        return await self._read(lambda db: db.get_notes_by_path(notepaths))
+
+    async def save_notes(self, notes: Dict[NotePath, Note]) -> List[NotePath]:
+        '''Save the notes; return the paths of stale notes (see save_notes).'''
+        return await self._write(lambda db: db.save_notes(notes))
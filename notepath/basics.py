@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
-# The function annotations in this module require Python 3.5 or higher.
+# Notepath requires Python 3.8 or higher.
 
 import os
+import sys
 import textwrap
 
 from itertools import chain
@@ -41,9 +42,13 @@ def sort_notepaths(notepaths: List[NotePath]) -> List[NotePath]:
     
     (We also ask the sort method to ignore case.)
     '''
-    notepaths.sort(key=lambda s: s.lower().replace('/', chr(0)))
+    notepaths.sort(key=notepath_sort_key)
     return notepaths
 
+def notepath_sort_key(notepath: NotePath) -> str:
+    '''Return the string by which sort_notepaths() sorts a notepath.'''
+    return notepath.lower().replace('/', chr(0))
+
 
 class Object():
     def _error(self, *args, **kwargs):
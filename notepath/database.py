@@ -1,31 +1,135 @@
 #!/usr/bin/env python3
-# The function annotations in this module require Python 3.5 or higher.
+# Notepath requires Python 3.8 or higher.
 
+import gzip
+import json
 import os
 import re
 import sqlite3
+import sys
+import tempfile
+import time
+import zlib
 
-from typing import Dict, List, Union
+from contextlib import nullcontext
+from functools import lru_cache
 
-from basics import (FilePath, NotePath, Object, sort_notepaths,
-                    SQLSelectStatement)
+from typing import (Callable, ContextManager, Dict, Iterable, Iterator, List,
+                    Set, Tuple, Union)
+from urllib.request import pathname2url
+
+from basics import (FilePath, NotePath, notepath_sort_key, Object,
+                    sort_notepaths, SQLSelectStatement)
 from archiver import Archiver
-from note import Note
-from querybuilder import QueryBuilder
+from delta import apply_delta, make_delta, make_prefix_delta
+from note import Note, OffsetReader, read_notes
+from profiler import Profiler
+from querybuilder import fts_words, QueryBuilder
+from utils import timestamp_for_logging
 
 # Type aliases
+ChangeSeq = int
+HistoryID = int
+NodeID = int
 NoteID = int
 
 DEFAULT_DATABASE_FILENAME = 'notes.sqlite3'
 
+# The "file name" SQLite takes to mean a database kept only in memory.
+IN_MEMORY = ':memory:'
+
+# How many notes save_note_stream() saves in each transaction.
+DEFAULT_BATCH_SIZE = 1000
+
+# Indexes that bulk_import() drops while loading notes and rebuilds after.
+# (The indexes that saving a note itself uses, such as those on tags.id and
+# on tag_counts, are kept; without them each note saved would scan a table.)
+_DEFERRED_INDEXES = ['path_index', 'name_index', 'value_index',
+                     'modified_index', 'created_index',
+                     'history_tag_name_index', 'history_tag_value_index',
+                     'history_valid_index']
+
+# A dump (see Database.dump) gives each note's times as these fields, much
+# as the archive file gives each version's archive date.
+DUMP_CREATED_FIELD = '{created_at}'
+DUMP_MODIFIED_FIELD = '{modified_at}'
+
+# Notepath format cannot show every text exactly: the text of a note read
+# from a file never begins with a blank line, always ends with a newline, and
+# stops at a line beginning with a single backslash. A dump gives any such
+# text, JSON-encoded on one line, as this field instead (with no text below
+# the header block), so that the dump restores it as it was.
+DUMP_TEXT_FIELD = '{text}'
+_UNDUMPABLE_TEXT_RE = re.compile(r'\r|^\\(?!\\)', re.MULTILINE)
+
+# A note's text longer than this many characters is stored compressed with
+# zlib (as a BLOB, in the same column as the other texts, so SQLite's typeof()
+# tells the two apart). The limit can be changed for each database, and 0
+# means texts are never compressed; see set_compress_over().
+DEFAULT_COMPRESS_OVER = 4096
+
+# The zlib level used. Saving a long text at level 6 (zlib's default) takes
+# several times as long as at level 1, and the text is only about a third
+# smaller; unpacking takes about as long either way.
+_COMPRESS_LEVEL = 1
+
+# Old versions of a note are stored as deltas against the next newer version,
+# except that every Nth version of each notepath is stored in full, so that
+# rebuilding any version never takes more than N deltas.
+HISTORY_SNAPSHOT_INTERVAL = 16
+
+# A character that sorts after any character likely to follow a prefix, used
+# to turn "begins with this prefix" into a range that can use an index.
+_PREFIX_END = chr(0x10FFFF)
+
+
+def _pack_text(text: str, compress_over: int) -> Union[str, bytes]:
+    '''Return the text as it should be stored: compressed, if it is long.'''
+    if not text or not compress_over or len(text) <= compress_over:
+        return text
+    packed = zlib.compress(text.encode('utf-8'), _COMPRESS_LEVEL)
+    return packed if len(packed) < len(text) else text
+
+@lru_cache(maxsize=4)
+def _decompress(packed: bytes) -> str:
+    # (A query with several words to find calls REGEXP on the same text once
+    # for each word, so the last few texts unpacked are kept.)
+    return zlib.decompress(packed).decode('utf-8')
+
+def _unpack_text(value: Union[str, bytes, None]) -> Union[str, None]:
+    '''Return the text stored in a note's text column.'''
+    if isinstance(value, bytes):
+        return _decompress(value)
+    return value
+
+def _fts_words(value: Union[str, bytes, None]) -> Union[str, None]:
+    '''Return the words of a (stored) text, for the full-text index.'''
+    if value is None:
+        return None
+    return fts_words(_unpack_text(value))
 
 def _regexp(pattern, text: str) -> bool:
-    return bool(re.search(pattern, text))
+    return bool(re.search(pattern, _unpack_text(text)))
+
+@lru_cache(maxsize=1)
+def _current_tables() -> Dict[str, Set[str]]:
+    '''Return the tables (and their columns) that create_tables() makes.'''
+    db = Database(IN_MEMORY)
+    cursor = db.connection.cursor()
+    tables = db._get_tables(cursor)
+    cursor.close()
+    db.close()
+    return tables
 
 class DatabaseError(Exception): pass
 
 class Database(Object):
-    def __init__(self, db_path: FilePath, archive_path: FilePath = None) -> None:
+    def __init__(self,
+                 db_path: FilePath,
+                 archive_path: FilePath = None,
+                 read_only: bool = False,
+                 staged: bool = False
+                 ) -> None:
         # Permitting an alternative filename for the database allows
         # us to create a dummy database for testing purposes.
         if not db_path:
@@ -33,19 +137,56 @@ class Database(Object):
             raise FileNotFoundError(t)
         self.db_path = db_path
 
-        # Make sure the database directory exists.
-        dirpath = os.path.dirname(db_path)
-        if not os.path.exists(dirpath):
-            os.makedirs(dirpath)
-
         # Also permit an alternative path for the archive file.
         self._archive_path = archive_path
-        
-        self.connection = sqlite3.connect(self.db_path)
+
+        # A staged database is copied into memory, and copied back to its
+        # file by sync() (and by close()); see _load_staged().
+        self.staged = staged
+        self._staged_stat = None
+        self._synced_changes = 0
+
+        # A profiler, if one is set, is told what the database is doing.
+        self.profiler = None # type: Profiler
+
+        self.read_only = read_only
+
+        if read_only:
+            # A read-only connection can only open a database that already
+            # exists (and already has its tables). SQLite itself refuses to
+            # write through it, so it is safe to hand to another thread ---
+            # for one thing, to close it (see AsyncDatabase).
+            uri = 'file:' + pathname2url(os.path.abspath(db_path)) + '?mode=ro'
+            self.connection = sqlite3.connect(uri, uri=True,
+                                              check_same_thread=False)
+        elif staged or db_path == IN_MEMORY:
+            self.connection = sqlite3.connect(IN_MEMORY)
+            if staged:
+                self._load_staged()
+        else:
+            # Make sure the database directory exists. (A database file
+            # named with no directory goes in the current directory.)
+            dirpath = os.path.dirname(db_path)
+            if dirpath and not os.path.exists(dirpath):
+                os.makedirs(dirpath)
+            self.connection = sqlite3.connect(self.db_path)
         self.connection.create_function("REGEXP", 2, _regexp)
+        self.connection.create_function("HISTORY_TEXT", 1,
+                                        self._get_history_text)
+        self.connection.create_function("NOTEPATH_KEY", 1, notepath_sort_key,
+                                        deterministic=True)
+        self.connection.create_function("NOTE_TEXT", 1, _unpack_text,
+                                        deterministic=True)
+        self.connection.create_function("FTS_WORDS", 1, _fts_words,
+                                        deterministic=True)
+        if read_only:
+            self.compress_over = self.get_compress_over()
+            return
         try:
             self.create_tables()
             self.create_indexes()
+            self.compress_over = self.get_compress_over()
+            self._synced_changes = self.connection.total_changes
         except sqlite3.OperationalError:
             # While writing this script, sometimes I'd doublecheck the contents
             # of the database with another program, e.g., DB Browser for SQLite,
@@ -55,11 +196,218 @@ class Database(Object):
             self._error(t)
             sys.exit(1)
 
+    def _get_file_stat(self) -> Union[Tuple[int, int], None]:
+        '''Return the database file's modification time and size, if any.'''
+        if not os.path.exists(self.db_path):
+            return None
+        stat = os.stat(self.db_path)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _load_staged(self) -> None:
+        '''Copy the database file (if there is one yet) into memory.
+        
+        On slow media such as a thumb drive, reading the whole file once,
+        from start to end, is faster than the scattered reads of a query,
+        and saving into memory skips the waits for each transaction to
+        reach the disk.
+        '''
+        self._staged_stat = self._get_file_stat()
+        if self._staged_stat:
+            disk = sqlite3.connect(self.db_path)
+            disk.backup(self.connection)
+            disk.close()
+
+    def set_profiler(self, profiler: Union[Profiler, None]) -> None:
+        '''Report work done to the profiler (or, given None, stop).
+        
+        The profiler is given the phases of work (see _phase), every SQL
+        statement run, and a count of the calls to REGEXP.
+        '''
+        self.profiler = profiler
+        regexp = _regexp
+        if profiler:
+            regexp = profiler.count_calls('REGEXP', _regexp)
+            self.connection.set_trace_callback(profiler.trace_sql)
+        else:
+            self.connection.set_trace_callback(None)
+        self.connection.create_function("REGEXP", 2, regexp)
+
+    def _phase(self, name: str) -> ContextManager:
+        '''Return a context for timing a phase of work, if profiling.'''
+        if self.profiler:
+            return self.profiler.phase(name)
+        return nullcontext()
+
     def _create_index(self, cursor, clause: str) -> None:
         t = 'CREATE INDEX IF NOT EXISTS ' + clause + ';'
         cursor.execute(t)
 
-    def _get_notes(self, sql: SQLSelectStatement) -> Dict[NotePath, Note]:
+    def _add_column(self, table: str, column: str, cursor) -> bool:
+        '''Add the column to the table if missing; return True if added.
+        
+        (This lets databases created by earlier versions of Notepath pick
+        up columns added since.) The column is given as name and type.
+        '''
+        name = column.split()[0]
+        cursor.execute('PRAGMA table_info(' + table + ');')
+        if name in [row[1] for row in cursor.fetchall()]:
+            return False
+        cursor.execute('ALTER TABLE ' + table + ' ADD COLUMN ' + column + ';')
+        return True
+
+    def _table_exists(self, table: str, cursor) -> bool:
+        sql = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?;"
+        cursor.execute(sql, (table,))
+        return cursor.fetchone() is not None
+
+    def _get_tables(self, cursor) -> Dict[str, Set[str]]:
+        '''Return the name of each table, with the names of its columns.'''
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'"
+                       " AND name NOT LIKE 'sqlite\\_%' ESCAPE '\\';")
+        tables = {}
+        for (name,) in cursor.fetchall():
+            cursor.execute('PRAGMA table_info(' + name + ');')
+            tables[name] = {row[1] for row in cursor.fetchall()}
+        return tables
+
+    def needs_upgrade(self) -> bool:
+        '''Return True if the database lacks a table or column it should have.
+        
+        A database written by an earlier version of Notepath picks up the
+        tables and columns added since when it is opened (by create_tables),
+        but not on a read-only connection; this tells whether it has yet,
+        by comparing it with a new, empty database. Nothing is changed.
+        '''
+        cursor = self.connection.cursor()
+        tables = self._get_tables(cursor)
+        cursor.close()
+        return any(not columns <= tables.get(name, set())
+                   for name, columns in _current_tables().items())
+
+    def _get_node_id(self, notepath: NotePath, cursor) -> Union[NodeID, None]:
+        '''Return the ID of the outline node for the notepath, if any.
+        
+        The blank notepath stands for the root of the outline, whose ID is 0.
+        '''
+        node_id = 0
+        if not notepath:
+            return node_id
+        sql = 'SELECT id FROM outline WHERE parent = ? AND segment = ?;'
+        for segment in notepath.split('/'):
+            cursor.execute(sql, (node_id, segment))
+            record = cursor.fetchone()
+            if not record:
+                return None
+            node_id = record[0]
+        return node_id
+
+    def _add_path_to_outline(self,
+                             notepath: NotePath,
+                             note_id: NoteID,
+                             cursor
+                             ) -> None:
+        '''Add one to the note count of each node on the notepath.
+        
+        Any nodes missing along the way are created, and the last node is
+        given the note's ID.
+        '''
+        node_id = 0
+        for segment in notepath.split('/'):
+            sql = 'SELECT id FROM outline WHERE parent = ? AND segment = ?;'
+            cursor.execute(sql, (node_id, segment))
+            record = cursor.fetchone()
+            if record:
+                node_id = record[0]
+                sql = ('UPDATE outline SET note_count = note_count + 1'
+                       ' WHERE id = ?;')
+                cursor.execute(sql, (node_id,))
+            else:
+                sql = ('INSERT INTO outline (parent, segment, note_count)'
+                       ' VALUES (?, ?, 1);')
+                cursor.execute(sql, (node_id, segment))
+                node_id = cursor.lastrowid
+        sql = 'UPDATE outline SET note_id = ? WHERE id = ?;'
+        cursor.execute(sql, (note_id, node_id))
+
+    def _rebuild_outline(self, cursor) -> None:
+        '''Rebuild the whole outline table from the notes table.
+        
+        This is for after a bulk load, when adding each path to the outline
+        one at a time would take several queries per note. With '/' turned
+        into char(1) (which sorts before anything found in a notepath), the
+        paths sort so that each subtree is in one run, so only the nodes
+        from the root to the current path have to be kept in memory; each
+        node is written once its subtree has been passed.
+        '''
+        def nodes():
+            stack = [] # [id, parent, segment, note_id, note_count] per level
+            next_id = 1
+            read_cursor = self.connection.cursor()
+            read_cursor.execute("SELECT id, path FROM notes"
+                                " ORDER BY replace(path, '/', char(1));")
+            for note_id, notepath in read_cursor:
+                segments = notepath.split('/')
+                depth = 0
+                while (depth < len(stack) and depth < len(segments)
+                       and stack[depth][2] == segments[depth]):
+                    depth += 1
+                while len(stack) > depth:
+                    yield tuple(stack.pop())
+                for segment in segments[depth:]:
+                    parent = stack[-1][0] if stack else 0
+                    stack.append([next_id, parent, segment, None, 0])
+                    next_id += 1
+                for node in stack:
+                    node[4] += 1
+                stack[-1][3] = note_id
+            while stack:
+                yield tuple(stack.pop())
+            read_cursor.close()
+
+        cursor.execute('DELETE FROM outline;')
+        sql = ('INSERT INTO outline (id, parent, segment, note_id, note_count)'
+               ' VALUES (?, ?, ?, ?, ?);')
+        cursor.executemany(sql, nodes())
+
+    def _remove_path_from_outline(self, notepath: NotePath, cursor) -> None:
+        '''Subtract one from the note count of each node on the notepath.
+        
+        Nodes left with no notes at or beneath them are deleted.
+        '''
+        node_id = self._get_node_id(notepath, cursor)
+        if not node_id:
+            return
+        sql = 'UPDATE outline SET note_id = NULL WHERE id = ?;'
+        cursor.execute(sql, (node_id,))
+        while node_id:
+            sql = 'SELECT parent FROM outline WHERE id = ?;'
+            cursor.execute(sql, (node_id,))
+            parent = cursor.fetchone()[0]
+            sql = ('UPDATE outline SET note_count = note_count - 1'
+                   ' WHERE id = ?;')
+            cursor.execute(sql, (node_id,))
+            sql = 'DELETE FROM outline WHERE id = ? AND note_count <= 0;'
+            cursor.execute(sql, (node_id,))
+            node_id = parent
+
+    def _get_counts(self, sql: str, params: Tuple) -> List[Tuple[str, int]]:
+        cursor = self.connection.cursor()
+        cursor.execute(sql, params)
+        counts = [(row[0], row[1]) for row in cursor]
+        cursor.close()
+        return counts
+
+    def _get_notes(self,
+                   sql: SQLSelectStatement,
+                   notes_table: str = 'notes',
+                   tags_table: str = 'tags',
+                   ordered: bool = False
+                   ) -> Dict[NotePath, Note]:
+        '''Return the notes whose IDs the query selects, keyed by notepath.
+        
+        If ordered is true, the query selects each note's path after its
+        ID, and the notes are returned in the order of the rows.
+        '''
         # If the SQL string is blank, return an empty dict.
         if not sql.strip():
             return {}
@@ -67,10 +415,16 @@ class Database(Object):
         cursor = self.connection.cursor()
 
         # Get a list of the IDs of all the notes to gather.
-        cursor.execute(sql)
-        records = cursor.fetchall()
-        note_ids = [row[0] for row in records]
-        notes = self._get_notes_by_id(note_ids, cursor)
+        with self._phase('query'):
+            cursor.execute(sql)
+            records = cursor.fetchall()
+            note_ids = [row[0] for row in records]
+        with self._phase('hydrate'):
+            notes = self._get_notes_by_id(note_ids, cursor,
+                                          notes_table, tags_table)
+        if ordered:
+            notes = {row[1]: notes[row[1]] for row in records
+                     if row[1] in notes}
         
         # Each method that opens a cursor should close the cursor.
         cursor.close()
@@ -78,13 +432,28 @@ class Database(Object):
 
     def _get_notes_by_id(self,
                          note_ids: List[NoteID],
-                         cursor
+                         cursor,
+                         notes_table: str = 'notes',
+                         tags_table: str = 'tags'
                          ) -> Dict[NotePath, Note]:
+        '''Return the notes with the IDs given, keyed by notepath.
+        
+        Old versions of notes can be pulled from the history tables, which
+        have the same layout, by passing their names.
+        '''
         notes = {}
         idlist = ', '.join(str(i) for i in note_ids)
         
-        # Request note paths and texts.
-        sql = 'SELECT id, path, text FROM notes WHERE id in (' + idlist + ');'
+        # Request note paths, texts, and versions. (Old versions may be
+        # stored as deltas, so their texts must be rebuilt. Their version
+        # numbers are left out: an old version exported and saved again
+        # should replace whatever version is current.)
+        if notes_table == 'history':
+            columns = 'HISTORY_TEXT(id), 0'
+        else:
+            columns = 'text, version'
+        sql = ('SELECT id, path, ' + columns + ' FROM ' + notes_table
+               + ' WHERE id in (' + idlist + ');')
         cursor.execute(sql)
         while True:
             record = cursor.fetchone()
@@ -92,6 +461,7 @@ class Database(Object):
                 break
             
             note_id, path, text = record[0], record[1], record[2]
+            text = _unpack_text(text)
             
             # We should (usually) have exactly one note for each notepath
             # pulled from the database.
@@ -112,14 +482,16 @@ class Database(Object):
             # REPLACE the original record when re-imported (unless the user
             # overrides the directive, of course).
             note.directive = 'replace'
+            note.version = record[3]
 
         # Request note tags and fields.
         # (Use a LEFT OUTER JOIN because the notes table should have ONE row
         # for each note, but the tags table may have zero, one, two, or more
         # rows, and we want ALL of the tag-and-field rows to be returned.)
-        sql = ('SELECT notes.path, tags.name, tags.value'
-               ' FROM notes LEFT OUTER JOIN tags ON notes.id = tags.id'
-               ' WHERE notes.id in (' + idlist + ');')
+        sql = ('SELECT n.path, t.name, t.value'
+               ' FROM ' + notes_table + ' AS n'
+               ' LEFT OUTER JOIN ' + tags_table + ' AS t ON n.id = t.id'
+               ' WHERE n.id in (' + idlist + ');')
         cursor.execute(sql)
         while True:
             row = cursor.fetchone()
@@ -142,28 +514,239 @@ class Database(Object):
 
         return notes
 
+    def _update_text_index(self, cursor) -> None:
+        '''Bring the full-text index (the notes_fts table) up to date.
+        
+        The index is made the first time it is needed, from every note,
+        and after that only the notes changed since it was last brought up
+        to date (according to the changes table) are indexed again, so an
+        index kept up to date costs little. If the change log has been
+        truncated past the last change indexed, or compacted (see
+        compact_changes), the index is rebuilt. (Only databases with ranked
+        queries pay for the index, and the room it takes: about as much as
+        the notes' texts, uncompressed.)
+        '''
+        cursor.execute("SELECT value FROM config WHERE category = 'settings'"
+                       " AND name = 'text_index_seq';")
+        record = cursor.fetchone()
+        indexed = None
+        if record and self._table_exists('notes_fts', cursor):
+            indexed = int(record[0])
+        last = self.get_last_change()
+        if indexed == last:
+            return
+        if self.read_only:
+            raise DatabaseError('the full-text index is out of date, and'
+                                ' this connection cannot update it')
+
+        cursor.execute('BEGIN TRANSACTION;')
+        try:
+            cursor.execute('CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts'
+                           ' USING fts5(path, text, tags);')
+        except sqlite3.OperationalError:
+            cursor.execute('ROLLBACK;')
+            raise DatabaseError('ranked queries need a version of SQLite'
+                                ' with FTS5')
+        # (Notes may have been saved since the last change was read.)
+        last = self.get_last_change()
+
+        # A note's tags and fields are indexed together, as one column.
+        # (Only the words of each column are indexed; see fts_words.)
+        columns = ('n.id, FTS_WORDS(n.path), FTS_WORDS(n.text),'
+                   " FTS_WORDS((SELECT group_concat(t.name"
+                   " || IFNULL(' ' || t.value, ''), ' ')"
+                   ' FROM tags AS t INDEXED BY tag_id_index'
+                   ' WHERE t.id = n.id))')
+        insert = ('INSERT INTO notes_fts (rowid, path, text, tags) SELECT '
+                  + columns + ' FROM notes AS n')
+
+        cursor.execute('SELECT MIN(seq) FROM changes WHERE seq > ?;',
+                       (indexed or 0,))
+        first = cursor.fetchone()[0]
+        if indexed is None or first is None or first > indexed + 1:
+            # (A gap may only mean that the log was compacted, but then
+            # rebuilding the index is merely slower, not wrong.)
+            cursor.execute('DELETE FROM notes_fts;')
+            cursor.execute(insert + ';')
+        else:
+            cursor.execute('SELECT DISTINCT note_id FROM changes'
+                           ' WHERE seq > ? AND note_id IS NOT NULL;',
+                           (indexed,))
+            note_ids = [row[0] for row in cursor.fetchall()]
+            for start in range(0, len(note_ids), 500):
+                idlist = ', '.join(str(note_id) for note_id
+                                   in note_ids[start:start + 500])
+                cursor.execute('DELETE FROM notes_fts'
+                               ' WHERE rowid IN (' + idlist + ');')
+                cursor.execute(insert + ' WHERE n.id IN (' + idlist + ');')
+
+        cursor.execute("DELETE FROM config WHERE category = 'settings'"
+                       " AND name = 'text_index_seq';")
+        cursor.execute("INSERT INTO config (category, name, value)"
+                       " VALUES ('settings', 'text_index_seq', ?);",
+                       (str(last),))
+        cursor.execute('END TRANSACTION;')
+
+    def _archive_notes_by_id(self,
+                             note_ids: List[NoteID],
+                             operation: str,
+                             cursor,
+                             text_unchanged: bool = False
+                             ) -> None:
+        '''Copy the notes given into the history tables.
+        
+        This is done with one INSERT for the notes and one for their tags
+        and fields, using the cursor (and so the transaction) of the change
+        that made the copies necessary.
+
+        If the change leaves the notes' texts alone (text_unchanged), each
+        old version is stored as a delta that copies the whole new text,
+        unless it is one of the versions kept in full.
+        '''
+        if not note_ids:
+            return
+        idlist = ', '.join(str(i) for i in note_ids)
+        cursor.execute('SELECT IFNULL(MAX(id), 0) FROM history;')
+        last_id = cursor.fetchone()[0]
+
+        # Each version is numbered, counting from 1 for each notepath.
+        sql = ('INSERT INTO history (note_id, path, text, valid_from,'
+               ' archived_at, operation, version, delta)'
+               ' SELECT id, path, text, modified_at, ?, ?,'
+               ' IFNULL((SELECT version FROM history WHERE path = notes.path'
+               ' ORDER BY archived_at DESC, id DESC LIMIT 1), 0) + 1, 0'
+               ' FROM notes WHERE id IN (' + idlist + ');')
+        cursor.execute(sql, (round(time.time(), 6), operation))
+
+        sql = ('INSERT INTO history_tags (id, name, value)'
+               ' SELECT history.id, tags.name, tags.value'
+               ' FROM history JOIN tags ON tags.id = history.note_id'
+               ' WHERE history.id > ?;')
+        cursor.execute(sql, (last_id,))
+
+        # The versions just archived are stored in full; the version before
+        # each of them can now be stored as a delta against it.
+        sql = 'SELECT id, path, text, archived_at FROM history WHERE id > ?;'
+        cursor.execute(sql, (last_id,))
+        for history_id, notepath, text, archived_at in cursor.fetchall():
+            self._store_older_version_as_delta(history_id, notepath, text,
+                                               archived_at, cursor)
+
+        if text_unchanged:
+            sql = ("UPDATE history SET delta = 1,"
+                   " text = '[[0, ' || IFNULL(LENGTH(NOTE_TEXT(text)), 0)"
+                   " || ']]'"
+                   " WHERE id > ? AND version % ? != 0;")
+            cursor.execute(sql, (last_id, HISTORY_SNAPSHOT_INTERVAL))
+
+        # The archive file is now optional: write to it only if asked to.
+        if self._archive_path:
+            with self._phase('archive'):
+                archiver = Archiver(self._archive_path)
+                old_notes = self._get_notes_by_id(note_ids, cursor)
+                if old_notes:
+                    archiver.append_notes(old_notes)
+
+    def _store_older_version_as_delta(self,
+                                      history_id: HistoryID,
+                                      notepath: NotePath,
+                                      newer_text: str,
+                                      archived_at: float,
+                                      cursor
+                                      ) -> None:
+        '''Replace the text of the version before history_id with a delta.
+        
+        This is skipped if the older version is already a delta, or if it
+        is one of the versions kept in full (see HISTORY_SNAPSHOT_INTERVAL).
+        '''
+        sql = ('SELECT id, text, version, delta FROM history'
+               ' WHERE path = ? AND (archived_at, id) < (?, ?)'
+               ' ORDER BY archived_at DESC, id DESC LIMIT 1;')
+        cursor.execute(sql, (notepath, archived_at, history_id))
+        record = cursor.fetchone()
+        if not record:
+            return
+        older_id, older_text, version, delta = record
+        if delta or version % HISTORY_SNAPSHOT_INTERVAL == 0:
+            return
+        older_delta = make_delta(_unpack_text(newer_text) or '',
+                                 _unpack_text(older_text) or '')
+        sql = 'UPDATE history SET text = ?, delta = 1 WHERE id = ?;'
+        cursor.execute(sql, (older_delta, older_id))
+
+    def _get_history_text(self, history_id: HistoryID) -> str:
+        '''Return the full text of an old version of a note.
+        
+        A version stored as a delta is rebuilt from the next newer version
+        (or, for the newest version, from the note in the database), which
+        may itself have to be rebuilt, and so on, up to the nearest version
+        stored in full.
+        '''
+        cursor = self.connection.cursor()
+        sql = ('SELECT path, text, archived_at, delta FROM history'
+               ' WHERE id = ?;')
+        cursor.execute(sql, (history_id,))
+        record = cursor.fetchone()
+        if not record:
+            cursor.close()
+            return None
+        notepath, text, archived_at, delta = record
+
+        deltas = []
+        sql = ('SELECT id, text, archived_at, delta FROM history'
+               ' WHERE path = ? AND (archived_at, id) > (?, ?)'
+               ' ORDER BY archived_at, id LIMIT 1;')
+        while delta:
+            deltas.append(text)
+            cursor.execute(sql, (notepath, archived_at, history_id))
+            record = cursor.fetchone()
+            if record:
+                history_id, text, archived_at, delta = record
+            else:
+                cursor.execute('SELECT text FROM notes WHERE path = ?;',
+                               (notepath,))
+                record = cursor.fetchone()
+                if not record:
+                    cursor.close()
+                    t = 'cannot rebuild old version of note: ' + notepath
+                    raise DatabaseError(t)
+                text, delta = record[0], 0
+        cursor.close()
+
+        text = _unpack_text(text)
+        for older_delta in reversed(deltas):
+            text = apply_delta(text or '', older_delta)
+        return text
+
     def _archive_and_delete_notes(self,
                                   notepaths: Union[NotePath, List[NotePath]],
-                                  cursor
+                                  cursor,
+                                  operation: str = 'delete'
                                   ) -> None:
         if isinstance(notepaths, NotePath):
             notepaths = [notepaths]
 
         # Archive the notes before deleting them from the database.
         note_ids = self._get_note_ids(notepaths, cursor)
-        archiver = Archiver(self._archive_path)
-        old_notes = self._get_notes_by_id(note_ids, cursor)
-        if old_notes:
-            archiver.append_notes(old_notes)
-
-        self._delete_notes_by_path(notepaths, cursor)
+        self._archive_notes_by_id(note_ids, operation, cursor)
+        self._delete_notes_by_id(note_ids, cursor)
 
     def _delete_notes_by_path(self,
                       notepaths: Union[NotePath, List[NotePath]],
                       cursor
                       ) -> None:
         note_ids = self._get_note_ids(notepaths, cursor)
+        self._delete_notes_by_id(note_ids, cursor)
+
+    def _delete_notes_by_id(self, note_ids: List[NoteID], cursor) -> None:
         idlist = ', '.join(str(i) for i in note_ids)
+
+        # Remove the notes from the outline before their paths are gone.
+        sql = 'SELECT path FROM notes WHERE id IN (' + idlist + ');'
+        cursor.execute(sql)
+        for notepath in [row[0] for row in cursor.fetchall()]:
+            self._remove_path_from_outline(notepath, cursor)
+
         sql = 'DELETE FROM notes WHERE id IN (' + idlist + ');'
         cursor.execute(sql)
         sql = 'DELETE FROM tags WHERE id IN (' + idlist + ');'
@@ -203,28 +786,177 @@ class Database(Object):
             sql = 'INSERT INTO tags (id, name, value) VALUES (?, ?, ?);'
             cursor.execute(sql, (note_id, name, value))
 
-    def _insert_note(self, note: Note, cursor) -> None:
-        sql = 'INSERT INTO notes (path, text) VALUES (?, ?);'
-        cursor.execute(sql, (note.path, note.get_text()))
+    def _get_created_at_and_version(self,
+                                    notepath: NotePath,
+                                    cursor
+                                    ) -> Tuple[Union[float, None], int]:
+        '''Return when the note with the path given was first saved, and its
+        version (or None and 0, if there is no such note).'''
+        sql = 'SELECT created_at, version FROM notes WHERE path = ?;'
+        cursor.execute(sql, (notepath,))
+        record = cursor.fetchone()
+        return tuple(record) if record else (None, 0)
+
+    def _insert_note(self,
+                     note: Note,
+                     cursor,
+                     created_at: float = None,
+                     old_version: int = 0
+                     ) -> None:
+        '''Insert the note given.
+        
+        A note replacing another (or merged with it) keeps the time the
+        other note was created (created_at), and its version number goes on
+        from the other note's (old_version); otherwise it is created now, as
+        version 1.
+        '''
+        now = round(time.time(), 6)
+        if created_at is None:
+            created_at = now
+        sql = ('INSERT INTO notes (path, text, modified_at, created_at,'
+               ' version) VALUES (?, ?, ?, ?, ?);')
+        text = _pack_text(note.get_text(), self.compress_over)
+        cursor.execute(sql, (note.path, text, now, created_at,
+                             old_version + 1))
         note_id = cursor.lastrowid
         self._insert_tags(note_id, note, cursor)
+        self._add_path_to_outline(note.path, note_id, cursor)
 
     def _replace_note(self, note: Note, cursor) -> None:
         '''Archive existing note, then replace it with the note passed.
         
         (If there is no existing note, the new note is simply inserted.)
         '''
-        self._archive_and_delete_notes(note.path, cursor)
-        self._insert_note(note, cursor)
+        created_at, version = self._get_created_at_and_version(note.path,
+                                                               cursor)
+        self._archive_and_delete_notes(note.path, cursor, 'replace')
+        self._insert_note(note, cursor, created_at, version)
+
+    def _append_to_note(self, note: Note, cursor) -> bool:
+        '''Merge the note into the note in the database in place, if possible.
+        
+        Merging only ever adds to a note, so rather than loading, archiving,
+        deleting, and reinserting the whole note (which, for a note that
+        grows a line at a time, costs more with every line), the new text
+        is appended in SQL, only the new tags and fields are inserted, and
+        the old version is archived as a delta: the first so many
+        characters of the new version, along with the old tags and fields.
+        
+        Return False if the note must be merged the long way: if there is
+        no note to merge into, if this version is one of those archived in
+        full (see HISTORY_SNAPSHOT_INTERVAL), or if an archive file is
+        being kept.
+        '''
+        if self._archive_path:
+            return False
+        sql = ("SELECT id, LENGTH(text), typeof(text) = 'blob', modified_at"
+               ' FROM notes WHERE path = ?;')
+        cursor.execute(sql, (note.path,))
+        record = cursor.fetchone()
+        if not record:
+            return False
+        note_id, old_length, packed, modified_at = record
+        old_length = old_length or 0
+
+        sql = ('SELECT version FROM history WHERE path = ?'
+               ' ORDER BY archived_at DESC, id DESC LIMIT 1;')
+        cursor.execute(sql, (note.path,))
+        record = cursor.fetchone()
+        version = (record[0] if record else 0) + 1
+        if version % HISTORY_SNAPSHOT_INTERVAL == 0:
+            return False
 
-    def _insert_or_merge_note(self, note: Note, cursor) -> None:
+        # Find what the note adds (see Note.merge()). Identical texts are not
+        # merged, and an empty text adds nothing.
+        text = note.get_text()
+        old_text = None
+        if packed:
+            # A compressed text can't be compared or added to in SQL, so it
+            # is unpacked here (and its LENGTH() above was in bytes).
+            cursor.execute('SELECT text FROM notes WHERE id = ?;', (note_id,))
+            old_text = _unpack_text(cursor.fetchone()[0])
+            old_length = len(old_text)
+            if text == old_text:
+                text = ''
+        elif text:
+            sql = 'SELECT text IS ? FROM notes WHERE id = ?;'
+            cursor.execute(sql, (text, note_id))
+            if cursor.fetchone()[0]:
+                text = ''
+        # (A note has only a few tags and fields, so these look them up by
+        # the note's ID. Left to itself, SQLite may use value_index instead,
+        # which for a tag means reading every tag of every note.)
+        tags = []
+        sql = ('SELECT 1 FROM tags INDEXED BY tag_id_index'
+               ' WHERE id = ? AND name = ? AND value IS NULL;')
+        for tag in note.tags:
+            cursor.execute(sql, (note_id, tag))
+            if not cursor.fetchone() and tag not in tags:
+                tags.append(tag)
+        fields = []
+        sql = ('SELECT 1 FROM tags INDEXED BY tag_id_index'
+               ' WHERE id = ? AND name = ? AND value = ?;')
+        for name, value in note.fields:
+            cursor.execute(sql, (note_id, name, value))
+            if not cursor.fetchone() and (name, value) not in fields:
+                fields.append((name, value))
+        if not (text or tags or fields):
+            return True
+
+        # Archive the old version, then add to the note.
+        now = round(time.time(), 6)
+        sql = ('INSERT INTO history (note_id, path, text, valid_from,'
+               ' archived_at, operation, version, delta)'
+               " VALUES (?, ?, ?, ?, ?, 'merge', ?, 1);")
+        cursor.execute(sql, (note_id, note.path, make_prefix_delta(old_length),
+                             modified_at, now, version))
+        sql = ('INSERT INTO history_tags (id, name, value)'
+               ' SELECT ?, name, value FROM tags WHERE id = ?;')
+        cursor.execute(sql, (cursor.lastrowid, note_id))
+
+        if text and (packed or (self.compress_over and old_length + 1
+                                + len(text) > self.compress_over)):
+            # The merged text is (or is now long enough to be) compressed.
+            if old_text is None:
+                cursor.execute('SELECT text FROM notes WHERE id = ?;',
+                               (note_id,))
+                old_text = cursor.fetchone()[0] or ''
+            set_text = 'text = ?, '
+            params = [_pack_text(old_text + '\n' + text, self.compress_over)]
+        elif text:
+            set_text = 'text = text || char(10) || ?, '
+            params = [text]
+        else:
+            set_text = ''
+            params = []
+        sql = 'INSERT INTO tags (id, name, value) VALUES (?, ?, ?);'
+        cursor.executemany(sql, [(note_id, tag, None) for tag in tags]
+                           + [(note_id, n, v) for n, v in fields])
+
+        # The text and the version are changed in one statement, so that
+        # the merge is logged (see the changes table) as one change.
+        sql = ('UPDATE notes SET ' + set_text + 'modified_at = ?,'
+               ' version = version + 1 WHERE id = ?;')
+        cursor.execute(sql, params + [now, note_id])
+        return True
+
+    def _insert_or_merge_note(self,
+                              note: Note,
+                              cursor,
+                              created_at: float = None,
+                              old_version: int = 0
+                              ) -> None:
+        if self._append_to_note(note, cursor):
+            return
         old_notes = self.get_notes_by_path(note.path)
         if old_notes:
             old_note = old_notes[note.path]
             old_note.merge(note)
             note = old_note
-            self._archive_and_delete_notes(note.path, cursor)
-        self._insert_note(note, cursor)
+            created_at, old_version = self._get_created_at_and_version(
+                note.path, cursor)
+            self._archive_and_delete_notes(note.path, cursor, 'merge')
+        self._insert_note(note, cursor, created_at, old_version)
 
     def _save_note(self, note: Note, cursor) -> None:
         directive = note.directive
@@ -248,22 +980,88 @@ class Database(Object):
             old_notes = self.get_notes_by_path(note.path)
             if old_notes:
                 t = 'Cannot add note; path is in use: ' + note.path
-                self.connection.commit()
                 raise DatabaseError(t)
             else:
                 self._insert_note(note, cursor)
         else:
             words = directive.split(maxsplit=1)
             if len(words) > 1 and words[0] in ['rename', 'newpath']:
-                self._archive_and_delete_notes(note.path, cursor)
+                created_at, version = self._get_created_at_and_version(
+                    note.path, cursor)
+                self._archive_and_delete_notes(note.path, cursor, 'rename')
                 new_path = words[1].strip()
                 note.path = new_path
-                self._insert_or_merge_note(note, cursor)
+                self._insert_or_merge_note(note, cursor, created_at, version)
             else:
                 self._error('Unrecognized directive:', directive)
                 self._error('--- adding or replacing note:', note.path)
                 self._replace_note(note, cursor)
     
+    def _move_notes(self,
+                    old_prefix: NotePath,
+                    new_prefix: NotePath,
+                    cursor
+                    ) -> int:
+        '''Change old_prefix to new_prefix in each notepath beginning with it.
+        
+        A note whose new path is already taken (by a note not itself being
+        moved) is merged into the note there. The other notes are moved with
+        two UPDATEs: the first sets each path aside (prefixing it with a
+        character never found in a notepath), so that no new path can
+        collide with an old path not yet changed, and the second writes the
+        new paths. Return the number of notes moved.
+        '''
+        low, high = old_prefix + '/', old_prefix + chr(ord('/') + 1)
+        sql = ('SELECT id, path FROM notes'
+               ' WHERE path = ? OR (path >= ? AND path < ?);')
+        cursor.execute(sql, (old_prefix, low, high))
+        old_paths = dict(cursor.fetchall())
+        if not old_paths:
+            return 0
+        new_paths = {note_id: new_prefix + path[len(old_prefix):]
+                     for note_id, path in old_paths.items()}
+
+        # Archive every note being moved, in one batch.
+        self._archive_notes_by_id(list(old_paths.keys()), 'move', cursor)
+
+        # Find the new paths already taken by notes staying where they are.
+        moving = set(old_paths.values())
+        targets = [path for path in new_paths.values() if path not in moving]
+        collisions = set()
+        for i in range(0, len(targets), 500):
+            batch = targets[i:i + 500]
+            sql = ('SELECT path FROM notes WHERE path IN ('
+                   + ', '.join('?' * len(batch)) + ');')
+            cursor.execute(sql, batch)
+            collisions.update(row[0] for row in cursor.fetchall())
+
+        merging = [note_id for note_id in old_paths
+                   if new_paths[note_id] in collisions]
+        if merging:
+            notes = self._get_notes_by_id(merging, cursor)
+            self._delete_notes_by_id(merging, cursor)
+            ids = {path: note_id for note_id, path in old_paths.items()}
+            for note in notes.values():
+                note.path = new_paths[ids[note.path]]
+                self._insert_or_merge_note(note, cursor)
+
+        moved = [note_id for note_id in old_paths if note_id not in merging]
+        if moved:
+            for note_id in moved:
+                self._remove_path_from_outline(old_paths[note_id], cursor)
+            idlist = ', '.join(str(note_id) for note_id in moved)
+            sql = ('UPDATE notes SET path = char(1) || path'
+                   ' WHERE id IN (' + idlist + ');')
+            cursor.execute(sql)
+            sql = ('UPDATE notes SET path = ? || substr(path, ?),'
+                   ' modified_at = ?, version = version + 1'
+                   ' WHERE id IN (' + idlist + ');')
+            cursor.execute(sql, (new_prefix, len(old_prefix) + 2,
+                                 round(time.time(), 6)))
+            for note_id in moved:
+                self._add_path_to_outline(new_paths[note_id], note_id, cursor)
+        return len(old_paths)
+
     def print_sqlite_info(self):
         cursor = self.connection.cursor()
 
@@ -306,6 +1104,162 @@ class Database(Object):
              ' name TEXT,'
              ' value TEXT);')
         cursor.execute(t)
+
+        # The tag_counts table holds one row for each distinct tag (with a
+        # NULL value) and each distinct field name/value pair, along with the
+        # number of notes using it, so that --list-tags and friends do not
+        # have to scan the whole tags table. The triggers below keep the
+        # counts current no matter which code path adds or removes tag rows.
+        # (Each note stores a given tag or name/value pair only once, so one
+        # tags row is one note.)
+        if not self._table_exists('tag_counts', cursor):
+            t = ('CREATE TABLE tag_counts (name TEXT,'
+                 ' value REAL,'
+                 ' note_count INTEGER NOT NULL);')
+            cursor.execute(t)
+            t = ('INSERT INTO tag_counts (name, value, note_count)'
+                 ' SELECT name, value, COUNT(*) FROM tags'
+                 ' GROUP BY name, value;')
+            cursor.execute(t)
+
+        t = ('CREATE TRIGGER IF NOT EXISTS tag_counts_insert'
+             ' AFTER INSERT ON tags BEGIN'
+             ' INSERT INTO tag_counts (name, value, note_count)'
+             ' SELECT NEW.name, NEW.value, 0 WHERE NOT EXISTS'
+             ' (SELECT 1 FROM tag_counts'
+             ' WHERE name = NEW.name AND value IS NEW.value);'
+             ' UPDATE tag_counts SET note_count = note_count + 1'
+             ' WHERE name = NEW.name AND value IS NEW.value;'
+             ' END;')
+        cursor.execute(t)
+
+        t = ('CREATE TRIGGER IF NOT EXISTS tag_counts_delete'
+             ' AFTER DELETE ON tags BEGIN'
+             ' UPDATE tag_counts SET note_count = note_count - 1'
+             ' WHERE name = OLD.name AND value IS OLD.value;'
+             ' DELETE FROM tag_counts'
+             ' WHERE name = OLD.name AND value IS OLD.value'
+             ' AND note_count <= 0;'
+             ' END;')
+        cursor.execute(t)
+        
+        # The history table holds old versions of notes, as they were just
+        # before each change, and history_tags holds their tags and fields.
+        # These have the same layout as the notes and tags tables, except
+        # that the notes' IDs are kept in history.note_id, while history.id
+        # identifies the version. Each version records when it was archived
+        # (in seconds since the epoch) and the operation that archived it.
+        t = ('CREATE TABLE IF NOT EXISTS history (id INTEGER PRIMARY KEY,'
+             ' note_id INTEGER,'
+             ' path TEXT NOT NULL,'
+             ' text TEXT,'
+             ' archived_at REAL NOT NULL,'
+             ' operation TEXT NOT NULL);')
+        cursor.execute(t)
+
+        # Each version's number (counting from 1 for each notepath), and
+        # whether its text is stored in full (0) or as a delta (1).
+        if self._add_column('history', 'version INTEGER', cursor):
+            t = ('UPDATE history SET version = (SELECT COUNT(*)'
+                 ' FROM history AS h WHERE h.path = history.path'
+                 ' AND h.id <= history.id);')
+            cursor.execute(t)
+        self._add_column('history', 'delta INTEGER NOT NULL DEFAULT 0', cursor)
+
+        # When each note (and so each old version) was last written. A
+        # version was the current one from valid_from until archived_at.
+        # (These are NULL for notes written before they were recorded.)
+        self._add_column('notes', 'modified_at REAL', cursor)
+        self._add_column('history', 'valid_from REAL', cursor)
+
+        # When each note was first saved. Replacing, merging, or renaming a
+        # note keeps this time. For notes saved before it was recorded, the
+        # best guess is when the oldest version in the history was written.
+        if self._add_column('notes', 'created_at REAL', cursor):
+            t = ('UPDATE notes SET created_at = IFNULL((SELECT'
+                 ' MIN(IFNULL(valid_from, archived_at)) FROM history'
+                 ' WHERE history.path = notes.path), modified_at);')
+            cursor.execute(t)
+
+        # Each note's version, counting from 1 and going up by one each time
+        # the note is changed. Notes exported by a query carry their version
+        # (in the directive), so that an edit made to an out-of-date copy can
+        # be caught when it is saved.
+        self._add_column('notes', 'version INTEGER NOT NULL DEFAULT 1', cursor)
+
+        # The changes table is a log of every note written or deleted, in
+        # order (seq never goes down, even after the log is truncated), so
+        # that a copy of the notes kept elsewhere can be brought up to date
+        # by fetching only what changed since the last seq it saw. Like
+        # tag_counts, it is kept by triggers, so every code path that writes
+        # notes is logged. When the log is first made, every note already in
+        # the database is logged, so that changes since 0 are everything.
+        if not self._table_exists('changes', cursor):
+            t = ('CREATE TABLE changes (seq INTEGER PRIMARY KEY AUTOINCREMENT,'
+                 ' note_id INTEGER,'
+                 ' path TEXT NOT NULL,'
+                 ' operation TEXT NOT NULL,'
+                 ' changed_at REAL NOT NULL);')
+            cursor.execute(t)
+            t = ("INSERT INTO changes (note_id, path, operation, changed_at)"
+                 " SELECT id, path, 'insert', IFNULL(modified_at, ?)"
+                 " FROM notes ORDER BY id;")
+            cursor.execute(t, (round(time.time(), 6),))
+
+        # A note moved by _move_notes() is briefly given a path beginning
+        # with char(1); that step is not logged. (The times are in seconds
+        # since the epoch, as elsewhere.)
+        now = "round(julianday('now') * 86400 - 210866760000, 6)"
+        t = ('CREATE TRIGGER IF NOT EXISTS changes_insert'
+             ' AFTER INSERT ON notes BEGIN'
+             ' INSERT INTO changes (note_id, path, operation, changed_at)'
+             " VALUES (NEW.id, NEW.path, 'insert', " + now + ');'
+             ' END;')
+        cursor.execute(t)
+
+        t = ('CREATE TRIGGER IF NOT EXISTS changes_update'
+             ' AFTER UPDATE ON notes BEGIN'
+             ' INSERT INTO changes (note_id, path, operation, changed_at)'
+             " SELECT OLD.id, OLD.path, 'delete', " + now +
+             ' WHERE OLD.path != NEW.path AND substr(OLD.path, 1, 1)'
+             ' != char(1);'
+             ' INSERT INTO changes (note_id, path, operation, changed_at)'
+             " SELECT NEW.id, NEW.path, 'update', " + now +
+             ' WHERE substr(NEW.path, 1, 1) != char(1);'
+             ' END;')
+        cursor.execute(t)
+
+        t = ('CREATE TRIGGER IF NOT EXISTS changes_delete'
+             ' AFTER DELETE ON notes BEGIN'
+             ' INSERT INTO changes (note_id, path, operation, changed_at)'
+             " VALUES (OLD.id, OLD.path, 'delete', " + now + ');'
+             ' END;')
+        cursor.execute(t)
+
+        t = ('CREATE TABLE IF NOT EXISTS history_tags (id INTEGER,'
+             ' name TEXT,'
+             ' value REAL);')
+        cursor.execute(t)
+
+        # The outline table mirrors the hierarchy of notepaths: one row per
+        # segment of a notepath, pointing to the row for its parent segment
+        # (or to 0 for a top-level segment). Each row counts the notes at or
+        # beneath it, and note_id is set if a note has exactly that path.
+        # This lets outlines, child listings, and subtree counts be answered
+        # from the part of the outline concerned, not from every notepath.
+        if not self._table_exists('outline', cursor):
+            t = ('CREATE TABLE outline (id INTEGER PRIMARY KEY,'
+                 ' parent INTEGER NOT NULL,'
+                 ' segment TEXT NOT NULL,'
+                 ' note_id INTEGER,'
+                 ' note_count INTEGER NOT NULL);')
+            cursor.execute(t)
+            t = ('CREATE UNIQUE INDEX IF NOT EXISTS'
+                 ' outline_index ON outline (parent, segment);')
+            cursor.execute(t)
+            cursor.execute('SELECT id, path FROM notes;')
+            for note_id, notepath in cursor.fetchall():
+                self._add_path_to_outline(notepath, note_id, cursor)
         
         cursor.execute('END TRANSACTION;')
         
@@ -317,12 +1271,606 @@ class Database(Object):
         cursor.execute('BEGIN TRANSACTION;')
 
         self._create_index(cursor, 'path_index ON notes (path)')
+        self._create_index(cursor, 'tag_id_index ON tags (id)')
         self._create_index(cursor, 'name_index ON tags (name)')
         self._create_index(cursor, 'value_index ON tags (value)')
         self._create_index(cursor, 'config_index ON config (category, name)')
+        self._create_index(cursor,
+                           'tag_counts_index ON tag_counts (name, value)')
+        self._create_index(cursor,
+                           'history_index ON history (path, archived_at)')
+        self._create_index(cursor, 'history_tags_index ON history_tags (id)')
+        self._create_index(cursor, 'history_tag_name_index'
+                           ' ON history_tags (name)')
+        self._create_index(cursor, 'history_tag_value_index'
+                           ' ON history_tags (value)')
+        self._create_index(cursor, 'history_valid_index'
+                           ' ON history (archived_at, valid_from)')
+        self._create_index(cursor, 'modified_index ON notes (modified_at)')
+        self._create_index(cursor, 'created_index ON notes (created_at)')
+        
+        cursor.execute('END TRANSACTION;')
+        cursor.close()
+
+    def get_tag_counts(self, prefix: str = '') -> List[Tuple[str, int]]:
+        '''Return (tag, note count) for each tag beginning with prefix.'''
+        sql = ('SELECT name, note_count FROM tag_counts'
+               ' WHERE value IS NULL AND name >= ? AND name < ?'
+               ' ORDER BY name COLLATE NOCASE;')
+        return self._get_counts(sql, (prefix, prefix + _PREFIX_END))
+
+    def get_field_counts(self, prefix: str = '') -> List[Tuple[str, int]]:
+        '''Return (field name, times used) for each name beginning with prefix.
+        
+        A note may assign several values to the same field name, so the count
+        is the number of name/value pairs, which may exceed the number of
+        notes.
+        '''
+        sql = ('SELECT name, SUM(note_count) FROM tag_counts'
+               ' WHERE value IS NOT NULL AND name >= ? AND name < ?'
+               ' GROUP BY name ORDER BY name COLLATE NOCASE;')
+        return self._get_counts(sql, (prefix, prefix + _PREFIX_END))
+
+    def get_value_counts(self,
+                         field_name: str,
+                         prefix: str = ''
+                         ) -> List[Tuple[Union[str, float], int]]:
+        '''Return (value, note count) for each value of the field given.
+        
+        SQLite sorts numbers before text, so numeric values come first. If a
+        prefix is given, only text values beginning with it are returned.
+        '''
+        sql = ('SELECT value, note_count FROM tag_counts'
+               ' WHERE name = ? AND value IS NOT NULL')
+        params = (field_name,)
+        if prefix:
+            sql += ' AND value >= ? AND value < ?'
+            params += (prefix, prefix + _PREFIX_END)
+        sql += ' ORDER BY value COLLATE NOCASE;'
+        return self._get_counts(sql, params)
+
+    def print_counts(self, counts: List[Tuple[Union[str, float], int]]) -> None:
+        '''Print each item and its count, separated by a tab.
+        
+        (The item comes first, so that "cut -f1" yields a list suitable for
+        shell completion.)
+        '''
+        for item, count in counts:
+            if isinstance(item, float) and item.is_integer():
+                item = int(item)
+            print(str(item) + '\t' + '{:,}'.format(count))
+
+    def get_outline(self, notepath: NotePath = '') -> List[Tuple[int, str]]:
+        '''Return (depth, segment) for each node at or beneath the notepath.
+        
+        The nodes are in the order of sort_notepaths(). If a notepath is
+        given, it is the first item (at depth 0) and its descendants follow.
+        '''
+        cursor = self.connection.cursor()
+        node_id = self._get_node_id(notepath, cursor)
+        if node_id is None:
+            cursor.close()
+            return []
+        if node_id:
+            start = 'SELECT id, 0, ? FROM outline WHERE id = ?'
+            params = (notepath, node_id)
+        else:
+            start = 'SELECT id, 0, segment FROM outline WHERE parent = ?'
+            params = (node_id,)
+        sql = ('WITH RECURSIVE subtree (id, depth, path) AS (' + start +
+               ' UNION ALL SELECT outline.id, subtree.depth + 1,'
+               " subtree.path || '/' || outline.segment"
+               ' FROM outline JOIN subtree ON outline.parent = subtree.id)'
+               ' SELECT depth, path FROM subtree;')
+        cursor.execute(sql, params)
+        depths = {path: depth for depth, path in cursor}
+        cursor.close()
+
+        outline = []
+        for path in sort_notepaths(list(depths.keys())):
+            depth = depths[path]
+            segment = path if depth == 0 else path.rsplit('/', 1)[1]
+            outline.append((depth, segment))
+        return outline
+
+    def print_outline(self, notepath: NotePath = '') -> None:
+        '''Print each path segment on its own line, indented by level.
+        
+        Each level is marked by a dot, except that every fifth level is
+        marked by a vertical bar, to make deep levels easier to count.
+        '''
+        for depth, segment in self.get_outline(notepath):
+            marks = ['| ' if i % 5 == 4 else '. ' for i in range(depth)]
+            print(''.join(marks) + segment)
+
+    def get_children(self, notepath: NotePath = '') -> List[Tuple[str, int]]:
+        '''Return (path, note count) for each child of the notepath.
+        
+        The count is the number of notes at or beneath the child.
+        '''
+        cursor = self.connection.cursor()
+        node_id = self._get_node_id(notepath, cursor)
+        children = []
+        if node_id is not None:
+            sql = 'SELECT segment, note_count FROM outline WHERE parent = ?;'
+            cursor.execute(sql, (node_id,))
+            prefix = notepath + '/' if notepath else ''
+            counts = {prefix + segment: count for segment, count in cursor}
+            for path in sort_notepaths(list(counts.keys())):
+                children.append((path, counts[path]))
+        cursor.close()
+        return children
+
+    def count_notes_under(self, notepath: NotePath = '') -> int:
+        '''Return the number of notes beneath (not at) the notepath.'''
+        cursor = self.connection.cursor()
+        node_id = self._get_node_id(notepath, cursor)
+        if node_id is None:
+            count = 0
+        elif node_id == 0:
+            sql = 'SELECT TOTAL(note_count) FROM outline WHERE parent = 0;'
+            cursor.execute(sql)
+            count = int(cursor.fetchone()[0])
+        else:
+            sql = ('SELECT note_count - (note_id IS NOT NULL)'
+                   ' FROM outline WHERE id = ?;')
+            cursor.execute(sql, (node_id,))
+            count = cursor.fetchone()[0]
+        cursor.close()
+        return count
+
+    def get_history(self, notepath: NotePath) -> List[Tuple[float, str, int]]:
+        '''Return (time archived, operation, version) for each old version.
+        
+        The versions of the note are listed from oldest to newest.
+        '''
+        sql = ('SELECT archived_at, operation, version FROM history'
+               ' WHERE path = ? ORDER BY archived_at, id;')
+        cursor = self.connection.cursor()
+        cursor.execute(sql, (notepath,))
+        versions = [(row[0], row[1], row[2]) for row in cursor]
+        cursor.close()
+        return versions
+
+    def print_history(self, notepath: NotePath) -> None:
+        '''Print when each old version was archived, and why.'''
+        for archived_at, operation, version in self.get_history(notepath):
+            print(timestamp_for_logging(archived_at) + '\t' + operation
+                  + '\t' + 'version ' + str(version))
+
+    def get_version(self,
+                    notepath: NotePath,
+                    when: float = None
+                    ) -> Union[Note, None]:
+        '''Return the version of the note archived at (or last before) when.
+        
+        If no time is given, the most recently archived version is returned.
+        '''
+        if when is None:
+            when = time.time()
+
+        # (Times are stored to the microsecond; allow for rounding.)
+        sql = ('SELECT id FROM history WHERE path = ? AND archived_at <= ?'
+               ' ORDER BY archived_at DESC, id DESC LIMIT 1;')
+        cursor = self.connection.cursor()
+        cursor.execute(sql, (notepath, when + 0.000001))
+        record = cursor.fetchone()
+        note = None
+        if record:
+            notes = self._get_notes_by_id([record[0]], cursor,
+                                          'history', 'history_tags')
+            note = notes[notepath]
+        cursor.close()
+        return note
+
+    def restore_note(self, notepath: NotePath, when: float = None) -> bool:
+        '''Replace the note with an old version; return False if none found.
+        
+        (The note being replaced is archived first, so a restore can itself
+        be undone.)
+        '''
+        note = self.get_version(notepath, when)
+        if not note:
+            return False
+        cursor = self.connection.cursor()
+        cursor.execute('BEGIN TRANSACTION;')
+        created_at, version = self._get_created_at_and_version(notepath,
+                                                               cursor)
+        self._archive_and_delete_notes(notepath, cursor, 'restore')
+        self._insert_note(note, cursor, created_at, version)
+        cursor.execute('END TRANSACTION;')
+        cursor.close()
+        return True
+
+    def export_history(self, file_path: FilePath,
+                       notepath: NotePath = None) -> None:
+        '''Append old versions of notes to a file in archive format.
         
+        All old versions are exported, oldest first, unless a notepath is
+        given, in which case only that note's old versions are exported.
+        '''
+        sql = 'SELECT id, archived_at FROM history'
+        params = ()
+        if notepath is not None:
+            sql += ' WHERE path = ?'
+            params = (notepath,)
+        sql += ' ORDER BY archived_at, id;'
+        cursor = self.connection.cursor()
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+
+        def versions():
+            for history_id, archived_at in rows:
+                notes = self._get_notes_by_id([history_id], cursor,
+                                              'history', 'history_tags')
+                for note in notes.values():
+                    yield archived_at, note
+
+        Archiver(file_path).append_versions(versions())
+        cursor.close()
+
+    def get_last_change(self) -> ChangeSeq:
+        '''Return the seq of the latest change logged (or 0 if none).'''
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT seq FROM sqlite_sequence"
+                       " WHERE name = 'changes';")
+        record = cursor.fetchone()
+        cursor.close()
+        return record[0] if record else 0
+
+    def get_changes_since(self,
+                          seq: ChangeSeq
+                          ) -> Iterator[Tuple[ChangeSeq, NotePath,
+                                              Union[Note, None]]]:
+        '''Yield (seq, path, note) for each notepath changed after seq.
+        
+        Each notepath is yielded once, in the order of its latest change,
+        with the note as it is now, or with None if there is no longer a
+        note with that path. Only the part of the log after seq is read, and
+        the notes are fetched in batches, so this takes time in proportion
+        to the number of changes, not to the number of notes.
+        '''
+        sql = ('SELECT path, MAX(seq) AS last FROM changes WHERE seq > ?'
+               ' GROUP BY path ORDER BY last;')
+        cursor = self.connection.cursor()
+        cursor.execute(sql, (seq,))
+        while True:
+            rows = cursor.fetchmany(500)
+            if not rows:
+                break
+            notes = self.get_notes_by_path([row[0] for row in rows])
+            for notepath, last in rows:
+                yield last, notepath, notes.get(notepath)
+        cursor.close()
+
+    def truncate_changes(self, seq: ChangeSeq) -> int:
+        '''Remove changes up to and including seq; return how many.'''
+        cursor = self.connection.cursor()
+        cursor.execute('BEGIN TRANSACTION;')
+        cursor.execute('DELETE FROM changes WHERE seq <= ?;', (seq,))
+        count = cursor.rowcount
+        cursor.execute('END TRANSACTION;')
+        cursor.close()
+        return count
+
+    def compact_changes(self) -> int:
+        '''Keep only the latest change to each notepath; return how many go.
+        
+        get_changes_since() gives the same results afterward, for any seq.
+        '''
+        cursor = self.connection.cursor()
+        cursor.execute('BEGIN TRANSACTION;')
+        cursor.execute('DELETE FROM changes WHERE seq NOT IN'
+                       ' (SELECT MAX(seq) FROM changes GROUP BY path);')
+        count = cursor.rowcount
+        if count:
+            # The full-text index follows notes by ID, and a note deleted
+            # from a path used again since has just lost its last change;
+            # so the index is rebuilt the next time it is used.
+            cursor.execute("DELETE FROM config WHERE category = 'settings'"
+                           " AND name = 'text_index_seq';")
+        cursor.execute('END TRANSACTION;')
+        cursor.close()
+        return count
+
+    def dump(self, filepath: FilePath) -> int:
+        '''Write every note to a file; return the number of notes written.
+        
+        The notes are written in notepath format, in the order given by
+        sort_notepaths() (sorted by SQLite, using the same key), straight
+        from one query, so that only one note at a time is in memory. Each
+        note's version is in its directive, and the times it was created
+        and last modified are given as fields (DUMP_CREATED_FIELD and
+        DUMP_MODIFIED_FIELD), as is a text that notepath format cannot show
+        exactly (DUMP_TEXT_FIELD). The file is compressed with gzip if its name
+        ends with ".gz"; a filepath of "-" means standard output. Old
+        versions of notes (in the history) are not written, nor is a note
+        with a blank path (which notepath format has no way to show).
+        '''
+        sql = ('SELECT path, text, version, created_at, modified_at,'
+               ' (SELECT json_group_array(json_array(name, value))'
+               ' FROM tags WHERE tags.id = notes.id)'
+               " FROM notes WHERE path != ''"
+               ' ORDER BY NOTEPATH_KEY(path), path;')
+        if filepath == '-':
+            file = sys.stdout
+        elif filepath.endswith('.gz'):
+            file = gzip.open(filepath, mode='wt', encoding='utf-8')
+        else:
+            file = open(filepath, mode='w', encoding='utf-8',
+                        buffering=1024 * 1024)
+        cursor = self.connection.cursor()
+        cursor.execute(sql)
+        count = 0
+        for notepath, text, version, created_at, modified_at, tags in cursor:
+            note = Note()
+            note.path = notepath
+            note.directive = 'replace'
+            note.version = version
+            for name, value in json.loads(tags):
+                if value is None:
+                    note.tags.append(name)
+                else:
+                    note.fields.append((name, value))
+            if created_at is not None:
+                note.fields.append((DUMP_CREATED_FIELD, created_at))
+            if modified_at is not None:
+                note.fields.append((DUMP_MODIFIED_FIELD, modified_at))
+            text = _unpack_text(text) or ''
+            if text and (not text.endswith('\n')
+                         or not text.split('\n', 1)[0].strip()
+                         or _UNDUMPABLE_TEXT_RE.search(text)):
+                note.fields.append((DUMP_TEXT_FIELD, json.dumps(text)))
+            elif text:
+                # (Not set_text(), which splits the text into lines in ways
+                # that reading the file back does not.)
+                note.textlines = [text]
+            text = str(note)
+            file.write(text if text.endswith('\n') else text + '\n')
+            count += 1
+        cursor.close()
+        if file is not sys.stdout:
+            file.close()
+        return count
+
+    def load_dump(self, filepath: FilePath) -> int:
+        '''Load a file written by dump(); return the number of notes loaded.
+        
+        The database must have no notes in it. Rather than saving the notes
+        one by one, the notes and their tags are inserted with executemany()
+        a batch at a time, with the secondary indexes dropped and the
+        triggers that keep the tag counts and the change log turned off;
+        then the tag counts, the change log, the outline, and the indexes
+        are rebuilt at once. The load is done in one transaction, so if it
+        fails, the database is left empty.
+        '''
+        cursor = self.connection.cursor()
+        cursor.execute('SELECT EXISTS (SELECT 1 FROM notes);')
+        if cursor.fetchone()[0]:
+            cursor.close()
+            raise DatabaseError('can only load a dump into an empty database')
+
+        if filepath == '-':
+            file = sys.stdin
+        elif filepath.endswith('.gz'):
+            file = gzip.open(filepath, mode='rt', encoding='utf-8')
+        else:
+            file = open(filepath, mode='r', encoding='utf-8',
+                        buffering=1024 * 1024)
+
+        cursor.execute('BEGIN TRANSACTION;')
+        for name in _DEFERRED_INDEXES + ['tag_id_index']:
+            cursor.execute('DROP INDEX IF EXISTS ' + name + ';')
+        for name in ['tag_counts_insert', 'changes_insert']:
+            cursor.execute('DROP TRIGGER IF EXISTS ' + name + ';')
+        cursor.execute('SELECT IFNULL(MAX(id), 0) FROM notes;')
+        note_id = cursor.fetchone()[0]
+
+        now = round(time.time(), 6)
+        note_rows, tag_rows = [], []
+        def insert_rows():
+            cursor.executemany('INSERT INTO notes (id, path, text,'
+                               ' modified_at, created_at, version)'
+                               ' VALUES (?, ?, ?, ?, ?, ?);', note_rows)
+            cursor.executemany('INSERT INTO tags (id, name, value)'
+                               ' VALUES (?, ?, ?);', tag_rows)
+            note_rows.clear()
+            tag_rows.clear()
+
+        try:
+            for note in read_notes(file):
+                note_id += 1
+                created_at = modified_at = now
+                text = note.get_text()
+                for name, value in note.fields:
+                    if name == DUMP_CREATED_FIELD:
+                        created_at = value
+                    elif name == DUMP_MODIFIED_FIELD:
+                        modified_at = value
+                    elif name == DUMP_TEXT_FIELD:
+                        text = json.loads(value)
+                    else:
+                        tag_rows.append((note_id, name, value))
+                tag_rows.extend((note_id, tag, None) for tag in note.tags)
+                text = _pack_text(text, self.compress_over)
+                note_rows.append((note_id, note.path, text,
+                                  modified_at, created_at, note.version or 1))
+                if len(note_rows) >= 10000:
+                    insert_rows()
+            insert_rows()
+
+            cursor.execute('DELETE FROM tag_counts;')
+            cursor.execute('INSERT INTO tag_counts (name, value, note_count)'
+                           ' SELECT name, value, COUNT(*) FROM tags'
+                           ' GROUP BY name, value;')
+            cursor.execute("INSERT INTO changes (note_id, path, operation,"
+                           " changed_at) SELECT id, path, 'insert', ?"
+                           " FROM notes ORDER BY id;", (now,))
+            self._rebuild_outline(cursor)
+            cursor.execute('SELECT COUNT(*) FROM notes;')
+            count = cursor.fetchone()[0]
+        except Exception:
+            cursor.execute('ROLLBACK;')
+            raise
+        finally:
+            if file is not sys.stdin:
+                file.close()
+            cursor.close()
+        self.connection.commit()
+        self.create_tables()
+        self.create_indexes()
+        return count
+
+    def move_notes(self, old_prefix: NotePath, new_prefix: NotePath) -> int:
+        '''Move the note at old_prefix, and all notes beneath it, to new_prefix.
+        
+        For example, moving "projects/old" to "archive/2019" moves
+        "projects/old/a" to "archive/2019/a". This is done in a single
+        transaction. Return the number of notes moved.
+        '''
+        if not old_prefix or not new_prefix:
+            raise DatabaseError('cannot move notes to or from a blank path')
+        cursor = self.connection.cursor()
+        cursor.execute('BEGIN TRANSACTION;')
+        count = self._move_notes(old_prefix, new_prefix, cursor)
         cursor.execute('END TRANSACTION;')
         cursor.close()
+        return count
+
+    def change_notes(self,
+                     sql: SQLSelectStatement,
+                     add_tags: List[str] = None,
+                     remove_tags: List[str] = None,
+                     set_fields: List[Tuple[str, object]] = None,
+                     delete: bool = False,
+                     dry_run: bool = False
+                     ) -> int:
+        '''Change every note matched by the query; return the number changed.
+        
+        Tags are added and removed, and fields set (replacing any values the
+        field had), with one statement each for all of the notes, or else
+        the notes are deleted. Only the notes that the changes actually
+        alter are archived (in one batch) and counted. Everything is done
+        in one transaction; if dry_run is True, the transaction is rolled
+        back, so only the count is returned.
+        '''
+        add_tags = add_tags or []
+        remove_tags = remove_tags or []
+        set_fields = set_fields or []
+        if not sql.strip():
+            raise DatabaseError('cannot change notes without a query')
+
+        cursor = self.connection.cursor()
+        cursor.execute('BEGIN TRANSACTION;')
+        cursor.execute('CREATE TEMP TABLE IF NOT EXISTS matched'
+                       ' (id INTEGER PRIMARY KEY);')
+        cursor.execute('CREATE TEMP TABLE IF NOT EXISTS changed'
+                       ' (id INTEGER PRIMARY KEY);')
+        cursor.execute('DELETE FROM matched;')
+        cursor.execute('DELETE FROM changed;')
+        cursor.execute('INSERT INTO matched (id) ' + sql.rstrip().rstrip(';'))
+
+        # Find the notes the changes would alter.
+        if delete:
+            cursor.execute('INSERT INTO changed SELECT id FROM matched;')
+        # (Each note's tags are looked up by its ID; see _append_to_note.)
+        lacks = ('NOT EXISTS (SELECT 1 FROM tags INDEXED BY tag_id_index'
+                 ' WHERE tags.id = matched.id AND name = ? AND value IS ?)')
+        has = lacks[len('NOT '):]
+        for tag in add_tags:
+            cursor.execute('INSERT OR IGNORE INTO changed SELECT id'
+                           ' FROM matched WHERE ' + lacks + ';', (tag, None))
+        for tag in remove_tags:
+            cursor.execute('INSERT OR IGNORE INTO changed SELECT id'
+                           ' FROM matched WHERE ' + has + ';', (tag, None))
+        for name, value in set_fields:
+            other_value = ('EXISTS (SELECT 1 FROM tags'
+                           ' INDEXED BY tag_id_index'
+                           ' WHERE tags.id = matched.id AND name = ?'
+                           ' AND value IS NOT NULL AND value IS NOT ?)')
+            cursor.execute('INSERT OR IGNORE INTO changed SELECT id'
+                           ' FROM matched WHERE ' + lacks + ' OR '
+                           + other_value + ';', (name, value, name, value))
+        cursor.execute('SELECT id FROM changed;')
+        note_ids = [row[0] for row in cursor.fetchall()]
+
+        if dry_run or not note_ids:
+            cursor.execute('ROLLBACK;')
+            cursor.close()
+            return len(note_ids)
+
+        if delete:
+            self._archive_notes_by_id(note_ids, 'delete', cursor)
+            self._delete_notes_by_id(note_ids, cursor)
+        else:
+            self._archive_notes_by_id(note_ids, 'change', cursor,
+                                      text_unchanged=True)
+            for tag in add_tags:
+                cursor.execute('INSERT INTO tags (id, name, value)'
+                               ' SELECT id, ?, NULL FROM changed'
+                               ' WHERE NOT EXISTS (SELECT 1 FROM tags'
+                               ' INDEXED BY tag_id_index'
+                               ' WHERE tags.id = changed.id AND name = ?'
+                               ' AND value IS NULL);', (tag, tag))
+            for tag in remove_tags:
+                cursor.execute('DELETE FROM tags INDEXED BY tag_id_index'
+                               ' WHERE id IN (SELECT id FROM changed)'
+                               ' AND name = ? AND value IS NULL;', (tag,))
+            for name, value in set_fields:
+                cursor.execute('DELETE FROM tags INDEXED BY tag_id_index'
+                               ' WHERE id IN (SELECT id FROM changed)'
+                               ' AND name = ? AND value IS NOT NULL;',
+                               (name,))
+                cursor.execute('INSERT INTO tags (id, name, value)'
+                               ' SELECT id, ?, ? FROM changed;',
+                               (name, value))
+            cursor.execute('UPDATE notes SET modified_at = ?,'
+                           ' version = version + 1'
+                           ' WHERE id IN (SELECT id FROM changed);',
+                           (round(time.time(), 6),))
+        cursor.execute('END TRANSACTION;')
+        cursor.close()
+        return len(note_ids)
+
+    def get_saved_query(self, query_name: str) -> SQLSelectStatement:
+        '''Return the SQL of the stored query given (or a blank string).'''
+        sql = ("SELECT value FROM config WHERE category = 'queries'"
+               " AND name = ?;")
+        cursor = self.connection.cursor()
+        cursor.execute(sql, (query_name,))
+        record = cursor.fetchone()
+        cursor.close()
+        return record[0] if record else ''
+
+    def get_compress_over(self) -> int:
+        '''Return the length over which texts are stored compressed.'''
+        sql = ("SELECT value FROM config WHERE category = 'settings'"
+               " AND name = 'compress_over';")
+        cursor = self.connection.cursor()
+        cursor.execute(sql)
+        record = cursor.fetchone()
+        cursor.close()
+        return int(record[0]) if record else DEFAULT_COMPRESS_OVER
+
+    def set_compress_over(self, length: int) -> None:
+        '''Compress each text saved from now on if it is longer than length.
+        
+        A length of 0 means no text is compressed. Notes already in the
+        database are left as they are until they are next saved. (A dump
+        loaded into a new database is packed as it is loaded, though.)
+        '''
+        if length < 0:
+            raise DatabaseError('length to compress over must be 0 or more')
+        cursor = self.connection.cursor()
+        cursor.execute('BEGIN TRANSACTION;')
+        cursor.execute("DELETE FROM config WHERE category = 'settings'"
+                       " AND name = 'compress_over';")
+        cursor.execute("INSERT INTO config (category, name, value)"
+                       " VALUES ('settings', 'compress_over', ?);",
+                       (str(length),))
+        cursor.execute('END TRANSACTION;')
+        cursor.close()
+        self.compress_over = length
 
     def get_file_path(self):
         return self.db_path
@@ -334,9 +1882,10 @@ class Database(Object):
         self.remove_saved_query(query_name)
 
         cursor = self.connection.cursor()
-        sql = "INSERT INTO config (category, name, value) VALUES (?, ?, ?);"
-        cursor.execute(sql, ('queries', query_name, sql))
+        insert = "INSERT INTO config (category, name, value) VALUES (?, ?, ?);"
+        cursor.execute(insert, ('queries', query_name, sql))
         cursor.close()
+        self.connection.commit()
     
     def remove_saved_query(self, query_name: str) -> None:
         if not query_name:
@@ -346,6 +1895,7 @@ class Database(Object):
         sql = "DELETE FROM config WHERE category = 'queries' AND name = ?;"
         cursor.execute(sql, (query_name,))
         cursor.close()
+        self.connection.commit()
     
     def print_saved_query_names(self) -> None:
         sql = "SELECT name FROM config WHERE category = 'queries';"
@@ -355,33 +1905,75 @@ class Database(Object):
         print('QUERIES SAVED:')
         namecount = 0
         for row in cursor:
-            print('-', '"' + row[0]) + '"'
+            print('-', '"' + row[0] + '"')
             namecount += 1
         cursor.close()
         print('One query' if namecount == 1 else namecount, 'queries')
 
     def run_saved_query(self, query_name: str) -> Dict[NotePath, Note]:
         '''Run the stored query given and return the notes selected.'''
-        sql = ("SELECT value FROM config WHERE category = 'queries'"
-               " AND name = ?;")
+        sql = self.get_saved_query(query_name)
+        return self._get_notes(sql) if sql else {}
+    
+    def run_ranked_query(self,
+                         paths: List[str],
+                         texts: List[str],
+                         tags: List[str],
+                         fields: List[str],
+                         limit: int = None,
+                         modified_since: float = None,
+                         created_before: float = None
+                         ) -> Dict[NotePath, Note]:
+        '''Return the notes matching the terms, best matches first.
+        
+        The notes are those a query with the same terms matches, ordered by
+        how well they match the texts (see RANK_WEIGHTS in querybuilder), and
+        only the first limit of them, if a limit is given; only those are
+        read from the database.
+        '''
         cursor = self.connection.cursor()
-        cursor.execute(sql, (query_name,))
-        record = cursor.fetchone()
-        if record:
-            sql = record[0]
-            notes = self._get_notes(sql)
+        with self._phase('text_index'):
+            self._update_text_index(cursor)
         cursor.close()
-        return notes
-    
+        with self._phase('build_sql'):
+            sql = QueryBuilder().build_ranked_sql_from_lists(
+                paths, texts, tags, fields, limit,
+                modified_since, created_before)
+        return self._get_notes(sql, ordered=True)
+
     def run_query_from_args(self, args: object) -> Dict[NotePath, Note]:
         qb = QueryBuilder()
-        sql = qb.build_sql_from_args(args)
+        if (args.rank or args.limit is not None) and (args.as_of
+                                                      or args.name_query):
+            # (The script refuses these before it gets this far.)
+            raise DatabaseError('cannot use --rank or --limit with --as-of'
+                                ' or -n')
+        if args.rank:
+            paths, texts, tags, fields = qb._flatten_args(args)
+            modified_since, created_before = qb._get_time_range(args)
+            return self.run_ranked_query(paths, texts, tags, fields,
+                                         args.limit, modified_since,
+                                         created_before)
+        with self._phase('build_sql'):
+            sql = qb.build_sql_from_args(args)
+        if args.limit is not None:
+            sql = qb.build_limited_sql(sql, args.limit)
+        if args.as_of:
+            # Notes as they were at a given time are partly in the notes
+            # table (those not changed since) and partly in history.
+            if args.name_query:
+                self._error('cannot save query with --as-of')
+            notes = self._get_notes(sql)
+            with self._phase('build_sql'):
+                sql = qb.build_history_sql_from_args(args)
+            notes.update(self._get_notes(sql, 'history', 'history_tags'))
+            return notes
         if args.name_query:
             if sql:
                 self.save_query(args.name_query[0], sql)
             else:
                 self._error('cannot save query with no parameters')
-        return self._get_notes(sql)
+        return self._get_notes(sql, ordered=args.limit is not None)
 
     def get_notes_by_path(self,
                           notepaths: Union[NotePath, List[NotePath]]
@@ -390,23 +1982,265 @@ class Database(Object):
         if isinstance(notepaths, NotePath):
             notepaths = [notepaths]
         note_ids = self._get_note_ids(notepaths, cursor)
-        notes = self._get_notes_by_id(note_ids, cursor)
+        with self._phase('hydrate'):
+            notes = self._get_notes_by_id(note_ids, cursor)
         cursor.close()
         return notes
 
-    def save_notes(self, notes: Dict[NotePath, Note]):
+    def _find_stale_notes(self,
+                          notes: Dict[NotePath, Note],
+                          cursor
+                          ) -> List[NotePath]:
+        '''Return the paths of notes edited from an out-of-date copy.
+        
+        A note exported from the database carries the version it had then.
+        If the note in the database has a different version now, it has been
+        changed since (perhaps from another exported copy). The versions of
+        all the notes are looked up at once.
+        '''
+        versions = {path: note.version for path, note in notes.items()
+                    if note.version and note.directive in ['replace', 'delete']}
+        if not versions:
+            return []
+        sql = ('SELECT path, version FROM notes WHERE path IN'
+               ' (SELECT value FROM json_each(?));')
+        cursor.execute(sql, (json.dumps(list(versions.keys())),))
+        return sort_notepaths([path for path, version in cursor.fetchall()
+                               if version != versions[path]])
+
+    def save_notes(self, notes: Dict[NotePath, Note]) -> List[NotePath]:
+        '''Save the notes given; return the paths of any stale notes.
+        
+        A stale note (see _find_stale_notes) is not allowed to replace or
+        delete the newer note in the database. A stale replacement is merged
+        into it instead, so that neither set of changes is lost; a stale
+        delete is skipped, leaving the newer note as it is.
+        '''
         cursor = self.connection.cursor()
         cursor.execute('BEGIN TRANSACTION;')
+        try:
+            stale = self._save_batch(notes, cursor)
+        except Exception:
+            # Save all of the notes or none of them.
+            cursor.execute('ROLLBACK;')
+            cursor.close()
+            raise
+        cursor.execute('END TRANSACTION;')
+        cursor.close()
+        return stale
 
-        notepaths = sort_notepaths(list(notes.keys()))
-        for notepath in notepaths:
-            self._save_note(notes[notepath], cursor)
+    def _save_batch(self,
+                    notes: Dict[NotePath, Note],
+                    cursor
+                    ) -> List[NotePath]:
+        with self._phase('save'):
+            stale = self._find_stale_notes(notes, cursor)
+            skipped = set()
+            for notepath in stale:
+                # (Merging a stale delete would only add the old text to
+                # the newer note again.)
+                if notes[notepath].directive == 'delete':
+                    skipped.add(notepath)
+                else:
+                    notes[notepath].directive = 'merge'
 
-        cursor.execute('END TRANSACTION;')
+            notepaths = sort_notepaths(list(notes.keys()))
+            for notepath in notepaths:
+                if notepath not in skipped:
+                    self._save_note(notes[notepath], cursor)
+        return stale
+
+    def save_note_stream(self,
+                         notes: Iterable[Note],
+                         batch_size: int = DEFAULT_BATCH_SIZE
+                         ) -> Tuple[int, List[NotePath]]:
+        '''Save notes as they are read; return the count and any stale paths.
+        
+        Unlike save_notes(), this never holds more than batch_size notes in
+        memory. Each batch is saved under a savepoint, which (outside of any
+        other transaction) commits the batch when it is released; if saving
+        a batch fails, that batch is rolled back, and the batches before it
+        stay saved. A note whose path comes up again is saved against the
+        database like any other note (so with no directive, it is merged
+        into the note saved before), which means the batch holding the
+        earlier note is saved first.
+        '''
+        return self._save_stream(((note, None) for note in notes),
+                                 batch_size)
+
+    def _save_stream(self,
+                     items: Iterable[Tuple[Note, object]],
+                     batch_size: int,
+                     checkpoint: Callable[[object, object], None] = None
+                     ) -> Tuple[int, List[NotePath]]:
+        '''Save each note from (note, marker) pairs, a batch at a time.
+        
+        If a checkpoint function is given, it is called with the marker of
+        the last note in each batch (and the cursor) just before the batch
+        is committed, so that whatever it records is committed with it.
+        '''
+        cursor = self.connection.cursor()
+        count = 0
+        stale = []
+        batch = {}
+        last_marker = None
+
+        def flush():
+            if not batch:
+                return
+            cursor.execute('SAVEPOINT note_batch;')
+            try:
+                stale.extend(self._save_batch(batch, cursor))
+                if checkpoint:
+                    checkpoint(last_marker, cursor)
+            except Exception:
+                if self.connection.in_transaction:
+                    cursor.execute('ROLLBACK TO note_batch;')
+                    cursor.execute('RELEASE note_batch;')
+                raise
+            cursor.execute('RELEASE note_batch;')
+            batch.clear()
+
+        for note, marker in items:
+            if note.path in batch:
+                flush()
+            batch[note.path] = note
+            last_marker = marker
+            count += 1
+            if len(batch) >= batch_size:
+                flush()
+        flush()
         cursor.close()
+        return count, stale
+
+    def get_import_checkpoint(self,
+                              filepath: FilePath
+                              ) -> Union[Dict[str, object], None]:
+        '''Return the checkpoint of an unfinished bulk import of the file.
+        
+        The checkpoint is a dictionary giving the byte offset at which to
+        resume ("offset"), the path of the last note saved ("path"), and the
+        size and modification time of the file when it was made.
+        '''
+        sql = ("SELECT value FROM config WHERE category = 'import'"
+               " AND name = ?;")
+        cursor = self.connection.cursor()
+        cursor.execute(sql, (os.path.abspath(filepath),))
+        record = cursor.fetchone()
+        cursor.close()
+        return json.loads(record[0]) if record else None
+
+    def bulk_import(self,
+                    filepath: FilePath,
+                    batch_size: int = DEFAULT_BATCH_SIZE
+                    ) -> Tuple[int, List[NotePath]]:
+        '''Save the notes in a (large) file; return the count and stale paths.
+        
+        The notes are committed in batches, as by save_note_stream(). With
+        each batch, a checkpoint is stored in the config table, so that if
+        the import is interrupted, running it again on the same file resumes
+        after the last batch saved. (If the file has changed since, the
+        import starts over.) The indexes in _DEFERRED_INDEXES are dropped
+        during the import and rebuilt at the end, even if the import fails.
+        '''
+        key = os.path.abspath(filepath)
+        stat = os.stat(filepath)
+        offset = 0
+        resume = self.get_import_checkpoint(filepath)
+        if (resume and resume['size'] == stat.st_size
+            and resume['mtime'] == stat.st_mtime):
+            offset = resume['offset']
+
+        cursor = self.connection.cursor()
+        cursor.execute('BEGIN TRANSACTION;')
+        for name in _DEFERRED_INDEXES:
+            cursor.execute('DROP INDEX IF EXISTS ' + name + ';')
+        cursor.execute('END TRANSACTION;')
+
+        def save_checkpoint(marker, cursor):
+            offset, notepath = marker
+            value = json.dumps({'offset': offset, 'path': notepath,
+                                'size': stat.st_size, 'mtime': stat.st_mtime})
+            cursor.execute("DELETE FROM config WHERE category = 'import'"
+                           " AND name = ?;", (key,))
+            cursor.execute("INSERT INTO config (category, name, value)"
+                           " VALUES ('import', ?, ?);", (key, value))
+
+        try:
+            with open(filepath, mode='rb') as file:
+                file.seek(offset)
+                reader = OffsetReader(file)
+                # When a note is read, the first line of the next note has
+                # been read too, so the next note begins where that line
+                # began.
+                items = ((note, (reader.line_start, note.path))
+                         for note in read_notes(reader))
+                count, stale = self._save_stream(items, batch_size,
+                                                 save_checkpoint)
+
+            cursor.execute("DELETE FROM config WHERE category = 'import'"
+                           " AND name = ?;", (key,))
+            self.connection.commit()
+        finally:
+            # If the import stopped partway, the batches saved stay saved
+            # (the checkpoint lets it resume), but the indexes must come
+            # back, or every later query on this connection scans tables.
+            if self.connection.in_transaction:
+                self.connection.rollback()
+            cursor.close()
+            self.create_indexes()
+        return count, stale
+
+    def sync(self) -> bool:
+        '''Write a staged database back to its file; return True if written.
+        
+        Nothing is written if nothing has changed since the database was
+        loaded (or last synced). The database is written to a temporary
+        file in the same directory, which then replaces the database file,
+        so that a failure partway through leaves the old file as it was.
+        If the file has been changed by someone else since it was loaded,
+        DatabaseError is raised rather than overwriting those changes.
+        '''
+        if not self.staged:
+            return False
+        self.connection.commit()
+        if self.connection.total_changes == self._synced_changes:
+            return False
+        if self._get_file_stat() != self._staged_stat:
+            t = 'database file changed since it was loaded: ' + self.db_path
+            raise DatabaseError(t)
+
+        dirpath = os.path.dirname(os.path.abspath(self.db_path))
+        if not os.path.exists(dirpath):
+            os.makedirs(dirpath)
+        handle, temp_path = tempfile.mkstemp(dir=dirpath, suffix='.tmp')
+        os.close(handle)
+        try:
+            disk = sqlite3.connect(temp_path)
+            self.connection.backup(disk)
+            disk.close()
+            with open(temp_path, 'rb+') as file:
+                os.fsync(file.fileno())
+            # (The temporary file is readable only by its owner.)
+            if self._staged_stat:
+                mode = os.stat(self.db_path).st_mode & 0o777
+            else:
+                umask = os.umask(0)
+                os.umask(umask)
+                mode = 0o666 & ~umask
+            os.chmod(temp_path, mode)
+            os.replace(temp_path, self.db_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self._staged_stat = self._get_file_stat()
+        self._synced_changes = self.connection.total_changes
+        return True
 
     def close(self) -> None:
         self.connection.commit()
+        self.sync()
         self.connection.close()
     
 
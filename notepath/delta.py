@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# Notepath requires Python 3.8 or higher.
+
+import difflib
+import json
+
+from typing import List, Union
+
+# Type aliases
+Delta = str
+
+
+def make_delta(newer: str, older: str) -> Delta:
+    '''Return a delta from which older can be rebuilt, given newer.
+
+    The delta is a JSON list. Each item in the list is either a pair of
+    numbers [start, end], meaning "copy newer[start:end]", or a string,
+    meaning "insert this text." The texts are compared line by line, but
+    the pairs count characters, so that a delta for text that only lost
+    lines at its end (as when a note grows by merging) is just [[0, n]].
+    '''
+    if newer.startswith(older):
+        return make_prefix_delta(len(older))
+
+    newer_lines = newer.splitlines(keepends=True)
+    older_lines = older.splitlines(keepends=True)
+
+    # Character offset of the start of each line of the newer text.
+    offsets = [0]
+    for line in newer_lines:
+        offsets.append(offsets[-1] + len(line))
+
+    items = [] # type: List[Union[List[int], str]]
+    matcher = difflib.SequenceMatcher(None, newer_lines, older_lines)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            items.append([offsets[i1], offsets[i2]])
+        elif j2 > j1:
+            items.append(''.join(older_lines[j1:j2]))
+    return json.dumps(items, ensure_ascii=False)
+
+def make_prefix_delta(length: int) -> Delta:
+    '''Return a delta for an older text that begins the newer text.'''
+    return json.dumps([[0, length]])
+
+def apply_delta(newer: str, delta: Delta) -> str:
+    '''Rebuild the older text from the newer text and the delta.'''
+    parts = []
+    for item in json.loads(delta):
+        if isinstance(item, str):
+            parts.append(item)
+        else:
+            start, end = item
+            parts.append(newer[start:end])
+    return ''.join(parts)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# Notepath requires Python 3.8 or higher.
+
+import os
+import tempfile
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+from typing import Dict, Iterable, List, Tuple
+
+from basics import FilePath, NotePath, Object, sort_notepaths
+from note import Note
+
+# Notes are formatted this many at a time, and each batch of text is written
+# with one call; the file itself is buffered in blocks of WRITE_BUFFER_SIZE.
+FORMAT_BATCH_SIZE = 1000
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# When notes are split into several files, each file has this extension.
+SPLIT_FILE_EXTENSION = '.nptext'
+
+
+def format_notes(notes: List[Note]) -> str:
+    '''Return the notes as one string, just as print() would output them.
+
+    (This is a module-level function so that worker processes can run it.)
+    '''
+    return ''.join([str(note) + '\n' for note in notes])
+
+def write_atomically(filepath: FilePath, chunks: Iterable[str]) -> None:
+    '''Write the strings to the file, replacing it only once all are written.
+
+    The text goes to a temporary file in the same directory, which is then
+    renamed over the file, so that the file is never left half written (and
+    a reader sees either the old file or the new one).
+    '''
+    dirpath = os.path.dirname(os.path.abspath(filepath))
+    if not os.path.exists(dirpath):
+        os.makedirs(dirpath)
+    handle, temp_path = tempfile.mkstemp(dir=dirpath, suffix='.tmp')
+
+    # The temporary file is readable only by its owner; give the new file
+    # the permissions of the file it replaces, or else the usual ones.
+    if os.path.exists(filepath):
+        mode = os.stat(filepath).st_mode & 0o777
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+    os.chmod(temp_path, mode)
+    try:
+        with open(handle, mode='w', encoding='utf-8',
+                  buffering=WRITE_BUFFER_SIZE) as file:
+            for chunk in chunks:
+                file.write(chunk)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, filepath)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+class Exporter(Object):
+    '''Writes notes (as from a query) to a file, or to a file per subtree.
+
+    With a split level of 0, every note goes into one file. With a split
+    level of N, the path given is a directory, and each note goes into the
+    file named for the first N segments of its notepath: with N = 1, the
+    note "work/tasks/call" goes into "work.nptext"; with N = 2, into
+    "work/tasks.nptext". (A note with fewer segments goes into the file for
+    its own path.) The files are formatted in parallel by worker processes,
+    and each file is written atomically.
+    '''
+    def __init__(self,
+                 path: FilePath,
+                 split_level: int = 0,
+                 workers: int = None
+                 ) -> None:
+        self.path = path
+        self.split_level = split_level
+        self.workers = workers or os.cpu_count() or 1
+
+    def _get_file_path(self, notepath: NotePath) -> FilePath:
+        segments = notepath.split('/')[:self.split_level]
+
+        # Keep each segment from naming a parent directory, or from being
+        # taken as more than one directory.
+        parts = []
+        for segment in segments:
+            segment = segment.replace(os.sep, '_').strip()
+            if segment in ['', '.', '..']:
+                segment = '_' + segment
+            parts.append(segment)
+        return os.path.join(self.path, *parts) + SPLIT_FILE_EXTENSION
+
+    def _group_notes(self,
+                     notes: Dict[NotePath, Note]
+                     ) -> List[Tuple[FilePath, List[Note]]]:
+        '''Return (file path, notes) for each file, with notes in order.'''
+        groups = {} # type: Dict[FilePath, List[Note]]
+        for notepath in sort_notepaths(list(notes.keys())):
+            if self.split_level:
+                filepath = self._get_file_path(notepath)
+            else:
+                filepath = self.path
+            groups.setdefault(filepath, []).append(notes[notepath])
+
+        # A query that found nothing still replaces the single file (with
+        # just the header), so that the file never shows stale results.
+        if not self.split_level and not groups:
+            groups[self.path] = []
+        return list(groups.items())
+
+    def export(self,
+               notes: Dict[NotePath, Note],
+               header: str = ''
+               ) -> List[FilePath]:
+        '''Write the notes; return the paths of the files written.
+
+        The header (such as a summary of the query) is written at the top
+        of each file, as temporary text, which is ignored when the file's
+        notes are saved.
+        '''
+        groups = self._group_notes(notes)
+        if header and not header.endswith('\n'):
+            header += '\n'
+
+        def batches(group: List[Note]) -> List[List[Note]]:
+            return [group[i:i + FORMAT_BATCH_SIZE]
+                    for i in range(0, len(group), FORMAT_BATCH_SIZE)]
+
+        if self.workers > 1 and len(groups) > 1:
+            # Each worker formats a whole file's worth of notes.
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                texts = executor.map(format_notes,
+                                     [group for _, group in groups],
+                                     chunksize=4)
+                for (filepath, _), text in zip(groups, texts):
+                    write_atomically(filepath, [header, text])
+        else:
+            for filepath, group in groups:
+                chunks = (format_notes(batch) for batch in batches(group))
+                write_atomically(filepath, chain([header], chunks))
+        return [filepath for filepath, _ in groups]
@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
-# The function annotations in this module require Python 3.5 or higher.
+# Notepath requires Python 3.8 or higher.
 
 import re
+import sys
 
-from typing import Dict, List
+from typing import Dict, Iterator, List, TextIO
 
 from basics import Object, FilePath, NotePath
 
@@ -18,6 +19,7 @@ class Note(Object):
         self.tags        = []
         self.fields      = [] # each field should be a tuple: (name, value)
         self.directive   = ''
+        self.version     = 0  # the note's version in the database, if known
         self.line_number = 0
         
         # These variables are used only by _add_line().
@@ -60,7 +62,12 @@ class Note(Object):
         divider = '\\' + ('=' * (_TEXT_FILE_LINE_WIDTH - len('\\')))
         parts.append(divider + '\n')
         parts.append('\\ ' + self.path + '\n')
-        parts.append('\\ @' + self.directive + '\n')
+        directive = self.directive
+        if self.version and directive in ['replace', 'merge', 'delete']:
+            # e.g. "@replace 7": replace version 7 of the note (if the
+            # database still has that version).
+            directive += ' ' + str(self.version)
+        parts.append('\\ @' + directive + '\n')
         parts.extend(self._write_tags_and_fields())
         parts.append('\n')
 
@@ -92,6 +99,14 @@ class Note(Object):
             # when the note is re-imported into the database.
             self.directive = line[len('@'):].lstrip()
 
+            # A directive such as "@replace 7" gives the version of the note
+            # that was exported. (The path after "@rename" is left alone.)
+            words = self.directive.split()
+            if (len(words) == 2 and words[0] in ['replace', 'merge', 'delete']
+                and words[1].isdigit()):
+                self.directive = words[0]
+                self.version = int(words[1])
+
         else:
             # Line is one or more tags, separated by commas
             # or semicolons.
@@ -229,9 +244,10 @@ class Note(Object):
     def clone(self) -> 'Note':
         note = Note()
         note.path = self.path
-        note.textlines = self.textlines
-        note.tags = self.tags
-        note.fields = self.fields
+        note.textlines = list(self.textlines)
+        note.tags = list(self.tags)
+        note.fields = list(self.fields)
+        note.version = self.version
         return note
 
     def merge(self, other: 'Note') -> None:
@@ -271,9 +287,10 @@ class Note(Object):
         of the next Note object.
         '''
         lines = multiline_string.splitlines(keepends=True)
-        for i, line in enumerated(lines):
+        for i, line in enumerate(lines):
             if not self._add_line(line):
                 return ''.join(lines[i:])
+        return ''
 
     def read(self, file_handle) -> str:
         '''Set note data from a text file; return first line of next note.'''
@@ -299,7 +316,7 @@ class Note(Object):
         '''
         self.textlines = []
         lines = text.splitlines(keepends=True)
-        while len(lines[0].strip()) == 0:
+        while lines and len(lines[0].strip()) == 0:
             lines.pop(0)
         self.textlines = lines
     
@@ -319,28 +336,55 @@ class Note(Object):
         return sum([len(re.findall(r'\w+', line)) for line in self.textlines])
 
 
+class OffsetReader(Object):
+    '''Read lines of UTF-8 text from a file opened in binary mode.
+    
+    Note.read() can read from this as from a text file. After each line is
+    read, line_start is the byte offset at which the line began, so that
+    reading can be resumed later from the start of a line (by seeking to
+    that offset).
+    '''
+    def __init__(self, file_handle) -> None:
+        self.file_handle = file_handle
+        self.line_start = file_handle.tell()
+
+    def readline(self) -> str:
+        self.line_start = self.file_handle.tell()
+        line = self.file_handle.readline().decode('utf-8')
+        return line.replace('\r\n', '\n')
+
+def read_notes(file_handle: TextIO) -> Iterator[Note]:
+    '''Yield the notes in a text file (or stream) one at a time.
+    
+    Only one note is held in memory at a time, so this can read a file (or
+    standard input) of any size.
+    '''
+    note = Note()
+    while True:
+        line = note.read(file_handle)
+        if note.in_note:
+            yield note
+        if line:
+            note = Note(line)
+        else:
+            break
+
 def get_notes_from_file(filepath: FilePath,
                         notes: Dict[NotePath, Note] = None,
                         suppress_warnings: bool = False
                         ) -> Dict[NotePath, Note]:
     if not notes:
         notes = {}
-        note = Note()
     try:
         with open(filepath, mode='r', encoding='utf-8') as file:
-            while True:
-                line = note.read(file)
+            for note in read_notes(file):
                 if note.path in notes:
                     if not suppress_warnings:
                         t = 'WARNING: notepath used more than once: '
-                        self._error(t + note.path)
+                        print(t + note.path, file=sys.stderr)
                     notes[note.path].merge(note)
                 else:
                     notes[note.path] = note
-                if line:
-                    note = Note(line)
-                else:
-                    break
     except FileNotFoundError:
         pass
     return notes
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# Notepath requires Python 3.8 or higher.
+
+import argparse
+import os
+import sqlite3
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+
+from basics import FilePath, NotePath, Object, sort_notepaths
+from database import Database
+from note import Note
+
+# A note found in a notebook other than the main one is shown with the
+# notebook's name in front of its path, e.g. "team:projects/launch".
+NOTEBOOK_SEPARATOR = ':'
+
+# Type aliases
+NotebookName = str
+NotebookQuery = Callable[[Database], Dict[NotePath, Note]]
+
+
+class NotebookError(Exception): pass
+
+
+def parse_notebook_arg(arg: str) -> Tuple[NotebookName, FilePath]:
+    '''Split a "name=path" argument into the name and the path.'''
+    name, sep, filepath = arg.partition('=')
+    name, filepath = name.strip(), filepath.strip()
+    if not sep or not name or not filepath:
+        raise NotebookError('notebook must be given as name=path: ' + arg)
+    if NOTEBOOK_SEPARATOR in name or '/' in name:
+        t = ('notebook name cannot contain "' + NOTEBOOK_SEPARATOR
+             + '" or "/": ' + name)
+        raise NotebookError(t)
+    return name, os.path.expanduser(filepath)
+
+
+class Notebooks(Object):
+    '''Runs a query on several notebooks (databases) at once.
+
+    The main notebook is the database the script would use anyway; its
+    notes keep their paths. The other notebooks are given by name, and
+    their notes' paths are prefixed with the name (see NOTEBOOK_SEPARATOR).
+    Each notebook is queried on its own connection, in its own thread, so
+    that a query takes about as long as it takes on the slowest notebook
+    (SQLite does its work without holding Python's global lock) rather than
+    as long as it takes on all of them together.
+    '''
+    def __init__(self,
+                 main_path: FilePath,
+                 notebooks: Dict[NotebookName, FilePath]
+                 ) -> None:
+        self.main_path = main_path
+        self.notebooks = notebooks
+
+        # Querying a notebook that isn't there would create an empty one.
+        for name, filepath in notebooks.items():
+            if not os.path.isfile(filepath):
+                t = 'notebook "' + name + '" not found: ' + filepath
+                raise NotebookError(t)
+
+    def _query_notebook(self,
+                        name: NotebookName,
+                        filepath: FilePath,
+                        query: NotebookQuery
+                        ) -> Dict[NotePath, Note]:
+        # (A SQLite connection may only be used by the thread that opened
+        # it, so each thread opens its own.) The other notebooks are only
+        # searched, so they are opened read-only: a search must not change
+        # someone else's file, not even to bring its tables up to date.
+        if not name:
+            db = Database(filepath)
+        else:
+            try:
+                db = Database(filepath, read_only=True)
+            except sqlite3.Error as e:
+                t = 'cannot open notebook "' + name + '": ' + str(e)
+                raise NotebookError(t)
+            if db.needs_upgrade():
+                db.close()
+                t = ('notebook "' + name + '" was written by an earlier'
+                     ' version of Notepath; open it on its own once to'
+                     ' bring it up to date: ' + filepath)
+                raise NotebookError(t)
+        try:
+            return query(db)
+        finally:
+            db.close()
+
+    def run(self,
+            main_query: NotebookQuery,
+            query: NotebookQuery = None
+            ) -> Dict[NotePath, Note]:
+        '''Run the queries; return the notes found, in sort_notepaths order.
+
+        The main query is run on the main notebook, and the other query (or,
+        if none is given, the main query) on each of the other notebooks.
+        '''
+        query = query or main_query
+        jobs = [('', self.main_path, main_query)]
+        for name in sorted(self.notebooks):
+            jobs.append((name, self.notebooks[name], query))
+
+        with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+            futures = [(name, executor.submit(self._query_notebook,
+                                              name, filepath, job_query))
+                       for name, filepath, job_query in jobs]
+            results = [(name, future.result()) for name, future in futures]
+
+        found = {} # type: Dict[NotePath, Note]
+        for name, notes in results:
+            for notepath, note in notes.items():
+                if name:
+                    notepath = name + NOTEBOOK_SEPARATOR + notepath
+                    note.path = notepath
+                found[notepath] = note
+        return {notepath: found[notepath]
+                for notepath in sort_notepaths(list(found.keys()))}
+
+    def run_query_from_args(self, args: object) -> Dict[NotePath, Note]:
+        '''Run the query given on the command line on every notebook.
+
+        A query being saved (-n) is saved in the main notebook only.
+        '''
+        other_args = argparse.Namespace(**vars(args))
+        other_args.name_query = None
+        return self.run(lambda db: db.run_query_from_args(args),
+                        lambda db: db.run_query_from_args(other_args))
+
+    def run_saved_query(self, query_name: str) -> Dict[NotePath, Note]:
+        '''Run a query saved in the main notebook on every notebook.'''
+        db = Database(self.main_path, read_only=True)
+        sql = db.get_saved_query(query_name)
+        db.close()
+        if not sql:
+            return {}
+        return self.run(lambda db: db._get_notes(sql))
+
+    def get_names(self) -> List[NotebookName]:
+        return sorted(self.notebooks)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# Notepath requires Python 3.8 or higher.
+
+import json
+import re
+import sys
+import time
+import tracemalloc
+
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List
+
+from basics import FilePath, Object
+
+# SQL statements that differ only in their values (such as the note IDs in
+# "WHERE id IN (1, 2, 3)", or the text of each note inserted) are counted as
+# one statement. (SQLite reports statements with their parameters filled in.)
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(\.\d+)?\b')
+_VALUE_LIST = re.compile(r'\?(\s*,\s*\?)+')
+
+
+def normalize_sql(statement: str) -> str:
+    '''Return the statement with its values (and runs of space) collapsed.'''
+    statement = _STRING.sub('?', statement)
+    statement = ' '.join(statement.split())
+    statement = _NUMBER.sub('?', statement)
+    return _VALUE_LIST.sub('?, ...', statement)
+
+
+class Profiler(Object):
+    '''Keeps track of where the time (and memory) goes in a run.
+
+    The code being profiled marks off phases of its work (parsing
+    arguments, building SQL, hydrating notes from rows, and so on) with
+    phase(). A database given the profiler (see Database.set_profiler)
+    also reports each SQL statement it runs, and counts the calls to its
+    REGEXP function. report() returns it all as a dict, ready for JSON.
+
+    Phases may be nested (saving notes includes archiving them), so a
+    phase's time includes the time of any phase within it. SQLite only
+    says when a statement starts, so a statement's time is counted from
+    then until the next statement starts or the phase it's in ends: that
+    is, it includes fetching the statement's rows. (SQLite also reports a
+    statement again for each statement of a trigger it sets off, so the
+    count of an INSERT into the notes table, for instance, includes those.)
+    '''
+    def __init__(self, trace_memory: bool = True) -> None:
+        self.start_time = time.perf_counter()
+        self.phases = {} # type: Dict[str, List[float]]
+        self.statements = {} # type: Dict[str, List[float]]
+        self.calls = {} # type: Dict[str, int]
+        self._statement = None # (normalized SQL, time started)
+        self._started_tracemalloc = False
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+
+    def add_time(self, name: str, seconds: float, count: int = 1) -> None:
+        '''Add time spent in a phase that wasn't timed with phase().'''
+        totals = self.phases.setdefault(name, [0.0, 0])
+        totals[0] += seconds
+        totals[1] += count
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self._end_statement(now)
+            self.add_time(name, now - start_time)
+
+    def _end_statement(self, now: float) -> None:
+        if self._statement:
+            statement, start_time = self._statement
+            totals = self.statements.setdefault(statement, [0.0, 0])
+            totals[0] += now - start_time
+            totals[1] += 1
+            self._statement = None
+
+    def trace_sql(self, statement: str) -> None:
+        '''Note a SQL statement starting (for set_trace_callback).'''
+        now = time.perf_counter()
+        self._end_statement(now)
+        self._statement = (normalize_sql(statement), now)
+
+    def count_calls(self, name: str, function: Callable) -> Callable:
+        '''Return the function, wrapped to count the calls made to it.'''
+        self.calls.setdefault(name, 0)
+        def counted(*args):
+            self.calls[name] += 1
+            return function(*args)
+        return counted
+
+    def report(self) -> Dict:
+        now = time.perf_counter()
+        self._end_statement(now)
+        report = {
+            'total_seconds': round(now - self.start_time, 6),
+            'phases': {name: {'seconds': round(seconds, 6), 'count': count}
+                       for name, (seconds, count) in self.phases.items()},
+            'sql': [{'statement': statement, 'seconds': round(seconds, 6),
+                     'count': count}
+                    for statement, (seconds, count) in sorted(
+                        self.statements.items(), key=lambda item: -item[1][0])],
+            'calls': dict(self.calls),
+        }
+        if tracemalloc.is_tracing():
+            report['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+        return report
+
+    def write_report(self, filepath: FilePath = '-') -> None:
+        '''Write the report as JSON to the file (or, for "-", stderr).'''
+        text = json.dumps(self.report(), indent=2)
+        if filepath == '-':
+            print(text, file=sys.stderr)
+        else:
+            with open(filepath, mode='w', encoding='utf-8') as file:
+                file.write(text + '\n')
+
+    def stop(self) -> None:
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
@@ -1,16 +1,41 @@
 #!/usr/bin/env python3
-# The function annotations in this module require Python 3.5 or higher.
+# Notepath requires Python 3.8 or higher.
 
 import re
 
-from typing import List, Tuple
+from typing import List, Tuple, Union
 
 from basics import Object, SQLSelectStatement
+from utils import parse_timestamp
 
 # Type aliases
 SQLFragment = str
 ErrorMessage = str
 
+# Old versions of notes may be stored as deltas; this expression yields the
+# full text of a row in the history table.
+_HISTORY_TEXT = 'CASE WHEN delta THEN HISTORY_TEXT(id) ELSE text END'
+
+# A ranked query (see build_ranked_sql_from_lists) scores each note with
+# SQLite's bm25() over the full-text index, the notes_fts table, whose
+# columns are a note's path, its text, and its tags and fields. A word found
+# in the path, or in the tags and fields, counts for more than one found in
+# the text. (The weights are in the order of the columns.)
+RANK_WEIGHTS = '4.0, 1.0, 2.0'
+
+# The words of a text, for the full-text index: runs of letters and digits
+# (so "don't" is "don" and "t", and "snake_case" is two words). A combining
+# mark, as in a decomposed "re\u0301sume\u0301", splits words here, as it does
+# for the REGEXP clauses; SQLite's tokenizer would keep it in the word. So
+# the index is given only these words (see fts_words), and the phrases
+# searched for are made of them too, and the two always split alike.
+_FTS_WORD = re.compile(r'[^\W_]+')
+
+
+def fts_words(text: str) -> str:
+    '''Return the words of the text (see _FTS_WORD), separated by spaces.'''
+    return ' '.join(_FTS_WORD.findall(text))
+
 
 class QueryBuilder(Object):
     '''Convert command-line arguments into SQL SELECT statements.'''
@@ -100,7 +125,7 @@ class QueryBuilder(Object):
         '''
         operators = ['=', '==', '!=', '<>', '<', '<=', '>', '>=']
         terms = self._parse_split(field, r'([=!<>]+)')
-        if not terms[0] or not terms[2]:
+        if len(terms) < 3 or not terms[0] or not terms[2]:
             return ('', '')
         
         if len(terms) == 3:
@@ -119,7 +144,7 @@ class QueryBuilder(Object):
         presumed to be a regular expression, and run through self.escape()
         but not processed further.
         '''
-        terms = self._parse_split(field, r'((?i) re )')
+        terms = self._parse_split(field, r'(?i)( re )')
         if len(terms) == 3:
             name, op, value = terms[0], 'REGEXP', terms[2]
             sql = "name = " + name + " and value " + op + " " + value
@@ -136,7 +161,7 @@ class QueryBuilder(Object):
         will match spans of whitespace within the field value, and case will be
         ignored.
         '''
-        terms = self._parse_split(field, r'((?i) has )', regexify=True)
+        terms = self._parse_split(field, r'(?i)( has )', regexify=True)
         if len(terms) == 3:
             name, op, value = terms[0], 'REGEXP', terms[2]
             sql = "name = " + name + " and value " + op + " " + value
@@ -167,7 +192,10 @@ class QueryBuilder(Object):
         '''Convert tag string to SQL clause to find tag; return the clause.'''
         tag = tag.strip()
         if tag:
-            sql = "name = " + self.escape(tag) + " and value is NULL"
+            # Every tag's value is NULL, so an index on values is no help in
+            # finding one; the "+" keeps SQLite from using it, even when its
+            # statistics (from ANALYZE) make NULL look like a rare value.
+            sql = "name = " + self.escape(tag) + " and +value is NULL"
         else:
             sql = ''
         return sql
@@ -189,12 +217,30 @@ class QueryBuilder(Object):
             sql = prefix + term
         return sql
     
-    def _parse_text(self, text: str) -> SQLFragment:
+    def _parse_text(self, text: str, column: str = 'text') -> SQLFragment:
         text = text.strip()
+        sql = None
         if text:
-            sql = "text REGEXP " + self.escape(self._regexify(text))
+            sql = column + " REGEXP " + self.escape(self._regexify(text))
         return sql
     
+    def _make_match(self, texts: List[str]) -> str:
+        '''Return a full-text query for notes with all the texts given.
+        
+        Each text becomes a phrase of its words, and every phrase must be
+        found. A phrase may match where the REGEXP clause does not (it
+        ignores punctuation and accents), so the index only narrows down
+        the notes; the REGEXP clauses still decide which ones match. (A
+        text with no letters or digits at all is left to the REGEXP
+        clauses.)
+        '''
+        phrases = []
+        for text in texts or []:
+            words = fts_words(text)
+            if words:
+                phrases.append('"' + words + '"')
+        return ' AND '.join(phrases)
+    
     def _make_tags_clauses(self,
                            fields: List[str],
                            tags: List[str]
@@ -216,7 +262,8 @@ class QueryBuilder(Object):
     
     def _make_notes_clauses(self,
                             paths: List[str],
-                            texts: List[str]
+                            texts: List[str],
+                            text_column: str = 'text'
                             ) -> List[SQLFragment]:
         notes_clauses = []
         if paths:
@@ -226,17 +273,27 @@ class QueryBuilder(Object):
                     notes_clauses.append(sql)
         if texts:
             for text in texts:
-                sql = self._parse_text(text)
+                sql = self._parse_text(text, text_column)
                 if sql:
                     notes_clauses.append(sql)
         return notes_clauses
     
     def _make_query(self,
                     notes_clauses: List[str],
-                    tags_clauses: List[str]
+                    tags_clauses: List[str],
+                    notes_table: str = 'notes',
+                    tags_table: str = 'tags',
+                    range_clauses: List[str] = None
                     ) -> SQLSelectStatement:
-        clauses = ([('notes', clause) for clause in notes_clauses]
-                   + [('tags', clause) for clause in tags_clauses])
+        '''Nest the clauses into one query, each selecting from the next.
+        
+        The innermost query is run first, and the others only check the
+        IDs it returns, so range_clauses (which can be answered from an
+        index on the notes table) go last.
+        '''
+        clauses = ([(notes_table, clause) for clause in notes_clauses]
+                   + [(tags_table, clause) for clause in tags_clauses]
+                   + [(notes_table, clause) for clause in range_clauses or []])
         middle = ' AND id IN ('
         s = []
         if clauses:
@@ -266,24 +323,157 @@ class QueryBuilder(Object):
             lists[0].append('^' + args.root[0])
         return tuple(lists)
 
+    def _get_as_of(self, args: object) -> Union[float, None]:
+        '''Return the --as-of time in seconds since the epoch, if given.'''
+        if args.as_of:
+            return parse_timestamp(args.as_of[0])
+        return None
+
+    def _get_time_range(self, args: object) -> Tuple[Union[float, None],
+                                                     Union[float, None]]:
+        '''Return the --modified-since and --created-before times, if given.'''
+        modified_since = created_before = None
+        if args.modified_since:
+            modified_since = parse_timestamp(args.modified_since[0])
+        if args.created_before:
+            created_before = parse_timestamp(args.created_before[0])
+        return modified_since, created_before
+
     def build_sql_from_lists(self,
                              paths: List[str],
                              texts: List[str],
                              tags: List[str],
-                             fields: List[str]
+                             fields: List[str],
+                             as_of: float = None,
+                             modified_since: float = None,
+                             created_before: float = None,
+                             match: str = None
                              ) -> SQLSelectStatement:
+        '''Build a query for notes in the notes table.
+        
+        If a time is given (as_of), only notes that have not been changed
+        since then are matched; see build_history_sql_from_lists(). The
+        other times limit the notes to those changed at or after
+        modified_since and those first saved before created_before.
+        
+        If a full-text query is given (match), only the notes whose text
+        the notes_fts table matches are checked against the other clauses.
+        '''
         tags_clauses = self._make_tags_clauses(fields, tags)
         notes_clauses = self._make_notes_clauses(paths, texts)
-        sql = self._make_query(notes_clauses, tags_clauses)
+        if as_of is not None:
+            notes_clauses.append('(modified_at <= ' + repr(as_of)
+                                 + ' OR modified_at IS NULL)')
+        range_clauses = []
+        if modified_since is not None:
+            range_clauses.append('modified_at >= ' + repr(modified_since))
+        if created_before is not None:
+            range_clauses.append('created_at < ' + repr(created_before))
+        if match:
+            # The index answers this faster than any other clause, so it
+            # goes innermost.
+            range_clauses.append('id IN (SELECT rowid FROM notes_fts'
+                                 ' WHERE notes_fts MATCH '
+                                 + self.escape('text : (' + match + ')')
+                                 + ')')
+        sql = self._make_query(notes_clauses, tags_clauses,
+                               range_clauses=range_clauses)
+        return sql
+
+    def build_ranked_sql_from_lists(self,
+                                    paths: List[str],
+                                    texts: List[str],
+                                    tags: List[str],
+                                    fields: List[str],
+                                    limit: int = None,
+                                    modified_since: float = None,
+                                    created_before: float = None
+                                    ) -> SQLSelectStatement:
+        '''Build a query for notes matching the texts, best matches first.
+        
+        The notes matched are the ones build_sql_from_lists() matches. The
+        query selects the ID and path of each, ordered by how well the
+        note matches the texts (see RANK_WEIGHTS), and only the first
+        limit of them, if a limit is given. The notes_fts table must be up
+        to date; see Database.run_ranked_query().
+        '''
+        match = self._make_match(texts)
+        sql = self.build_sql_from_lists(paths, texts, tags, fields, None,
+                                        modified_since, created_before,
+                                        match)
+        if not sql or not match:
+            # Nothing to rank by, so the notes come in notepath order.
+            return self.build_limited_sql(sql, limit)
+        # The same words, but found anywhere, so that bm25() counts the
+        # words found in the path and in the tags and fields, too. (The
+        # index holds only the words of a path, so the path itself comes
+        # from the notes table.)
+        sql = ('SELECT n.id, n.path FROM notes_fts'
+               ' JOIN notes AS n ON n.id = notes_fts.rowid'
+               ' WHERE notes_fts MATCH ' + self.escape(match)
+               + ' AND notes_fts.rowid IN (' + sql + ')'
+               ' ORDER BY bm25(notes_fts, ' + RANK_WEIGHTS + '),'
+               ' NOTEPATH_KEY(n.path)')
+        if limit is not None:
+            sql += ' LIMIT ' + str(int(limit))
+        return sql
+
+    def build_limited_sql(self,
+                          sql: SQLSelectStatement,
+                          limit: int = None
+                          ) -> SQLSelectStatement:
+        '''Order a query's notes by notepath, keeping the first limit.
+        
+        The query built selects the ID and path of each note.
+        '''
+        if not sql:
+            return sql
+        sql = ('SELECT id, path FROM notes WHERE id IN (' + sql + ')'
+               ' ORDER BY NOTEPATH_KEY(path)')
+        if limit is not None:
+            sql += ' LIMIT ' + str(int(limit))
+        return sql
+
+    def build_history_sql_from_lists(self,
+                                     paths: List[str],
+                                     texts: List[str],
+                                     tags: List[str],
+                                     fields: List[str],
+                                     as_of: float
+                                     ) -> SQLSelectStatement:
+        '''Build a query for old versions of notes current at a given time.
+        
+        The query selects from the history tables those versions that were
+        current at the time given (as_of, in seconds since the epoch): the
+        versions written before then and archived after. Together with the
+        notes matched by build_sql_from_lists() with the same time, these
+        are the notes that would have matched at that time.
+        '''
+        tags_clauses = self._make_tags_clauses(fields, tags)
+        notes_clauses = self._make_notes_clauses(paths, texts, _HISTORY_TEXT)
+        notes_clauses.append('archived_at > ' + repr(as_of)
+                             + ' AND (valid_from <= ' + repr(as_of)
+                             + ' OR valid_from IS NULL)')
+        sql = self._make_query(notes_clauses, tags_clauses,
+                               'history', 'history_tags')
         return sql
 
     def build_sql_from_args(self, args: object) -> SQLSelectStatement:
         paths, texts, tags, fields = self._flatten_args(args)
-        return self.build_sql_from_lists(paths, texts, tags, fields)
+        as_of = self._get_as_of(args)
+        modified_since, created_before = self._get_time_range(args)
+        return self.build_sql_from_lists(paths, texts, tags, fields, as_of,
+                                         modified_since, created_before)
+
+    def build_history_sql_from_args(self, args: object) -> SQLSelectStatement:
+        paths, texts, tags, fields = self._flatten_args(args)
+        as_of = self._get_as_of(args)
+        return self.build_history_sql_from_lists(paths, texts, tags, fields,
+                                                 as_of)
 
     def summarize_query_from_args(self, args: object) -> str:
         if args.query:
-            return 'SAVED QUERY: ' + self.args.query[0]
+            return 'SAVED QUERY: ' + args.query[0]
         else:
             parts = []
             paths, texts, tags, fields = self._flatten_args(args)
@@ -304,6 +494,21 @@ class QueryBuilder(Object):
             for field in fields:
                 parts.append('--- FIELD:'.ljust(width)
                              + '"' + field + '"')
+            if args.as_of:
+                parts.append('--- AS OF:'.ljust(width)
+                             + '"' + args.as_of[0] + '"')
+            if args.modified_since:
+                parts.append('--- MODIFIED SINCE:'.ljust(width)
+                             + '"' + args.modified_since[0] + '"')
+            if args.created_before:
+                parts.append('--- CREATED BEFORE:'.ljust(width)
+                             + '"' + args.created_before[0] + '"')
+            if args.rank:
+                parts.append('--- RANKED:'.ljust(width)
+                             + 'best matches first')
+            if args.limit is not None:
+                parts.append('--- LIMITED TO:'.ljust(width)
+                             + '{:,}'.format(args.limit) + ' notes')
             if parts:
                 parts.insert(0, 'SEARCHING FOR NOTES WITH:')
             return '\n'.join(parts)
@@ -1,12 +1,15 @@
 #!/usr/bin/env python3
-# The function annotations in this module require Python 3.5 or higher.
+# Notepath requires Python 3.8 or higher.
 
 import argparse
+import atexit
+import json
 import os
 import sys
 import time
 
-from typing import List
+from contextlib import nullcontext
+from typing import ContextManager, Dict, Iterator, List, Union
 
 # Explicitly put the current directory in the import path, so that the main
 # script can use this file as a module without causing the "import" lines
@@ -15,27 +18,59 @@ _here_ = os.path.realpath(os.path.dirname(__file__))
 if _here_ not in sys.path:
     sys.path.append(_here_)
 
-from basics import get_data_path, FilePath, Object
-from database import Database, DEFAULT_DATABASE_FILENAME
+from archiver import Archiver, ARCHIVE_FILENAME, COMPRESS_AFTER_DAYS
+from basics import (get_data_path, sort_notepaths, FilePath, NotePath,
+                    Object)
+from database import (Database, DatabaseError, DEFAULT_BATCH_SIZE,
+                      DEFAULT_COMPRESS_OVER, DEFAULT_DATABASE_FILENAME)
+from exporter import Exporter, write_atomically
 from license import print_license
-from note import get_notes_from_file
+from note import Note, read_notes
+from notebooks import NotebookError, Notebooks, parse_notebook_arg
+from profiler import Profiler
 from querybuilder import QueryBuilder
 from utils import (get_readable_filesize, get_readable_moddate,
-                   timestamp_for_journal, timestamp_for_logging)
+                   parse_timestamp, timestamp_for_journal,
+                   timestamp_for_logging)
 
 
 class Script(Object):
     def run(self) -> None:
+        start_time = time.perf_counter()
         self._init_options()
         self.args = self.parser.parse_args()
+
+        # With --profile, a report of where the time went is written at
+        # the end (including on the way out through sys.exit()).
+        self.profiler = None
+        if self.args.profile:
+            self.profiler = Profiler()
+            self.profiler.add_time('parse_args',
+                                   time.perf_counter() - start_time)
+            atexit.register(self.profiler.write_report, self.args.profile)
         
         if self.args.license:
             print_license()
             sys.exit(0)
 
         path = get_data_path(DEFAULT_DATABASE_FILENAME)
-        self.db = Database(path)
+        with self._phase('open_database'):
+            self.db = Database(path, staged=self.args.staged)
+        self.db.set_profiler(self.profiler)
+        if not self.args.staged:
+            self._run_commands()
+            return
+        # Everything is done in memory and written back on the way out
+        # (including by sys.exit()). This is not left to atexit, because
+        # Python ignores sys.exit() in an atexit function, and a failed
+        # write-back must still end with an exit status of 1.
+        try:
+            self._run_commands()
+        finally:
+            self.close_staged_database()
 
+    def _run_commands(self) -> None:
+        '''Do what the options ask, with the database open.'''
         if self.args.database:
             self.db.print_sqlite_info()
             sys.exit(0)
@@ -44,71 +79,454 @@ class Script(Object):
             self.db.print_saved_query_names()
             sys.exit(0)
 
+        if self.args.list_tags is not None:
+            self.db.print_counts(self.db.get_tag_counts(self.args.list_tags))
+            sys.exit(0)
+
+        if self.args.list_fields is not None:
+            counts = self.db.get_field_counts(self.args.list_fields)
+            self.db.print_counts(counts)
+            sys.exit(0)
+
+        if self.args.list_values_for:
+            field_name = self.args.list_values_for[0]
+            prefix = ' '.join(self.args.list_values_for[1:])
+            counts = self.db.get_value_counts(field_name, prefix)
+            self.db.print_counts(counts)
+            sys.exit(0)
+
+        if self.args.outline is not None:
+            self.db.print_outline(self.args.outline)
+            sys.exit(0)
+
+        if self.args.list_children is not None:
+            self.db.print_counts(self.db.get_children(self.args.list_children))
+            sys.exit(0)
+
+        if self.args.count_notes is not None:
+            count = self.db.count_notes_under(self.args.count_notes)
+            print('{:,}'.format(count))
+            sys.exit(0)
+
+        if self.args.history:
+            self.db.print_history(self.args.history[0])
+            sys.exit(0)
+
+        if self.args.restore:
+            self.restore_note_from_args(self.args)
+            sys.exit(0)
+
+        if self.args.maintain_archive:
+            archiver = Archiver(self.args.maintain_archive)
+            archiver.maintain(self.args.compress_after)
+            sys.exit(0)
+
+        if self.args.read_archive:
+            self.read_archive_from_args(self.args)
+            sys.exit(0)
+
+        if self.args.export_history:
+            filepath = self.args.export_history[0]
+            notepath = self.args.export_history[1] if len(
+                self.args.export_history) > 1 else None
+            self.db.export_history(filepath, notepath)
+            sys.exit(0)
+
+        if self.args.changes_since is not None:
+            self.print_changes_from_args(self.args)
+            sys.exit(0)
+
+        if self.args.truncate_changes is not None:
+            count = self.db.truncate_changes(self.args.truncate_changes)
+            print('CHANGES REMOVED:', '{:,}'.format(count))
+            sys.exit(0)
+
+        if self.args.compact_changes:
+            count = self.db.compact_changes()
+            print('CHANGES REMOVED:', '{:,}'.format(count))
+            sys.exit(0)
+
+        if self.args.move:
+            old_prefix, new_prefix = self.args.move
+            try:
+                count = self.db.move_notes(old_prefix, new_prefix)
+            except DatabaseError as e:
+                self._error(e)
+                sys.exit(1)
+            print('NOTES MOVED:', '{:,}'.format(count))
+            sys.exit(0)
+
+        for option in [self.args.as_of, self.args.modified_since,
+                       self.args.created_before]:
+            try:
+                if option:
+                    parse_timestamp(option[0])
+            except ValueError as e:
+                self._error(e)
+                sys.exit(1)
+        if self.args.as_of and (self.args.modified_since
+                                or self.args.created_before):
+            self._error('cannot use --as-of with --modified-since'
+                        ' or --created-before')
+            sys.exit(1)
+        if self.args.rank and not self.args.text:
+            self._error('--rank needs words to rank by (-t)')
+            sys.exit(1)
+        if self.args.limit is not None and self.args.limit < 1:
+            self._error('--limit must be 1 or more')
+            sys.exit(1)
+        if ((self.args.rank or self.args.limit is not None)
+            and (self.args.query or self.args.notebook)):
+            self._error('cannot use --rank or --limit with -q or --notebook')
+            sys.exit(1)
+        if ((self.args.rank or self.args.limit is not None)
+            and (self.args.as_of or self.args.name_query)):
+            self._error('cannot use --rank or --limit with --as-of or -n')
+            sys.exit(1)
+
+        # A new limit for compressing texts applies to the notes saved (or
+        # loaded) by this same command, too.
+        if self.args.compress_over is not None:
+            try:
+                self.db.set_compress_over(self.args.compress_over)
+            except DatabaseError as e:
+                self._error(e)
+                sys.exit(1)
+
+        if self.args.dump:
+            start_time = time.time()
+            count = self.db.dump(self.args.dump[0])
+            self._report_throughput('NOTES DUMPED:', count, start_time)
+            sys.exit(0)
+
+        if self.args.restore_dump:
+            start_time = time.time()
+            try:
+                count = self.db.load_dump(self.args.restore_dump[0])
+            except DatabaseError as e:
+                self._error(e)
+                sys.exit(1)
+            self._report_throughput('NOTES LOADED:', count, start_time)
+            sys.exit(0)
+
+        if self.args.bulk_import:
+            self.bulk_import_from_args(self.args)
+            sys.exit(0)
+
         # Save notes first, so the query can include them.
         if self.args.save_notes:
-            self.save_notes(self.args)
+            self.save_notes_from_args(self.args)
+
+        # Changes made by query are made after saving, too.
+        if (self.args.add_tag or self.args.remove_tag or self.args.set_field
+            or self.args.delete):
+            self.change_notes_from_args(self.args)
+            sys.exit(0)
 
         # Run the query and retrieve the notes.
         if self.args.remove_query:
             self.db.remove_saved_query(self.args.remove_query[0])
+        # With --notebook, the same query is run on the other notebooks
+        # (the Notebooks object has the same query methods as the database).
+        source = self.db
+        notebooks = self.get_notebooks_from_args(self.args)
+        if notebooks:
+            # (Each notebook is read from its file, so notes saved into a
+            # staged database must be written back first.)
+            self.sync_staged_database()
+            source = notebooks
         start_time = time.time()
-        if self.args.query:
-            notes = self.db.run_saved_query(self.args.query[0])
-        else:
-            notes = self.db.run_query_from_args(self.args)
+        try:
+            if self.args.query:
+                notes = source.run_saved_query(self.args.query[0])
+            else:
+                notes = source.run_query_from_args(self.args)
+        except NotebookError as e:
+            self._error(e)
+            sys.exit(1)
         elapsed = time.time() - start_time
 
-        # Output notes sorted by notepath.
-        paths = sorted(list(notes.keys()))
+        # Output notes sorted by notepath (so that parents and children are
+        # never separated; see sort_notepaths), unless they were ranked.
+        if self.args.rank:
+            paths = list(notes.keys())
+        else:
+            paths = sort_notepaths(list(notes.keys()))
 
         # But output statistics and query info before outputting any notes.
+        lines = []
         summary = QueryBuilder().summarize_query_from_args(self.args)
         if summary:
             path = self.db.get_file_path()
             size = get_readable_filesize(path)
             moddate = get_readable_moddate(path)
-            print(summary)
-            print('')
-            print('DATABASE SIZE:    ', size)
-            print('DATABASE MODIFIED:', moddate)
-            print('WHEN SEARCHED:    ', timestamp_for_journal())
-            print('SEARCH DURATION:  ', '{0:.4f}'.format(elapsed), 'seconds')
-            print('NOTES FOUND:      ', '{:,}'.format(len(notes)))
-            word_count = sum(notes[path].count_words() for path in paths)
-            print('WORD COUNT:       ', '{:,}'.format(word_count))
-            print('')
+            with self._phase('count_words'):
+                word_count = sum(notes[path].count_words() for path in paths)
+            lines.append(summary)
+            lines.append('')
+            lines.append('DATABASE SIZE:     ' + size)
+            lines.append('DATABASE MODIFIED: ' + moddate)
+            lines.append('WHEN SEARCHED:     ' + timestamp_for_journal())
+            lines.append('SEARCH DURATION:   '
+                         + '{0:.4f}'.format(elapsed) + ' seconds')
+            if notebooks:
+                names = ['(main)'] + notebooks.get_names()
+                lines.append('NOTEBOOKS:         ' + ', '.join(names))
+            lines.append('NOTES FOUND:       ' + '{:,}'.format(len(notes)))
+            lines.append('WORD COUNT:        ' + '{:,}'.format(word_count))
+            lines.append('')
         else:
-            print('NO SEARCH WAS MADE.')
+            lines.append('NO SEARCH WAS MADE.')
+
+        # With --write-to, the summary goes at the top of each file written,
+        # and the names of the files go to standard output.
+        if self.args.write_to:
+            header = '\n'.join(lines) + '\n'
+            self.write_notes_from_args(self.args, notes, header)
+            return
 
         # Output notes last.
-        for path in paths:
-            if self.args.paths_only:
-                print(path)
-            else:
-                print(notes[path])
+        print('\n'.join(lines))
+        with self._phase('format'):
+            for path in paths:
+                if self.args.paths_only:
+                    print(path)
+                else:
+                    print(notes[path])
+
+    def _phase(self, name: str) -> ContextManager:
+        '''Return a context for timing a phase of work, if profiling.'''
+        if self.profiler:
+            return self.profiler.phase(name)
+        return nullcontext()
+
+    def write_notes_from_args(self,
+                              args: object,
+                              notes: Dict[NotePath, Note],
+                              header: str
+                              ) -> None:
+        filepath = args.write_to[0]
+        if args.paths_only:
+            if args.split_level:
+                self._error('cannot use --split-level with --paths-only')
+                sys.exit(1)
+            # (Written in order of their paths, even if ranked, as the
+            # notes themselves are written by the Exporter.)
+            paths = sort_notepaths(list(notes.keys()))
+            write_atomically(filepath, [path + '\n' for path in paths])
+            print(filepath)
+            return
+        if args.split_level < 0:
+            self._error('--split-level must be 0 or more')
+            sys.exit(1)
+        exporter = Exporter(filepath, args.split_level)
+        with self._phase('format'):
+            written = exporter.export(notes, header)
+        for filepath in written:
+            print(filepath)
+
+    def change_notes_from_args(self, args: object) -> None:
+        if args.as_of:
+            self._error('cannot change notes found with --as-of')
+            sys.exit(1)
+        if args.rank or args.limit is not None:
+            self._error('cannot change notes found with --rank or --limit')
+            sys.exit(1)
+        if args.query:
+            sql = self.db.get_saved_query(args.query[0])
+        else:
+            sql = QueryBuilder().build_sql_from_args(args)
+        set_fields = []
+        for item in self._flatten_arg(args.set_field) or []:
+            name, sep, value = item.partition('=')
+            if not sep or not name.strip():
+                self._error('expected name=value, not:', item)
+                sys.exit(1)
+            # As in notes, a numeric value is stored as a float.
+            try:
+                value = float(value)
+            except ValueError:
+                value = value.strip()
+            set_fields.append((name.strip(), value))
+        try:
+            count = self.db.change_notes(
+                sql, add_tags=self._flatten_arg(args.add_tag),
+                remove_tags=self._flatten_arg(args.remove_tag),
+                set_fields=set_fields, delete=args.delete,
+                dry_run=args.dry_run)
+        except DatabaseError as e:
+            self._error(e)
+            sys.exit(1)
+        if args.dry_run:
+            print('NOTES THAT WOULD CHANGE:', '{:,}'.format(count))
+        else:
+            print('NOTES CHANGED:', '{:,}'.format(count))
+
+    def print_changes_from_args(self, args: object) -> None:
+        '''Print each note changed since the seq given, as it is now.
+        
+        A deleted note is printed with a delete directive, so that saving
+        the output into another database brings that database up to date.
+        In nptext, the seq to ask for next time is printed first (as the
+        file's temporary text); in JSON Lines, each line has its seq.
+        '''
+        if args.format == 'jsonl':
+            for seq, path, note in self.db.get_changes_since(
+                    args.changes_since):
+                item = {'seq': seq, 'path': path}
+                if note:
+                    item['operation'] = 'save'
+                    item['tags'] = note.tags
+                    item['fields'] = note.fields
+                    item['text'] = note.get_text()
+                else:
+                    item['operation'] = 'delete'
+                print(json.dumps(item, ensure_ascii=False))
+        else:
+            print('CHANGES SINCE:', args.changes_since)
+            print('LAST CHANGE:  ', self.db.get_last_change())
+            print('')
+            for seq, path, note in self.db.get_changes_since(
+                    args.changes_since):
+                if not note:
+                    note = Note()
+                    note.path = path
+                    note.directive = 'delete'
+                print(note)
+
+    def sync_staged_database(self) -> None:
+        try:
+            self.db.sync()
+        except DatabaseError as e:
+            self._error(e)
+            self._error('The changes made in memory were NOT written back.')
+            sys.exit(1)
+
+    def close_staged_database(self) -> None:
+        self.sync_staged_database()
+        self.db.close()
+
+    def get_notebooks_from_args(self, args: object) -> Union[Notebooks, None]:
+        if not args.notebook:
+            return None
+        notebooks = {}
+        try:
+            for arg in self._flatten_arg(args.notebook):
+                name, filepath = parse_notebook_arg(arg)
+                if name in notebooks:
+                    raise NotebookError('notebook given twice: ' + name)
+                notebooks[name] = filepath
+            return Notebooks(self.db.get_file_path(), notebooks)
+        except NotebookError as e:
+            self._error(e)
+            sys.exit(1)
+
+    def restore_note_from_args(self, args: object) -> None:
+        notepath = args.restore[0]
+        when = None
+        if args.at:
+            try:
+                when = parse_timestamp(args.at[0])
+            except ValueError as e:
+                self._error(e)
+                sys.exit(1)
+        if self.db.restore_note(notepath, when):
+            print('RESTORED:', notepath)
+        else:
+            self._error('No archived version found for:', notepath)
+            sys.exit(1)
+
+    def read_archive_from_args(self, args: object) -> None:
+        notepath = args.read_archive[0]
+        filepath = args.read_archive[1] if len(args.read_archive) > 1 else None
+        for note in Archiver(filepath).read_versions(notepath):
+            print(note)
 
     def save_notes_from_args(self, args: object) -> None:
         filepaths = self._flatten_arg(args.save_notes)
-        self.save_notes_from_filepaths(filepaths)
+        self.save_notes_from_filepaths(filepaths, args.batch_size)
     
-    def save_notes_from_filepaths(self, filepaths: List[FilePath]) -> None:
-        # Broken out to make testing a little easier.
-        notes = {}
-        print('SAVING NOTES INTO DATABASE FROM FILES:')
-        number = 1
+    def _report_throughput(self,
+                           label: str,
+                           count: int,
+                           start_time: float
+                           ) -> None:
+        # Reported on stderr, so that "--dump -" can be piped.
+        elapsed = time.time() - start_time
+        rate = count / elapsed if elapsed else 0
+        self._error(label, '{:,}'.format(count), 'in',
+                    '{0:.1f}'.format(elapsed), 'seconds',
+                    '({:,.0f} notes per second)'.format(rate))
 
+    def bulk_import_from_args(self, args: object) -> None:
+        for filepath in self._flatten_arg(args.bulk_import):
+            if not os.path.exists(filepath):
+                self._error('File not found:', filepath)
+                continue
+            checkpoint = self.db.get_import_checkpoint(filepath)
+            if checkpoint:
+                print('RESUMING IMPORT:', filepath, '(at byte',
+                      '{:,}'.format(checkpoint['offset']) + ', after',
+                      checkpoint['path'] + ')')
+            else:
+                print('IMPORTING:', filepath)
+            start_time = time.time()
+            try:
+                count, stale = self.db.bulk_import(filepath, args.batch_size)
+            except DatabaseError as e:
+                self._error(e)
+                self._error('Run the same command again to resume.')
+                sys.exit(1)
+            elapsed = time.time() - start_time
+            print('NOTES SAVED:', '{:,}'.format(count), 'in',
+                  '{0:.1f}'.format(elapsed), 'seconds')
+            for notepath in stale:
+                self._error('CHANGED SINCE EXPORT (MERGED OR NOT DELETED):',
+                            notepath)
+
+    def _read_notes_from_filepaths(self,
+                                   filepaths: List[FilePath]
+                                   ) -> Iterator[Note]:
+        number = 1
         for filepath in filepaths:
             prefix = '{:,}'.format(number) + '. '
+            number += 1
+            if filepath == '-':
+                print(prefix, '(standard input)')
+                yield from read_notes(sys.stdin)
+                continue
             print(prefix, filepath)
-            
-            # Make one big dictionary of all the notes from all the files.
-            # This is in case notes in different files have the same path,
-            # as when the same note was exported in different queries. (Worst
-            # case scenario should be that you'll end up with some notes with
-            # the text repeated twice.)
-            notes = get_notes_from_file(filepath, notes)
+            try:
+                with open(filepath, mode='r', encoding='utf-8') as file:
+                    yield from read_notes(file)
+            except FileNotFoundError:
+                self._error('File not found:', filepath)
 
-        self.db.save_notes(notes)
+    def save_notes_from_filepaths(self,
+                                  filepaths: List[FilePath],
+                                  batch_size: int = DEFAULT_BATCH_SIZE
+                                  ) -> None:
+        # Broken out to make testing a little easier.
+        #
+        # The notes are saved as they are read, a batch at a time, so that
+        # a file of any size (or "-", for standard input) can be saved. If
+        # notes in different files have the same path, as when the same
+        # note was exported in different queries, the later note is saved
+        # against the earlier one in the database. (Worst case scenario
+        # should be that you'll end up with some notes with the text
+        # repeated twice.)
+        print('SAVING NOTES INTO DATABASE FROM FILES:')
+        notes = self._read_notes_from_filepaths(filepaths)
+        count, stale = self.db.save_note_stream(notes, batch_size)
+        print('NOTES SAVED:', '{:,}'.format(count))
+        if stale:
+            # Someone changed these notes in the database after they were
+            # exported, so they were merged rather than replaced (or, if
+            # they were to be deleted, left alone).
+            self._error('NOTES CHANGED SINCE EXPORT'
+                        ' (MERGED, NOT REPLACED; OR NOT DELETED):')
+            for notepath in stale:
+                self._error('---', notepath)
 
     def _init_options(self):
         t = ('For moving notes between text files and a SQLite database.'
@@ -125,16 +543,55 @@ class Script(Object):
 
         t = 'Print SQLite settings.'
         parser.add_argument('-d', '--database', help=t, action='store_true')
+
+        t = ('Copy the database into memory, do everything there, and write'
+             ' it back to its file at the end (only if anything changed),'
+             ' all at once. This is much faster on slow media such as a'
+             ' thumb drive.')
+        parser.add_argument('--staged', help=t, action='store_true')
+
+        t = ('Report, as JSON, how long each phase of the work took, each'
+             ' SQL statement run, how many times REGEXP was called, and the'
+             ' most memory used. The report is written to the file given,'
+             ' or else to standard error. (Tracking memory slows Notepath'
+             ' down somewhat.)')
+        parser.add_argument('--profile', help=t, nargs='?', const='-',
+                            metavar='file')
         
         t = ('Print only the paths of matching notes. (If this option is not'
              ' specified, each note is printed in full.)')
         parser.add_argument('-P', '--paths-only', help=t, action='store_true')
 
+        t = ('Write the notes found (or, with -P, their paths) to a file'
+             ' instead of printing them. The file is replaced only once'
+             ' every note has been written to it.')
+        parser.add_argument('-w', '--write-to', help=t, nargs=1,
+                            metavar='path')
+
+        t = ('With -w, treat the path as a directory, and write the notes'
+             ' into one file per subtree: with N = 1, one file for each'
+             ' top-level segment of the notepaths ("work.nptext"); with'
+             ' N = 2, one for each second-level segment'
+             ' ("work/tasks.nptext"); and so on.')
+        parser.add_argument('--split-level', help=t, type=int, default=0,
+                            metavar='N')
+
         t = ('Print notes whose text has certain words or phrases. '
              'This program matches whole words and ignores case.')
         parser.add_argument('-t', '--text', help=t, action=a, nargs='+',
                             metavar='phrase')
         
+        t = ('With -t, print the notes best matching the words first (a word'
+             ' found in a note\'s path, tags, or fields counts for more than'
+             ' one found in its text). The first time, this builds a'
+             ' full-text index, which is kept up to date after that.')
+        parser.add_argument('--rank', help=t, action='store_true')
+
+        t = ('Print only the first N notes found (with --rank, the N best'
+             ' matches; otherwise, the first N by notepath). Only those'
+             ' notes are read from the database.')
+        parser.add_argument('--limit', help=t, type=int, metavar='N')
+
         t = ('Print only notes whose path begins with "part" --- i.e.,'
              ' specify a "root" path for all matching notes.')
         parser.add_argument('-r', '--root', help=t, nargs=1, metavar='part')
@@ -153,6 +610,26 @@ class Script(Object):
         parser.add_argument('-f', '--field', help=t, action=a, nargs='+',
                             metavar='X=Y')
         
+        t = ('Find notes as they were at the time given (e.g. "2020-03-01'
+             ' 14:30"), including old versions since replaced or deleted.')
+        parser.add_argument('--as-of', help=t, nargs=1, metavar='timestamp')
+
+        t = ('Print only notes changed at or after the time given (e.g.'
+             ' "2020-03-01").')
+        parser.add_argument('--modified-since', help=t, nargs=1,
+                            metavar='timestamp')
+
+        t = 'Print only notes first saved before the time given.'
+        parser.add_argument('--created-before', help=t, nargs=1,
+                            metavar='timestamp')
+
+        t = ('Also run the query on another notebook (database file), given'
+             ' as name=path. The notes found there are shown with the'
+             ' notebook\'s name in front of their paths, as "name:path".'
+             ' The notebooks are searched at the same time.')
+        parser.add_argument('--notebook', help=t, action=a, nargs='+',
+                            metavar='name=path')
+
         t = 'Give this query a name and save it for future re-use.'
         parser.add_argument('-n', '--name-query', help=t, nargs=1,
                             metavar='name')
@@ -163,9 +640,153 @@ class Script(Object):
         t = 'List the names of all saved queries in alphabetical order.'
         parser.add_argument('-l', '--list-queries', help=t, action='store_true')
 
-        t = 'Save notes from files into the database.'
+        t = ('List all tags (optionally only those beginning with "prefix"),'
+             ' each with the number of notes using it.')
+        parser.add_argument('--list-tags', help=t, nargs='?', const='',
+                            metavar='prefix')
+
+        t = ('List all field names (optionally only those beginning with'
+             ' "prefix"), each with the number of times it is used.')
+        parser.add_argument('--list-fields', help=t, nargs='?', const='',
+                            metavar='prefix')
+
+        t = ('List all values of the field given (optionally only those'
+             ' beginning with "prefix"), numbers first, each with the number'
+             ' of notes using it.')
+        parser.add_argument('--list-values-for', help=t, nargs='+',
+                            metavar=('field', 'prefix'))
+
+        t = ('Print all notepaths (or only those at or beneath "path") as an'
+             ' outline, one path segment per line.')
+        parser.add_argument('--outline', help=t, nargs='?', const='',
+                            metavar='path')
+
+        t = ('List the children of "path" (or the top-level paths), each with'
+             ' the number of notes at or beneath it.')
+        parser.add_argument('--list-children', help=t, nargs='?', const='',
+                            metavar='path')
+
+        t = 'Print the number of notes beneath "path" (or in the database).'
+        parser.add_argument('--count-notes', help=t, nargs='?', const='',
+                            metavar='path')
+
+        t = ('List the old versions of the note with this path, with the'
+             ' time each was archived.')
+        parser.add_argument('--history', help=t, nargs=1, metavar='path')
+
+        t = ('Replace the note with this path with its most recently archived'
+             ' version (or the version given by --at).')
+        parser.add_argument('--restore', help=t, nargs=1, metavar='path')
+
+        t = ('With --restore: restore the version archived at this time (or'
+             ' the last one archived before it), e.g. "2020-03-01 14:30".')
+        parser.add_argument('--at', help=t, nargs=1, metavar='timestamp')
+
+        t = ('Append old versions of notes (of all notes, or only the note'
+             ' with the path given) to a file in archive format.')
+        parser.add_argument('--export-history', help=t, nargs='+',
+                            metavar=('file', 'path'))
+
+        t = ('Rotate the archive file (by default, ' + ARCHIVE_FILENAME + ')'
+             ' into a dated segment, dropping repeated versions of notes;'
+             ' compress old segments; and update the segment index.')
+        parser.add_argument('--maintain-archive', help=t, nargs='?',
+                            const=ARCHIVE_FILENAME, metavar='file')
+
+        t = ('With --maintain-archive: compress segments older than this many'
+             ' days (default: ' + str(COMPRESS_AFTER_DAYS) + ').')
+        parser.add_argument('--compress-after', help=t, type=float,
+                            default=COMPRESS_AFTER_DAYS, metavar='days')
+
+        t = ('Print the versions of the note with this path kept in the'
+             ' archive file (by default, ' + ARCHIVE_FILENAME + ') and its'
+             ' segments.')
+        parser.add_argument('--read-archive', help=t, nargs='+',
+                            metavar=('path', 'file'))
+
+        t = ('Move the note at "old" and every note beneath it to "new"'
+             ' (e.g. "projects/old/a" becomes "archive/2019/a"), merging any'
+             ' note into a note already at its new path.')
+        parser.add_argument('--move', help=t, nargs=2, metavar=('old', 'new'))
+
+        t = ('Add these tags to every note found by the query (e.g.'
+             ' -p recipes --add-tag vegetarian).')
+        parser.add_argument('--add-tag', help=t, action=a, nargs='+',
+                            metavar='word')
+
+        t = 'Remove these tags from every note found by the query.'
+        parser.add_argument('--remove-tag', help=t, action=a, nargs='+',
+                            metavar='word')
+
+        t = ('Set field X to Y in every note found by the query, replacing'
+             ' any value X had.')
+        parser.add_argument('--set-field', help=t, action=a, nargs='+',
+                            metavar='X=Y')
+
+        t = ('Delete every note found by the query. (Old versions are kept'
+             ' in the history and can be restored with --restore.)')
+        parser.add_argument('--delete', help=t, action='store_true')
+
+        t = ('With --add-tag, --remove-tag, --set-field or --delete, only'
+             ' count the notes that would change.')
+        parser.add_argument('--dry-run', help=t, action='store_true')
+
+        t = ('Print every note changed (saved, merged, moved, or deleted)'
+             ' after the change numbered "seq", as it is now, so that a copy'
+             ' of the notes kept elsewhere can be brought up to date. Deleted'
+             ' notes are printed with a delete directive. Use 0 to get every'
+             ' note.')
+        parser.add_argument('--changes-since', help=t, type=int,
+                            metavar='seq')
+
+        t = ('Output format for --changes-since: notepath text files'
+             ' (nptext, the default) or JSON Lines (jsonl).')
+        parser.add_argument('--format', help=t, choices=['nptext', 'jsonl'],
+                            default='nptext')
+
+        t = ('Remove changes up to and including the one numbered "seq"'
+             ' from the change log.')
+        parser.add_argument('--truncate-changes', help=t, type=int,
+                            metavar='seq')
+
+        t = ('Remove all but the latest change to each note from the change'
+             ' log. (--changes-since gives the same notes afterward.)')
+        parser.add_argument('--compact-changes', help=t, action='store_true')
+
+        t = ('Save notes from files into the database. Use "-" to read'
+             ' notes from standard input.')
         parser.add_argument('-s', '--save-notes', help=t, action=a, nargs='+',
                             metavar='path')
+
+        t = ('Write every note in the database to a file (or "-" for'
+             ' standard output), sorted by notepath. If the file name ends'
+             ' with ".gz", the file is compressed.')
+        parser.add_argument('--dump', help=t, nargs=1, metavar='file')
+
+        t = ('Load the notes in a file written by --dump into a new (empty)'
+             ' database.')
+        parser.add_argument('--restore-dump', help=t, nargs=1, metavar='file')
+
+        t = ('Save notes from very large files into the database, committing'
+             ' them in batches (see --batch-size) and recording how far the'
+             ' import got, so that if it is interrupted, running it again'
+             ' resumes where it stopped. Some indexes are dropped during the'
+             ' import and rebuilt at the end.')
+        parser.add_argument('--bulk-import', help=t, action=a, nargs='+',
+                            metavar='path')
+
+        t = ('With -s or --bulk-import, commit the notes saved after every N'
+             ' notes (by'
+             ' default, ' + str(DEFAULT_BATCH_SIZE) + ').')
+        parser.add_argument('--batch-size', help=t, type=int,
+                            default=DEFAULT_BATCH_SIZE, metavar='N')
+
+        t = ('Store the text of each note saved from now on compressed if'
+             ' it is longer than N characters (by default, '
+             + str(DEFAULT_COMPRESS_OVER) + '), or never, if N is 0.'
+             ' The setting is kept in the database.')
+        parser.add_argument('--compress-over', help=t, type=int,
+                            metavar='N')
         
         t = 'Remove named query from the database.'
         parser.add_argument('-x', '--remove-query', help=t, nargs=1,
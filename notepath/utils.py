@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
-# The function annotations in this module require Python 3.5 or higher.
+# Notepath requires Python 3.8 or higher.
 
 import datetime
 import os
+import re
 import time
 
 def _timestamp(pattern, when: float = None) -> str:
@@ -22,6 +23,29 @@ def timestamp_for_logging(when: float = None) -> str:
 def timestamp_for_journal(when: float = None) -> str:
     return _timestamp('%A %d %B %Y at %I:%M %p', when)
 
+def parse_timestamp(timestamp: str) -> float:
+    '''Convert a date and time to seconds since the epoch (local time).
+    
+    This accepts the timestamps written by timestamp_for_logging(), as well
+    as ISO-style dates with or without a time ("2020-03-01", "2020-03-01
+    14:30", "2020-03-01T14:30:15.25"). Raises ValueError if the timestamp
+    can't be read.
+    '''
+    patterns = ['%Y-%m-%d %a %H:%M:%S.%f',
+                '%Y-%m-%d %H:%M:%S.%f',
+                '%Y-%m-%d %H:%M:%S',
+                '%Y-%m-%d %H:%M',
+                '%Y-%m-%d']
+    text = re.sub(r'(\d)T(\d)', r'\1 \2', timestamp)
+    text = ' '.join(text.split())
+    for pattern in patterns:
+        try:
+            date_object = datetime.datetime.strptime(text, pattern)
+        except ValueError:
+            continue
+        return date_object.timestamp()
+    raise ValueError('cannot read date and time: ' + timestamp)
+
 def format_filesize(num: int, suffix='B') -> str:
     for unit in ['','K','M','G','T','P','E','Z']:
         if abs(num) < 1024.0:
@@ -1,27 +1,41 @@
 #!/usr/bin/env python3
 
+import asyncio
 import configparser
+import gzip
+import io
 import itertools
+import json
 import os
+import re
+import shutil
+import sqlite3
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 import unittest
 
 from sqlite3 import IntegrityError
 from typing import Dict, List, Tuple, Union
 
 p = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
-p = os.path.join(p, 'notepath')
-if p not in sys.path:
-    sys.path.append(p)
+for d in ['notepath', 'benchmarks']:
+    if os.path.join(p, d) not in sys.path:
+        sys.path.append(os.path.join(p, d))
 
-from basics import get_data_path, NotePath, sort_notepaths
-from database import Database, DatabaseError
-from note import Note, get_notes_from_file
+from archiver import Archiver
+from asyncdatabase import AsyncDatabase
+from basics import NotePath, sort_notepaths
+from corpus import Corpus
+from database import Database, DatabaseError, DEFAULT_COMPRESS_OVER
+from exporter import Exporter
+from note import Note, get_notes_from_file, read_notes
+from notebooks import NotebookError, Notebooks, parse_notebook_arg
+from profiler import normalize_sql, Profiler
 from querybuilder import QueryBuilder
 
-DATABASE_PATH = get_data_path('test.sqlite3')
-ARCHIVE_PATH  = get_data_path('test_archive.nparch')
-
 class TestSearch():
     def __init__(self):
         self.path_terms = []
@@ -71,9 +85,45 @@ class TestDataLoader():
         return searches
 
 class Test_Database(unittest.TestCase):
+    def setUp(self) -> None:
+        # Each test gets a directory of its own for its database, archive,
+        # and other files, so that no test sees another's notes, and tests
+        # can run in any order (or at the same time, in several processes).
+        # A test that opens its database only once keeps it in memory.
+        self.dirpath = tempfile.mkdtemp(prefix='notepath-test-')
+        self.db_path = self._path('test.sqlite3')
+        self.archive_path = self._path('test_archive.nparch')
+        self.export_path = self._path('test_export.nparch')
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.dirpath)
+
+    def _path(self, filename: str) -> str:
+        return os.path.join(self.dirpath, filename)
+
+    def _copy_script(self) -> str:
+        '''Copy Notepath into the test's folder; return the script's path.
+        
+        (The script keeps its database in the data folder next to it, so a
+        copy of it run in a subprocess has a database of its own.)
+        '''
+        copy_path = self._path('script')
+        if not os.path.exists(copy_path):
+            shutil.copytree(os.path.join(p, 'notepath'),
+                            os.path.join(copy_path, 'notepath'),
+                            ignore=shutil.ignore_patterns('__pycache__'))
+            shutil.copy(os.path.join(p, 'notepath.py'), copy_path)
+        return os.path.join(copy_path, 'notepath.py')
+
+    def _open_test_database(self) -> Database:
+        '''Return a database in memory holding the notes in test_1.nptext.'''
+        db = Database(':memory:', self.archive_path)
+        db.save_notes(TestDataLoader().load_notes('test_1'))
+        return db
+
     def _delete_archive_file(self) -> None:
-        if os.path.exists(ARCHIVE_PATH):
-            os.remove(ARCHIVE_PATH)
+        if os.path.exists(self.archive_path):
+            os.remove(self.archive_path)
     
     def _save_and_verify_note(self,
                               db: Database,
@@ -93,7 +143,7 @@ class Test_Database(unittest.TestCase):
             self.assertTrue(notes[note.path] == note)
 
     def _verify_note_archived(self, old_note: Note) -> None:
-        notes = get_notes_from_file(ARCHIVE_PATH)
+        notes = get_notes_from_file(self.archive_path)
         archived_note = notes[old_note.path]
         self.assertEqual(archived_note.textlines, old_note.textlines)
         self.assertEqual(archived_note.tags, old_note.tags)
@@ -121,13 +171,10 @@ class Test_Database(unittest.TestCase):
 
     def test_01_set_up_database(self):
         '''Verify notes retrieved == notes saved.'''
-        if os.path.exists(DATABASE_PATH):
-            os.remove(DATABASE_PATH)
-        
         loader = TestDataLoader()
         loaded_notes = loader.load_notes('test_1')
         
-        db = Database(DATABASE_PATH, ARCHIVE_PATH)
+        db = Database(':memory:', self.archive_path)
         db.save_notes(loaded_notes)
         
         for notepath in loaded_notes:
@@ -139,7 +186,7 @@ class Test_Database(unittest.TestCase):
     def test_02_ini_searches(self):
         loader = TestDataLoader()
         searches = loader.load_searches('test_1')
-        db = Database(DATABASE_PATH, ARCHIVE_PATH)
+        db = self._open_test_database()
         qb = QueryBuilder()
         for search in searches:
             expected_paths = sort_notepaths(search.matches)
@@ -155,7 +202,7 @@ class Test_Database(unittest.TestCase):
         notepath = list(loaded_notes.keys())[0]
         loaded_note = loaded_notes[notepath]
 
-        db = Database(DATABASE_PATH, ARCHIVE_PATH)
+        db = self._open_test_database()
         notetext = 'This note has a duplicate notepath.'
         notetag = 'test'
 
@@ -168,9 +215,11 @@ class Test_Database(unittest.TestCase):
         self.assertRaises(IntegrityError, cursor.execute,
                           sql, (notepath, notetext))
         cursor.close()
+
+        db.close()
     
     def test_04_edit_and_resave_notes(self) -> None:
-        db = Database(DATABASE_PATH, ARCHIVE_PATH)
+        db = Database(':memory:', self.archive_path)
         note = Note()
         
         initial_path   = 'some/path'
@@ -255,7 +304,1231 @@ class Test_Database(unittest.TestCase):
         notes = db.get_notes_by_path(note.path)
         self.assertEqual(len(notes), 0)
         self._verify_note_archived(old_note)
-    
+
+    def test_05_tag_and_field_counts(self) -> None:
+        db = self._open_test_database()
+        cursor = db.connection.cursor()
+
+        # The maintained counts must agree with counting the tags table.
+        sql = ('SELECT name, COUNT(*) FROM tags WHERE value IS NULL'
+               ' GROUP BY name;')
+        cursor.execute(sql)
+        expected = dict(cursor.fetchall())
+        self.assertEqual(dict(db.get_tag_counts()), expected)
+
+        sql = ("SELECT value, COUNT(*) FROM tags WHERE name = 'weight'"
+               " GROUP BY value;")
+        cursor.execute(sql)
+        expected = dict(cursor.fetchall())
+        self.assertEqual(dict(db.get_value_counts('weight')), expected)
+        cursor.close()
+
+        # Numbers sort before text, and prefixes filter the lists.
+        note = Note()
+        note.path = 'counts/test'
+        note.textlines = ['Text.']
+        note.tags = ['worry']
+        note.fields = [('weight', 'heavy')]
+        db.save_notes({note.path: note})
+        values = [value for value, _ in db.get_value_counts('weight')]
+        self.assertEqual(values[-1], 'heavy')
+        tags = [tag for tag, _ in db.get_tag_counts('wor')]
+        self.assertEqual(tags, ['work', 'worry'])
+        fields = dict(db.get_field_counts('we'))
+        self.assertEqual(list(fields.keys()), ['weight'])
+
+        # Deleting the note removes its tag from the counts.
+        note.directive = 'delete'
+        db.save_notes({note.path: note})
+        tags = [tag for tag, _ in db.get_tag_counts('wor')]
+        self.assertEqual(tags, ['work'])
+
+    def test_06_outline(self) -> None:
+        db = self._open_test_database()
+        cursor = db.connection.cursor()
+        cursor.execute('SELECT path FROM notes;')
+        paths = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+
+        # Count the notes under each top-level segment the slow way.
+        expected = {}
+        for path in paths:
+            top = path.split('/')[0]
+            expected[top] = expected.get(top, 0) + 1
+        self.assertEqual(dict(db.get_children()), expected)
+        self.assertEqual(db.count_notes_under(), len(paths))
+        under_fall = len([p for p in paths if p.startswith('fall/')])
+        self.assertEqual(db.count_notes_under('fall'), under_fall)
+
+        # Renaming a note moves it in the outline.
+        note = Note()
+        note.path = 'outline/a/b'
+        note.textlines = ['Text.']
+        db.save_notes({note.path: note})
+        self.assertEqual(db.get_outline('outline'),
+                         [(0, 'outline'), (1, 'a'), (2, 'b')])
+        note.directive = 'rename outline/c'
+        db.save_notes({note.path: note})
+        self.assertEqual(db.get_children('outline'), [('outline/c', 1)])
+        self.assertEqual(db.get_outline('outline/a'), [])
+
+        note.path = 'outline/c'
+        note.directive = 'delete'
+        db.save_notes({note.path: note})
+        self.assertEqual(db.get_outline('outline'), [])
+
+    def test_07_history_and_restore(self) -> None:
+        db = Database(':memory:', self.archive_path)
+        note = Note()
+        note.path = 'history/test'
+        note.tags = ['first']
+        for text in ['Version one.', 'Version two.', 'Version three.']:
+            note.textlines = [text]
+            note.directive = 'replace'
+            db.save_notes({note.path: note})
+        
+        # Two old versions should have been archived, oldest first.
+        history = db.get_history(note.path)
+        self.assertEqual([h[1] for h in history], ['replace', 'replace'])
+        self.assertEqual(db.get_version(note.path).get_text(),
+                         'Version two.')
+        
+        # Restore the first version by the time it was archived.
+        first_archived = history[0][0]
+        self.assertTrue(db.restore_note(note.path, first_archived))
+        restored = db.get_notes_by_path(note.path)[note.path]
+        self.assertEqual(restored.get_text(), 'Version one.')
+        self.assertEqual(restored.tags, ['first'])
+        self.assertEqual(db.get_history(note.path)[-1][1], 'restore')
+        self.assertFalse(db.restore_note('history/none'))
+
+        # The history can still be exported in archive format.
+        db.export_history(self.export_path, note.path)
+        with open(self.export_path, encoding='utf-8') as file:
+            exported = file.read()
+        self.assertEqual(exported.count('{archive_date}'), 3)
+        self.assertTrue('Version three.' in exported)
+
+    def test_08_history_deltas(self) -> None:
+        db = Database(':memory:', self.archive_path)
+        texts = []
+        for i in range(40):
+            # Mostly merges that add a line, with an occasional edit.
+            note = Note()
+            note.path = 'history/jottings'
+            note.textlines = ['Line ' + str(i) + '.\n']
+            note.directive = 'merge'
+            if i % 10 == 9:
+                old = db.get_notes_by_path(note.path)[note.path]
+                old.textlines[0] = 'Edited line.\n'
+                note = old
+            db.save_notes({note.path: note})
+            texts.append(db.get_notes_by_path(note.path)[note.path].get_text())
+        
+        # Every version but the last is an old version; each should be
+        # rebuilt exactly, and all but the snapshots should be deltas.
+        cursor = db.connection.cursor()
+        sql = ('SELECT id, delta FROM history WHERE path = ?'
+               ' ORDER BY archived_at, id;')
+        cursor.execute(sql, (note.path,))
+        rows = cursor.fetchall()
+        cursor.close()
+        self.assertEqual(len(rows), len(texts) - 1)
+        for (history_id, _), text in zip(rows, texts):
+            self.assertEqual(db._get_history_text(history_id), text)
+        self.assertEqual(sum(delta for _, delta in rows), len(rows) - 3)
+
+    def test_09_archive_maintenance(self) -> None:
+        maintenance_dir = self._path('maintenance')
+        archiver = Archiver(os.path.join(maintenance_dir, 'archive.nparch'))
+        a, b = Note(), Note()
+        a.path, a.textlines = 'maint/a', ['Same text.']
+        b.path, b.textlines = 'maint/b', ['Other text.\n']
+        versions = [(1.0, a), (2.0, b), (3.0, a)]
+        archiver.append_versions(versions)
+        
+        # Rotate without compressing: the repeated version of a is dropped.
+        archiver.maintain(days=1)
+        self.assertFalse(os.path.exists(archiver.path))
+        self.assertEqual(len(archiver.read_versions('maint/a')), 1)
+        
+        # Archive a changed version, then rotate and compress everything.
+        a.textlines = ['Changed text.']
+        archiver.append_versions([(4.0, a)])
+        archiver.maintain(days=0)
+        segments = os.listdir(maintenance_dir)
+        self.assertEqual(len([s for s in segments if s.endswith('.gz')]), 2)
+        self.assertFalse([s for s in segments if s.endswith('.nparch')])
+        texts = [n.get_text() for n in archiver.read_versions('maint/a')]
+        self.assertEqual(texts, ['Same text.\n', 'Changed text.\n'])
+        texts = [n.get_text() for n in archiver.read_versions('maint/b')]
+        self.assertEqual(texts, ['Other text.\n'])
+
+    def test_10_as_of_queries(self) -> None:
+        db = Database(':memory:', self.archive_path)
+        qb = QueryBuilder()
+
+        def find(tags: List[str], when: float) -> List[NotePath]:
+            sql = qb.build_sql_from_lists([], [], tags, [], when)
+            notes = db._get_notes(sql)
+            sql = qb.build_history_sql_from_lists([], [], tags, [], when)
+            notes.update(db._get_notes(sql, 'history', 'history_tags'))
+            return sorted(notes.keys())
+
+        note = Note()
+        note.path = 'as of/task'
+        note.textlines = ['Do this now.']
+        note.tags = ['as-of-urgent']
+        before_saved = time.time()
+        time.sleep(0.01)
+        db.save_notes({note.path: note})
+        time.sleep(0.01)
+        while_urgent = time.time()
+        time.sleep(0.01)
+        note.tags = ['as-of-done']
+        note.directive = 'replace'
+        db.save_notes({note.path: note})
+        time.sleep(0.01)
+        while_done = time.time()
+        time.sleep(0.01)
+        note.directive = 'delete'
+        db.save_notes({note.path: note})
+
+        self.assertEqual(find(['as-of-urgent'], before_saved), [])
+        self.assertEqual(find(['as-of-urgent'], while_urgent), [note.path])
+        self.assertEqual(find(['as-of-urgent'], while_done), [])
+        self.assertEqual(find(['as-of-done'], while_done), [note.path])
+        self.assertEqual(find(['as-of-done'], time.time()), [])
+
+    def test_11_merge_fast_path(self) -> None:
+        # Without an archive file, merges are done in place; with one, they
+        # are done the long way. Both should give the same notes and the
+        # same old versions.
+        fast_db = Database(self.db_path)
+        slow_db = Database(self.db_path, self.archive_path)
+        results = []
+        for db, path in [(fast_db, 'merge/fast'), (slow_db, 'merge/slow')]:
+            for i in range(20):
+                note = Note()
+                note.path = path
+                note.textlines = ['Line ' + str(i) + '.\n']
+                note.tags = ['tag' + str(i % 3)]
+                note.fields = [('count', float(i % 4))]
+                db.save_notes({note.path: note})
+            
+            note = db.get_notes_by_path(path)[path]
+            cursor = db.connection.cursor()
+            sql = 'SELECT id FROM history WHERE path = ? ORDER BY id;'
+            cursor.execute(sql, (path,))
+            versions = [db._get_history_text(row[0]) for row in cursor]
+            cursor.close()
+            results.append((note.textlines, sorted(note.tags),
+                            sorted(note.fields), versions))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(len(results[0][3]), 19)
+
+    def test_12_move_subtree(self) -> None:
+        db = Database(':memory:', self.archive_path)
+        notes = {}
+        for path in ['move/old', 'move/old/a', 'move/old/b', 'move/older',
+                     'move/new/b']:
+            note = Note()
+            note.path = path
+            note.textlines = ['Text of ' + path + '.\n']
+            notes[path] = note
+        db.save_notes(notes)
+
+        self.assertEqual(db.move_notes('move/old', 'move/new'), 3)
+        self.assertEqual(db.get_notes_by_path(['move/old', 'move/old/a',
+                                               'move/old/b']), {})
+        moved = db.get_notes_by_path(['move/new', 'move/new/a', 'move/new/b',
+                                      'move/older'])
+        self.assertEqual(len(moved), 4)
+        text = moved['move/new/b'].get_text()
+        self.assertTrue('move/old/b' in text and 'move/new/b' in text)
+        self.assertEqual(db.get_children('move/new'),
+                         [('move/new/a', 1), ('move/new/b', 1)])
+        operations = [h[1] for h in db.get_history('move/old/a')]
+        self.assertEqual(operations, ['move'])
+
+        # A subtree can be moved beneath itself.
+        self.assertEqual(db.move_notes('move/new', 'move/new/x'), 3)
+        paths = db.get_notes_by_path(['move/new/x', 'move/new/x/a',
+                                      'move/new/x/b'])
+        self.assertEqual(len(paths), 3)
+        self.assertEqual(db.count_notes_under('move'), 4)
+
+    def test_13_change_notes_by_query(self) -> None:
+        db = Database(':memory:')
+        notes = {}
+        for i in range(5):
+            note = Note()
+            note.path = 'bulk/' + str(i)
+            note.tags = ['old'] if i < 3 else []
+            note.fields = [('rating', 1.0)]
+            note.textlines = ['Bulk note ' + str(i) + '.\n']
+            notes[note.path] = note
+        db.save_notes(notes)
+        sql = QueryBuilder().build_sql_from_lists(['^bulk'], [], [], [])
+
+        # A dry run only counts; notes already tagged are not counted.
+        self.assertEqual(db.change_notes(sql, add_tags=['old'],
+                                         dry_run=True), 2)
+        self.assertFalse(db.get_notes_by_path(['bulk/4'])['bulk/4'].tags)
+
+        count = db.change_notes(sql, add_tags=['bulked'], remove_tags=['old'],
+                                set_fields=[('rating', 5.0)])
+        self.assertEqual(count, 5)
+        changed = db.get_notes_by_path(['bulk/' + str(i) for i in range(5)])
+        for note in changed.values():
+            self.assertEqual(note.tags, ['bulked'])
+            self.assertEqual(note.fields, [('rating', 5.0)])
+            self.assertEqual(note.get_text(), 'Bulk note ' + note.path[-1]
+                             + '.\n')
+        self.assertEqual(db.change_notes(sql, add_tags=['bulked']), 0)
+        self.assertEqual(db.get_tag_counts('bulked'), [('bulked', 5)])
+
+        # The old tags and text are still in the history.
+        old = db.get_version('bulk/0', db.get_history('bulk/0')[-1][0])
+        self.assertEqual(old.tags, ['old'])
+        self.assertEqual(old.get_text(), 'Bulk note 0.\n')
+
+        sql = QueryBuilder().build_sql_from_lists(['^bulk'], [], [],
+                                                  ['rating=5'])
+        self.assertEqual(db.change_notes(sql, delete=True), 5)
+        self.assertEqual(db.count_notes_under('bulk'), 0)
+        self.assertRaises(DatabaseError, db.change_notes, '', delete=True)
+        db.close()
+
+    def test_14_created_and_modified_times(self) -> None:
+        db = Database(':memory:')
+        notes = {}
+        for i in range(3):
+            note = Note()
+            note.path = 'timed/' + str(i)
+            note.textlines = ['Timed note ' + str(i) + '.\n']
+            notes[note.path] = note
+        db.save_notes(notes)
+        cursor = db.connection.cursor()
+        cursor.execute("UPDATE notes SET created_at = 1000.0,"
+                       " modified_at = 1000.0 WHERE path LIKE 'timed/%';")
+        db.connection.commit()
+
+        # Replacing and merging keep the time the note was created.
+        for path, directive in [('timed/0', 'replace'), ('timed/1', '')]:
+            note = Note()
+            note.path = path
+            note.directive = directive
+            note.textlines = ['Changed.\n']
+            db.save_notes({path: note})
+        cursor.execute("SELECT path, created_at, modified_at FROM notes"
+                       " WHERE path LIKE 'timed/%' ORDER BY path;")
+        rows = cursor.fetchall()
+        self.assertEqual([row[1] for row in rows], [1000.0] * 3)
+        self.assertTrue(rows[0][2] > 1000.0 and rows[1][2] > 1000.0)
+        self.assertEqual(rows[2][2], 1000.0)
+
+        qb = QueryBuilder()
+        sql = qb.build_sql_from_lists(['^timed'], [], [], [],
+                                      modified_since=2000.0)
+        self.assertEqual(sorted(db._get_notes(sql)), ['timed/0', 'timed/1'])
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+        plan = ' '.join(str(row[-1]) for row in cursor.fetchall())
+        self.assertTrue('modified_index' in plan)
+
+        sql = qb.build_sql_from_lists(['^timed'], [], [], [],
+                                      created_before=1000.5)
+        self.assertEqual(len(db._get_notes(sql)), 3)
+        sql = qb.build_sql_from_lists([], [], [], [], created_before=999.0)
+        self.assertEqual(db._get_notes(sql), {})
+        cursor.close()
+        db.close()
+
+    def test_15_change_log(self) -> None:
+        db = Database(':memory:')
+        start = db.get_last_change()
+        notes = {}
+        for path in ['feed/a', 'feed/b', 'feed/c']:
+            note = Note()
+            note.path = path
+            note.textlines = ['Feed note.\n']
+            notes[path] = note
+        db.save_notes(notes)
+        self.assertEqual(db.get_last_change(), start + 3)
+        middle = db.get_last_change()
+
+        note = Note()
+        note.path = 'feed/a'
+        note.textlines = ['More.\n']
+        note.tags = ['more']
+        db.save_notes({'feed/a': note})
+        # (A merge is one change, however much it adds.)
+        self.assertEqual(db.get_last_change(), middle + 1)
+        note = Note()
+        note.path = 'feed/b'
+        note.directive = 'delete'
+        db.save_notes({'feed/b': note})
+        db.move_notes('feed/c', 'feed/d')
+
+        changes = list(db.get_changes_since(middle))
+        self.assertEqual([(path, bool(note)) for seq, path, note in changes],
+                         [('feed/a', True), ('feed/b', False),
+                          ('feed/c', False), ('feed/d', True)])
+        self.assertTrue('More.' in changes[0][2].get_text())
+        self.assertEqual(changes[-1][0], db.get_last_change())
+
+        # Compacting and truncating keep what is needed to catch up.
+        changes = [(seq, path) for seq, path, note in changes]
+        self.assertTrue(db.compact_changes() > 0)
+        self.assertEqual([(seq, path) for seq, path, note
+                          in db.get_changes_since(middle)], changes)
+        db.truncate_changes(middle)
+        self.assertEqual([(seq, path) for seq, path, note
+                          in db.get_changes_since(0)], changes)
+        self.assertEqual(db.get_last_change(), changes[-1][0])
+        db.close()
+
+    def test_16_stale_notes_are_merged(self) -> None:
+        db = Database(':memory:')
+        note = Note()
+        note.path = 'versioned'
+        note.textlines = ['First.\n']
+        self.assertEqual(db.save_notes({'versioned': note}), [])
+
+        # Two copies are exported; the version goes into the directive.
+        first = db.get_notes_by_path('versioned')['versioned']
+        self.assertEqual(first.version, 1)
+        exported = str(first)
+        self.assertTrue('\\ @replace 1\n' in exported)
+        second = Note()
+        for line in exported.splitlines(keepends=True):
+            second._add_line(line)
+        self.assertEqual((second.directive, second.version), ('replace', 1))
+
+        first.textlines = ['First, edited.\n']
+        self.assertEqual(db.save_notes({'versioned': first}), [])
+        second.textlines = ['First, edited differently.\n']
+        self.assertEqual(db.save_notes({'versioned': second}), ['versioned'])
+        note = db.get_notes_by_path('versioned')['versioned']
+        text = note.get_text()
+        self.assertTrue('edited.' in text and 'edited differently.' in text)
+        self.assertEqual(note.version, 3)
+
+        # A current copy replaces the note as usual.
+        note.textlines = ['Clean.\n']
+        self.assertEqual(db.save_notes({'versioned': note}), [])
+        note = db.get_notes_by_path('versioned')['versioned']
+        self.assertEqual((note.get_text(), note.version), ('Clean.\n', 4))
+
+        # A stale delete is skipped: the newer note is left as it is.
+        stale = note.clone()
+        stale.directive = 'delete'
+        note.textlines = ['Edited by A.\n']
+        self.assertEqual(db.save_notes({'versioned': note}), [])
+        self.assertEqual(db.save_notes({'versioned': stale}), ['versioned'])
+        note = db.get_notes_by_path('versioned')['versioned']
+        self.assertEqual((note.get_text(), note.version),
+                         ('Edited by A.\n', 5))
+
+        # A current delete deletes the note as usual.
+        note.directive = 'delete'
+        self.assertEqual(db.save_notes({'versioned': note}), [])
+        self.assertEqual(db.get_notes_by_path('versioned'), {})
+        db.close()
+
+    def test_17_save_note_stream(self) -> None:
+        db = Database(':memory:')
+        lines = []
+        for i in range(25):
+            lines.append('\\ stream/' + str(i % 20) + '\n\n')
+            lines.append('Streamed note ' + str(i) + '.\n\n')
+        stream = io.StringIO(''.join(lines))
+        count, stale = db.save_note_stream(read_notes(stream), batch_size=7)
+        self.assertEqual((count, stale), (25, []))
+        self.assertEqual(db.count_notes_under('stream'), 20)
+
+        # Notes whose paths came up twice were merged in the database.
+        text = db.get_notes_by_path('stream/3')['stream/3'].get_text()
+        self.assertTrue('note 3.' in text and 'note 23.' in text)
+
+        # A batch that fails is rolled back; the batches before it stay.
+        notes = [Note(), Note(), Note()]
+        for i, note in enumerate(notes):
+            note.path = 'stream/new/' + str(i)
+        notes[2].path = 'stream/0'
+        notes[2].directive = 'add'
+        self.assertRaises(DatabaseError, db.save_note_stream, notes, 2)
+        self.assertEqual(db.count_notes_under('stream/new'), 2)
+
+        note = Note()
+        rest = note.set_from_string(''.join(lines[:4]))
+        self.assertEqual(note.path, 'stream/0')
+        self.assertEqual(rest, ''.join(lines[2:4]))
+        db.close()
+
+    def test_18_resumable_bulk_import(self) -> None:
+        db = Database(':memory:')
+        note = Note()
+        note.path = 'bulk_import/12'
+        db.save_notes({note.path: note})
+
+        # Note 12 cannot be added, so the import stops in its batch.
+        with open(self.export_path, mode='w', encoding='utf-8') as file:
+            file.write('Temporary text.\n\n')
+            for i in range(30):
+                file.write('\\ bulk_import/' + str(i) + '\n')
+                if i == 12:
+                    file.write('\\ @add\n')
+                file.write('\nImported note ' + str(i) + '.\n\n')
+        def count_indexes() -> int:
+            cursor = db.connection.cursor()
+            cursor.execute("SELECT COUNT(*) FROM sqlite_master"
+                           " WHERE type = 'index' AND name IN"
+                           " ('path_index', 'name_index', 'value_index',"
+                           " 'modified_index');")
+            count = cursor.fetchone()[0]
+            cursor.close()
+            return count
+
+        self.assertRaises(DatabaseError, db.bulk_import, self.export_path, 5)
+        checkpoint = db.get_import_checkpoint(self.export_path)
+        self.assertEqual(checkpoint['path'], 'bulk_import/9')
+        self.assertEqual(db.count_notes_under('bulk_import'), 11)
+
+        # The indexes dropped for the import are back, even so.
+        self.assertEqual(count_indexes(), 4)
+
+        # Running it again resumes with the batch that failed.
+        note.directive = 'delete'
+        db.save_notes({note.path: note})
+        self.assertEqual(db.bulk_import(self.export_path, 5), (20, []))
+        self.assertEqual(db.count_notes_under('bulk_import'), 30)
+        self.assertEqual(db.get_import_checkpoint(self.export_path), None)
+        self.assertEqual(count_indexes(), 4)
+        db.close()
+
+    def test_19_dump_and_load(self) -> None:
+        db = self._open_test_database()
+        # (Texts that notepath format, read back, would not give exactly.)
+        for i, text in enumerate(['no newline', '\n\nblank lines first\n',
+                                  'a line like a header:\n\\ not a path\n',
+                                  'carriage\r\nreturns\r\n', '  ']):
+            note = Note()
+            note.path = 'dump/odd text/' + str(i)
+            note.textlines = [text]
+            db.save_notes({note.path: note})
+        dump_path = self.export_path + '.gz'
+        count = db.dump(dump_path)
+        cursor = db.connection.cursor()
+        cursor.execute("SELECT path, text, version, created_at FROM notes"
+                       " WHERE path != '';")
+        expected = sorted(cursor.fetchall())
+        cursor.close()
+        self.assertEqual(count, len(expected))
+        paths = db.get_notes_by_path([row[0] for row in expected])
+        outline = db.get_outline('fall')
+        self.assertTrue(outline)
+        db.close()
+
+        # The dump is in sort_notepaths() order.
+        with gzip.open(dump_path, mode='rt', encoding='utf-8') as file:
+            dumped = [note.path for note in read_notes(file)]
+        self.assertEqual(dumped, sort_notepaths(list(dumped)))
+
+        restored = Database(self._path('test_restore.sqlite3'))
+        self.assertEqual(restored.load_dump(dump_path), count)
+        cursor = restored.connection.cursor()
+        cursor.execute('SELECT path, text, version, created_at FROM notes;')
+        rows = sorted(cursor.fetchall())
+        cursor.close()
+        # The texts are exactly as they were, byte for byte.
+        self.assertEqual([row[:3] for row in rows],
+                         [row[:3] for row in expected])
+        self.assertEqual([row[3] for row in rows],
+                         [row[3] for row in expected])
+        notes = restored.get_notes_by_path(list(paths))
+        self.assertEqual({path: (note.tags, note.fields)
+                          for path, note in notes.items()},
+                         {path: (note.tags, note.fields)
+                          for path, note in paths.items()})
+        self.assertEqual(restored.get_outline('fall'), outline)
+        self.assertEqual(restored.get_last_change(), count)
+        self.assertRaises(DatabaseError, restored.load_dump, dump_path)
+        restored.close()
+
+    def test_20_write_to_files(self) -> None:
+        db = self._open_test_database()
+        cursor = db.connection.cursor()
+        cursor.execute("SELECT path FROM notes WHERE path != '';")
+        notes = db.get_notes_by_path([row[0] for row in cursor.fetchall()])
+        cursor.close()
+        db.close()
+        self.assertTrue(notes)
+
+        def read_back(filepath: str) -> List[Note]:
+            with open(filepath, encoding='utf-8') as file:
+                return list(read_notes(file))
+
+        # Everything in one file, in order, after the header.
+        write_dir = self._path('write_to')
+        filepath = os.path.join(write_dir, 'all.txt')
+        self.assertEqual(Exporter(filepath).export(notes, 'HEADER'),
+                         [filepath])
+        with open(filepath, encoding='utf-8') as file:
+            self.assertEqual(file.readline(), 'HEADER\n')
+        written = read_back(filepath)
+        self.assertEqual([note.path for note in written],
+                         sort_notepaths(list(notes.keys())))
+        for note in written:
+            self.assertEqual(note.get_text().rstrip(),
+                             notes[note.path].get_text().rstrip())
+            self.assertEqual(note.tags, notes[note.path].tags)
+
+        # Writing again replaces the file without leaving temporary files.
+        Exporter(filepath).export({}, 'EMPTY')
+        self.assertEqual(read_back(filepath), [])
+        self.assertEqual(os.listdir(write_dir), ['all.txt'])
+
+        # One file per top-level segment, formatted by worker processes.
+        split_dir = os.path.join(write_dir, 'split')
+        filepaths = Exporter(split_dir, 1, workers=2).export(notes)
+        self.assertEqual(sorted(read_back(filepath)[0].path.split('/')[0]
+                                for filepath in filepaths),
+                         sorted(os.path.basename(filepath)[:-len('.nptext')]
+                                for filepath in filepaths))
+        written = [note for filepath in filepaths
+                   for note in read_back(filepath)]
+        self.assertEqual(sorted(note.path for note in written),
+                         sorted(notes.keys()))
+
+        # Segments can't name files outside of the directory.
+        odd = Note()
+        odd.path = '../up'
+        filepaths = Exporter(split_dir, 2).export({odd.path: odd})
+        self.assertEqual(filepaths,
+                         [os.path.join(split_dir, '_..', 'up.nptext')])
+        self.assertEqual(read_back(filepaths[0])[0].path, '../up')
+
+    def test_21_compressed_texts(self) -> None:
+        # Notes whose texts are compressed should read, merge, search, and
+        # keep old versions just as notes whose texts are not.
+        db = Database(self.db_path)
+        results = []
+        for compress_over, path in [(0, 'packed/off'), (60, 'packed/on')]:
+            db.set_compress_over(compress_over)
+            for i in range(20):
+                note = Note()
+                note.path = path
+                note.textlines = ['Line ' + str(i) + ' of the log.\n']
+                note.tags = ['tag' + str(i % 3)]
+                db.save_notes({note.path: note})
+            note = db.get_notes_by_path(path)[path]
+            cursor = db.connection.cursor()
+            sql = 'SELECT id FROM history WHERE path = ? ORDER BY id;'
+            cursor.execute(sql, (path,))
+            versions = [db._get_history_text(row[0]) for row in cursor]
+            cursor.close()
+            results.append((note.textlines, sorted(note.tags), versions))
+        self.assertEqual(results[0], results[1])
+        self.assertIn('Line 19 of the log.\n', results[1][0])
+
+        cursor = db.connection.cursor()
+        cursor.execute("SELECT path, typeof(text) FROM notes"
+                       " WHERE path LIKE 'packed/%' ORDER BY path;")
+        self.assertEqual(cursor.fetchall(),
+                         [('packed/off', 'text'), ('packed/on', 'blob')])
+
+        # Text searches look inside compressed texts.
+        qb = QueryBuilder()
+        sql = qb.build_sql_from_lists(['packed'], ['line 19', 'log'], [], [])
+        self.assertEqual(sorted(db._get_notes(sql).keys()),
+                         ['packed/off', 'packed/on'])
+
+        # A short text replacing a long one is stored as it is, and the long
+        # one can still be restored.
+        note = Note()
+        note.path = 'packed/on'
+        note.textlines = ['Short.\n']
+        note.directive = 'replace'
+        db.save_notes({note.path: note})
+        cursor.execute("SELECT typeof(text) FROM notes"
+                       " WHERE path = 'packed/on';")
+        self.assertEqual(cursor.fetchone()[0], 'text')
+        self.assertEqual(db.get_version('packed/on').textlines,
+                         results[1][0])
+        cursor.close()
+
+        self.assertRaises(DatabaseError, db.set_compress_over, -1)
+        db.set_compress_over(DEFAULT_COMPRESS_OVER)
+        db.close()
+        self.assertEqual(Database(self.db_path).get_compress_over(),
+                         DEFAULT_COMPRESS_OVER)
+
+    def test_22_notebooks(self) -> None:
+        # Two more notebooks, each with a note at the same path as a note
+        # in the main notebook, and one with a note only it has.
+        paths = {}
+        for name in ['team', 'home']:
+            paths[name] = self._path(name + '.sqlite3')
+            db = Database(paths[name])
+            notes = {}
+            for notepath in ['packed/on', name + '/only']:
+                note = Note()
+                note.path = notepath
+                note.textlines = ['Kept in the ' + name + ' notebook.\n']
+                notes[notepath] = note
+            db.save_notes(notes)
+            db.save_query('packed', "SELECT id FROM notes"
+                          " WHERE path LIKE 'packed/%';")
+            db.close()
+
+        db = Database(self.db_path)
+        note = Note()
+        note.path = 'packed/on'
+        note.textlines = ['Kept in the main database.\n']
+        db.save_notes({note.path: note})
+        db.save_query('notebook', QueryBuilder().build_sql_from_lists(
+            [], ['notebook'], [], []))
+        db.close()
+        notebooks = Notebooks(self.db_path, paths)
+        notes = notebooks.run_saved_query('notebook')
+        self.assertEqual(list(notes.keys()),
+                         ['home:home/only', 'home:packed/on',
+                          'team:packed/on', 'team:team/only'])
+        self.assertEqual(notes['team:packed/on'].path, 'team:packed/on')
+        self.assertEqual(notes['home:packed/on'].textlines,
+                         ['Kept in the home notebook.\n'])
+
+        # Every notebook runs the same SQL; results come back merged and
+        # in sort_notepaths() order, with the main notebook's unprefixed.
+        sql = "SELECT id FROM notes WHERE path = 'packed/on';"
+        notes = notebooks.run(lambda db: db._get_notes(sql))
+        self.assertEqual(list(notes.keys()),
+                         sort_notepaths(['packed/on', 'home:packed/on',
+                                         'team:packed/on']))
+        self.assertEqual(notebooks.run_saved_query('no such query'), {})
+
+        # The other notebooks are only read, never changed; one written by
+        # an earlier version of Notepath is refused rather than upgraded.
+        with open(paths['team'], 'rb') as file:
+            before = file.read()
+        notebooks.run_saved_query('notebook')
+        with open(paths['team'], 'rb') as file:
+            self.assertEqual(file.read(), before)
+        connection = sqlite3.connect(paths['team'])
+        connection.execute('DROP TABLE outline;')
+        connection.commit()
+        connection.close()
+        with open(paths['team'], 'rb') as file:
+            before = file.read()
+        self.assertRaises(NotebookError, notebooks.run_saved_query,
+                          'notebook')
+        with open(paths['team'], 'rb') as file:
+            self.assertEqual(file.read(), before)
+
+        self.assertEqual(parse_notebook_arg(' team = ~/team.sqlite3 '),
+                         ('team', os.path.expanduser('~/team.sqlite3')))
+        for arg in ['team', '=path', 'a:b=path', 'a/b=path']:
+            self.assertRaises(NotebookError, parse_notebook_arg, arg)
+        self.assertRaises(NotebookError, Notebooks, self.db_path,
+                          {'gone': self._path('gone.db')})
+
+    def test_23_async_database(self) -> None:
+        slow_sql = ('WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL'
+                    ' SELECT x + 1 FROM c LIMIT 100000000)'
+                    ' SELECT x FROM c WHERE x < 0;')
+
+        async def run() -> None:
+            async with AsyncDatabase(self._path('test_async.sqlite3'), readers=2,
+                                     max_pending=3) as db:
+                # Saves are made one at a time, however many are asked for.
+                notes = []
+                for i in range(10):
+                    note = Note()
+                    note.path = 'async/' + str(i)
+                    note.textlines = ['Saved at once.\n']
+                    note.tags = ['async']
+                    notes.append({note.path: note})
+                await asyncio.gather(*[db.save_notes(n) for n in notes])
+
+                # Queries run side by side (and wait, past max_pending).
+                results = await asyncio.gather(
+                    *[db.query(tags=['async']) for _ in range(10)])
+                for found in results:
+                    self.assertEqual(sorted(found.keys()),
+                                     sorted('async/' + str(i)
+                                            for i in range(10)))
+                found = await db.get_notes_by_path('async/3')
+                self.assertEqual(found['async/3'].textlines,
+                                 ['Saved at once.\n'])
+
+                # A query that takes too long is interrupted, and its
+                # connection can be used again.
+                start_time = time.time()
+                with self.assertRaises(asyncio.TimeoutError):
+                    await asyncio.wait_for(db.run_query(slow_sql), 0.2)
+                self.assertLess(time.time() - start_time, 5)
+                found = await asyncio.gather(
+                    *[db.query(texts=['saved']) for _ in range(2)])
+                self.assertEqual([len(f) for f in found], [10, 10])
+
+                # Readers can't write.
+                note = Note()
+                note.path = 'async/read-only'
+                with self.assertRaises(Exception):
+                    await db._read(lambda d: d.save_notes({note.path: note}))
+
+        asyncio.run(run())
+
+        # A call that times out keeps its place among the max_pending until
+        # its job stops running (this one can't be interrupted), so calls
+        # that time out one after another never run more than that at once.
+        running = []
+        most_running = []
+        lock = threading.Lock()
+
+        def sleep(db: Database) -> None:
+            with lock:
+                running.append(db)
+                most_running.append(len(running))
+            time.sleep(0.5)
+            with lock:
+                running.pop()
+
+        async def time_out() -> None:
+            async with AsyncDatabase(self._path('test_async.sqlite3'), readers=4,
+                                     max_pending=2) as db:
+                for _ in range(4):
+                    with self.assertRaises(asyncio.TimeoutError):
+                        await asyncio.wait_for(db._read(sleep), 0.05)
+
+        asyncio.run(time_out())
+        self.assertEqual(max(most_running), 2)
+
+    def test_24_memory_and_staged_databases(self) -> None:
+        def make_note(notepath: NotePath) -> Dict[NotePath, Note]:
+            note = Note()
+            note.path = notepath
+            note.textlines = ['Kept in memory.\n']
+            return {notepath: note}
+
+        def count_notes(filepath: str) -> int:
+            db = Database(filepath)
+            count = db.count_notes_under('')
+            db.close()
+            return count
+
+        db = Database(':memory:')
+        db.save_notes(make_note('memory/one'))
+        self.assertEqual(list(db.get_notes_by_path('memory/one').keys()),
+                         ['memory/one'])
+        self.assertFalse(db.sync())
+        db.close()
+        self.assertFalse(os.path.exists(':memory:'))
+
+        # A staged database is written to its file only by sync() or
+        # close(), and only if something changed.
+        staged_path = self._path('test_staged.sqlite3')
+        db = Database(staged_path, staged=True)
+        db.save_notes(make_note('staged/one'))
+        self.assertFalse(os.path.exists(staged_path))
+        self.assertTrue(db.sync())
+        self.assertFalse(db.sync())
+        self.assertEqual(count_notes(staged_path), 1)
+        db.save_notes(make_note('staged/two'))
+        db.close()
+        self.assertEqual(count_notes(staged_path), 2)
+        self.assertEqual([name for name in os.listdir(
+            os.path.dirname(staged_path)) if name.endswith('.tmp')], [])
+
+        # A staged database loads what is in its file, and won't write over
+        # changes made to the file since it was loaded.
+        db = Database(staged_path, staged=True)
+        self.assertEqual(db.count_notes_under(''), 2)
+        other = Database(staged_path)
+        other.save_notes(make_note('staged/three'))
+        other.close()
+        db.save_notes(make_note('staged/four'))
+        self.assertRaises(DatabaseError, db.sync)
+        db.connection.close()
+        self.assertEqual(count_notes(staged_path), 3)
+
+        # The script, run with --staged, exits with status 1 when it can't
+        # write its changes back.
+        script_path = self._copy_script()
+        script_db_path = os.path.join(os.path.dirname(script_path), 'data',
+                                      'notes.sqlite3')
+        Database(script_db_path).close()
+        process = subprocess.Popen(
+            [sys.executable, script_path, '--staged', '-s', '-'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, universal_newlines=True,
+            env=dict(os.environ, PYTHONUNBUFFERED='1'))
+        # (The database has been loaded once the script says it's saving.)
+        self.assertEqual(process.stdout.readline(),
+                         'SAVING NOTES INTO DATABASE FROM FILES:\n')
+        other = Database(script_db_path)
+        other.save_notes(make_note('script/other'))
+        other.close()
+        note = make_note('script/staged')['script/staged']
+        _, errors = process.communicate(str(note))
+        self.assertEqual(process.returncode, 1)
+        self.assertIn('NOT written back', errors)
+        self.assertEqual(count_notes(script_db_path), 1)
+
+    def test_25_profiler(self) -> None:
+        db = Database(':memory:')
+        profiler = Profiler()
+        db.set_profiler(profiler)
+        notes = {}
+        for i in range(50):
+            note = Note()
+            note.path = 'profile/' + str(i)
+            note.textlines = ['Note number ' + str(i) + '.\n']
+            notes[note.path] = note
+        db.save_notes(notes)
+        sql = QueryBuilder().build_sql_from_lists([], ['number 7'], [], [])
+        self.assertEqual(list(db._get_notes(sql).keys()), ['profile/7'])
+        report = json.loads(json.dumps(profiler.report()))
+        profiler.stop()
+
+        self.assertEqual(sorted(report['phases'].keys()),
+                         ['hydrate', 'query', 'save'])
+        self.assertEqual(report['phases']['save']['count'], 1)
+        self.assertEqual(report['calls'], {'REGEXP': 50})
+        self.assertGreater(report['peak_memory_bytes'], 0)
+
+        # Statements differing only in numbers are counted together.
+        inserts = [item for item in report['sql']
+                   if item['statement'].startswith('INSERT INTO notes')]
+        self.assertEqual(len(inserts), 1)
+        self.assertGreaterEqual(inserts[0]['count'], 50)
+        self.assertEqual(normalize_sql("SELECT  x FROM t WHERE id IN"
+                                       " (1, 22, 333) AND y = 4.5"
+                                       " AND z = 'it''s\n2';"),
+                         'SELECT x FROM t WHERE id IN (?, ...) AND y = ?'
+                         ' AND z = ?;')
+
+        # Without a profiler, nothing more is counted.
+        db.set_profiler(None)
+        db._get_notes(sql)
+        self.assertEqual(profiler.report()['calls'], {'REGEXP': 50})
+        db.close()
+
+    def test_26_benchmark_corpus(self) -> None:
+        # The same settings always make the same notes.
+        first = [str(note) for note in Corpus(count=100, seed=3).notes()]
+        again = [str(note) for note in Corpus(count=100, seed=3).notes()]
+        other = [str(note) for note in Corpus(count=100, seed=4).notes()]
+        self.assertEqual(first, again)
+        self.assertNotEqual(first, other)
+
+        corpus = Corpus(count=300, depth=2, branching=4, tags=5, fields=3)
+        notes = list(corpus.notes())
+        self.assertEqual(len({note.path for note in notes}), 300)
+        for note in notes:
+            self.assertLessEqual(note.path.count('/'), 2)
+            self.assertTrue(set(note.tags) <= {corpus.tag_name(i)
+                                               for i in range(5)})
+            self.assertTrue(note.get_text())
+            self.assertEqual(len(note.get_field_values('title')), 1)
+
+        # Every kind of query the benchmarks run finds some of the notes.
+        db = Database(':memory:')
+        db.save_note_stream(notes)
+        queries = [
+            ([corpus.segment(1, 2)], [], [], []),
+            (['^' + corpus.segment(0, 1)], [], [], []),
+            ([], [corpus.word(0)], [], []),
+            ([], [], [corpus.tag_name(0)], []),
+            ([], [], [], [corpus.field_name(0) + ' < 500']),
+            ([], [], [], ['title has ' + corpus.word(0)]),
+            ([], [], [], ['title re ^' + corpus.word(0)]),
+            ([], [], [], ['title HAS ' + corpus.word(0)]),
+        ]
+        for paths, texts, tags, fields in queries:
+            sql = QueryBuilder().build_sql_from_lists(paths, texts,
+                                                      tags, fields)
+            self.assertTrue(sql)
+            found = db._get_notes(sql)
+            self.assertTrue(0 < len(found) < 300, (paths, texts, tags,
+                                                   fields))
+        db.close()
+
+    def test_27_ranked_queries(self) -> None:
+        db = Database(self.db_path, self.archive_path)
+        db.set_compress_over(100)
+        qb = QueryBuilder()
+
+        def save(notepath: NotePath, text: str, tags: List[str] = ()):
+            note = Note()
+            note.path = notepath
+            note.textlines = [text]
+            note.tags = list(tags)
+            db.save_notes({note.path: note})
+
+        def ranked(texts: List[str], limit: int = None) -> List[NotePath]:
+            return list(db.run_ranked_query([], texts, [], [], limit))
+
+        def unranked(texts: List[str]) -> List[NotePath]:
+            sql = qb.build_sql_from_lists([], texts, [], [])
+            return sort_notepaths(list(db._get_notes(sql)))
+
+        # (bm25() weighs a word by how few notes have it, so most notes
+        # here must not have it.)
+        for i in range(20):
+            save('filler/' + str(i), 'Nothing much to see here.')
+        save('rank/one', 'One cat among a great many other words. ' * 3)
+        save('rank/cat', 'Here is a cat among a great many other words.')
+        save('rank/tagged', 'Here is a cat among a great many words.',
+             ['cat'])
+        save('rank/catalog', 'A catalog of dogs, and of dogs only.')
+        save('rank/long', 'Cats and dogs. ' * 50 + 'A cat.') # compressed
+        save('rank/quote', "I don't know where the cat is.")
+
+        # Ranking finds the same notes as the query would, best first: a
+        # word in the path or a tag counts for more than one in the text.
+        self.assertEqual(sorted(ranked(['cat'])), unranked(['cat']))
+        self.assertEqual(len(unranked(['cat'])), 5)
+        found = ranked(['cat'])
+        self.assertEqual(set(found[:2]), {'rank/cat', 'rank/tagged'})
+        self.assertEqual(ranked(['cat'], 2), found[:2])
+        self.assertEqual(ranked(["don't know"]), ['rank/quote'])
+        self.assertEqual(ranked(['cat', 'dogs']), ['rank/long'])
+        self.assertEqual(ranked(['dog']), [])
+
+        # Decomposed text (with combining marks) is split into words the
+        # same way for the index as for the REGEXP clauses.
+        save('rank/nfd', 'My re\u0301sume\u0301 is attached.')
+        for text in ['re\u0301sume\u0301', 'sume', 'my re\u0301sume\u0301']:
+            self.assertEqual(unranked([text]), ['rank/nfd'])
+            self.assertEqual(ranked([text]), ['rank/nfd'])
+
+        # A phrase with no words is left to the REGEXP clauses; with only
+        # such phrases, there is nothing to rank by, so the notes come in
+        # notepath order.
+        self.assertEqual(sorted(ranked(['cat', '.'])), unranked(['cat', '.']))
+        self.assertEqual(ranked(['.'], 2), ['filler/0', 'filler/1'])
+
+        # The index follows the notes as they are saved, moved, deleted,
+        # and tagged, by any route.
+        found = ranked(['cat'])
+        self.assertLess(found.index('rank/one'), found.index('rank/quote'))
+        save('rank/new', 'A new cat.')
+        db.move_notes('rank/one', 'moved/one')
+        sql = qb.build_sql_from_lists(['^rank/long'], [], [], [])
+        db.change_notes(sql, delete=True)
+        sql = qb.build_sql_from_lists(['^rank/quote'], [], [], [])
+        db.change_notes(sql, add_tags=['cat'])
+        self.assertEqual(sorted(ranked(['cat'])), unranked(['cat']))
+        self.assertIn('rank/new', unranked(['cat']))
+        self.assertNotIn('rank/long', unranked(['cat']))
+        found = ranked(['cat'])
+        self.assertIn('moved/one', found)
+        self.assertLess(found.index('rank/quote'), found.index('moved/one'))
+
+        # If the change log is truncated past what the index has seen, the
+        # index is built again.
+        save('rank/newer', 'Another cat.')
+        db.truncate_changes(db.get_last_change())
+        save('rank/newest', 'Yet another cat.')
+        self.assertEqual(sorted(ranked(['cat'])), unranked(['cat']))
+        self.assertIn('rank/newer', ranked(['cat']))
+
+        # A note deleted from a path that is used again loses its last
+        # change when the log is compacted (here, from the middle of the
+        # log), but still leaves the index.
+        save('rank/reused', 'A cat to delete.')
+        ranked(['cat'])
+        save('rank/kept', 'A change the log keeps.')
+        sql = qb.build_sql_from_lists(['^rank/reused'], [], [], [])
+        db.change_notes(sql, delete=True)
+        save('rank/reused', 'A dog this time.')
+        db.compact_changes()
+        cursor = db.connection.cursor()
+        cursor.execute('SELECT COUNT(*) FROM notes_fts WHERE notes_fts'
+                       " MATCH 'text : (\"cat to delete\")';")
+        self.assertEqual(cursor.fetchone()[0], 1)
+        self.assertEqual(sorted(ranked(['cat'])), unranked(['cat']))
+        cursor.execute('SELECT COUNT(*) FROM notes_fts WHERE notes_fts'
+                       " MATCH 'text : (\"cat to delete\")';")
+        self.assertEqual(cursor.fetchone()[0], 0)
+        cursor.close()
+
+        # The ranked query reads no table from end to end.
+        sql = qb.build_ranked_sql_from_lists(['^rank'], ['cat'], ['cat'],
+                                             [], 3)
+        cursor = db.connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+        plan = [row[3] for row in cursor.fetchall()]
+        cursor.close()
+        self.assertFalse([row for row in plan
+                          if re.match(r'SCAN (notes|tags)\b', row)], plan)
+        db.close()
+
+        # A read-only connection can rank with an index that is up to date,
+        # but cannot bring one up to date.
+        reader = Database(self.db_path, read_only=True)
+        self.assertIn('rank/newest', reader.run_ranked_query([], ['cat'],
+                                                             [], []))
+        db = Database(self.db_path, self.archive_path)
+        save('rank/latest', 'The latest cat.')
+        db.close()
+        with self.assertRaises(DatabaseError):
+            reader.run_ranked_query([], ['cat'], [], [])
+        reader.close()
+
+        # The script refuses --rank or --limit with --as-of or -n, rather
+        # than printing an empty result; and with -w and -P, it writes the
+        # paths found in order of their paths, ranked or not.
+        script_path = self._copy_script()
+        def run_script(*args: str) -> subprocess.CompletedProcess:
+            return subprocess.run([sys.executable, script_path] + list(args),
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE,
+                                  universal_newlines=True)
+        save_path = self._path('rank_notes.nptext')
+        with open(save_path, mode='w', encoding='utf-8') as file:
+            for notepath, text in [('a', 'One cat.\n'),
+                                   ('b', 'A cat, a cat, a cat.\n')]:
+                note = Note()
+                note.path = notepath
+                note.textlines = [text]
+                file.write(str(note))
+        self.assertEqual(run_script('-s', save_path).returncode, 0)
+        for args in [['--rank', '-n', 'cats'], ['--limit', '1', '-n', 'cats'],
+                     ['--rank', '--as-of', '2020-01-01'],
+                     ['--limit', '1', '--as-of', '2020-01-01']]:
+            with self.subTest(args=args):
+                result = run_script('-t', 'cat', *args)
+                self.assertEqual(result.returncode, 1)
+                self.assertIn('cannot use --rank or --limit', result.stderr)
+        paths_path = self._path('rank_paths.txt')
+        result = run_script('-t', 'cat', '--rank', '-P', '-w', paths_path)
+        self.assertEqual(result.returncode, 0)
+        with open(paths_path, encoding='utf-8') as file:
+            self.assertEqual(file.read(), 'a\nb\n')
+
+
+class Test_QueryPlans(unittest.TestCase):
+    '''Check that queries use the indexes they should.
+
+    A query that stops using an index still finds the right notes, only
+    more slowly, so these tests look at the plan SQLite makes for each
+    query (with EXPLAIN QUERY PLAN) instead of at its results. A term for
+    a tag or a field, or a time limit, should always be found through an
+    index; a path or a text is matched with a regular expression, which
+    no index can help with, so at most one table may be scanned for it
+    (the others then only look up the notes it found).
+
+    Each test runs on a database of notes from the benchmark corpus, both
+    as it is and after ANALYZE, which gives SQLite statistics to choose
+    plans by (and so can change them).
+    '''
+    # Terms of each kind, as they'd be given on the command line.
+    TERMS = {
+        'path':     (['work'], [], [], []),
+        'root':     (['^work'], [], [], []),
+        'text':     ([], ['cat'], [], []),
+        'tag':      ([], [], ['project'], []),
+        'field_op': ([], [], [], ['price < 5']),
+        'field_eq': ([], [], [], ['price = 5']),
+        'has':      ([], [], [], ['title has cat']),
+        're':       ([], [], [], ['title re ^c']),
+    }
+    TIMES = {
+        'no time': {},
+        'modified_since': {'modified_since': 1.0},
+        'created_before': {'created_before': 2.0e9},
+        'as_of': {'as_of': 2.0e9},
+    }
+    INDEXED_KINDS = ['tag', 'field_op', 'field_eq', 'has', 're']
+    SCAN = re.compile(r'^SCAN (notes|tags|history|history_tags)\b')
+
+    def setUp(self) -> None:
+        self.corpus = Corpus(count=300)
+        self.db = Database(':memory:')
+        self.db.save_note_stream(self.corpus.notes())
+
+    def tearDown(self) -> None:
+        self.db.close()
+
+    def _get_plan(self, sql: str) -> List[str]:
+        rows = self.db.connection.execute('EXPLAIN QUERY PLAN ' + sql)
+        return [row[3] for row in rows]
+
+    def _get_scans(self, sql: str) -> List[str]:
+        return [step for step in self._get_plan(sql) if self.SCAN.match(step)]
+
+    def _check_query_plans(self) -> None:
+        qb = QueryBuilder()
+        kinds = sorted(self.TERMS)
+        combinations = ([(kind,) for kind in kinds]
+                        + list(itertools.combinations(kinds, 2)))
+        for combination, time_name in itertools.product(combinations,
+                                                        self.TIMES):
+            terms = [[], [], [], []]
+            for kind in combination:
+                for i, items in enumerate(self.TERMS[kind]):
+                    terms[i] = terms[i] + items
+            times = self.TIMES[time_name]
+            indexed = (bool(set(combination) & set(self.INDEXED_KINDS))
+                       or bool(times))
+            sql = qb.build_sql_from_lists(*terms, **times)
+            with self.subTest(terms=combination, time=time_name):
+                scans = self._get_scans(sql)
+                if indexed:
+                    self.assertEqual(scans, [], sql)
+                else:
+                    self.assertLessEqual(len(scans), 1, sql)
+
+                # A tag is never looked up by its (NULL) value.
+                if combination == ('tag',):
+                    self.assertNotIn('value_index',
+                                     ' '.join(self._get_plan(sql)), sql)
+
+                # The history is always searched by time.
+                sql = qb.build_history_sql_from_lists(*terms, as_of=2.0e9)
+                self.assertEqual(self._get_scans(sql), [], sql)
+
+    def test_01_query_plans(self) -> None:
+        self._check_query_plans()
+
+    def test_02_query_plans_with_statistics(self) -> None:
+        self.db.connection.execute('ANALYZE;')
+        self._check_query_plans()
+
+    def test_03_save_and_change_plans(self) -> None:
+        # Merging notes and changing notes by query look up each note's
+        # tags and fields. Collect every statement they run, and check
+        # that none of them reads all of the notes or all of the tags.
+        self.db.connection.execute('ANALYZE;')
+        statements = []
+        self.db.connection.set_trace_callback(statements.append)
+        notes = {}
+        for note in itertools.islice(self.corpus.notes(), 5):
+            note.tags.append('added')
+            note.fields.append(('added', 7.0))
+            note.textlines.append('Added.\n')
+            notes[note.path] = note
+        self.db.save_notes(notes)
+        sql = QueryBuilder().build_sql_from_lists([], [], ['tag3'], [])
+        self.db.change_notes(sql, add_tags=['changed'], remove_tags=['tag0'],
+                             set_fields=[('field1', 3.0)])
+        self.db.connection.set_trace_callback(None)
+
+        checked = 0
+        for statement in set(statements):
+            if not re.match(r'(SELECT|INSERT|UPDATE|DELETE)\b', statement):
+                continue
+            plan = self._get_plan(statement)
+            self.assertEqual([step for step in plan if self.SCAN.match(step)],
+                             [], statement)
+            if re.search(r'FROM tags\b.*\bid = ', statement):
+                self.assertNotIn('value_index', ' '.join(plan), statement)
+                checked += 1
+        self.assertGreater(checked, 0)
+
 
 class Test_Note(unittest.TestCase):
     def test_99_adding_metadata_line_to_note_in_text_mode_fails(self):
@@ -280,14 +1553,6 @@ class Test_Note(unittest.TestCase):
         #     note should always reject it.
         pass
 
-def tearDownModule():
-    # Clean up after yourself. Delete the database and archive test files.
-    files = [DATABASE_PATH, ARCHIVE_PATH]
-    for file in files:
-        if os.path.exists(file):
-            os.remove(file)
-
-
 if __name__ == '__main__':
     unittest.main()
 